@@ -1,6 +1,6 @@
 # TODO: Serve out the url of the image of the event. 
 import os
-from flask import Flask, request, send_from_directory
+from flask import Flask, request, abort
 from flask_cors import CORS
 from flask_apscheduler import APScheduler
 
@@ -11,10 +11,15 @@ from services import event as event_service
 from services import user as user_service
 from services import asset as asset_service
 from services import auth as auth_service
-from services import webscrape as webscrape_service
+from services import scrape_jobs as scrape_jobs_service
+from services import scrape_worker as scrape_worker_service
+from services import delivery as delivery_service
+from services import asset_gc as asset_gc_service
+from services import upload_session as upload_session_service
 
 class Config:
 	SCHEDULER_API_ENABLED = True
+	USE_X_SENDFILE = delivery_service.ASSET_OFFLOAD == 'sendfile'
 
 app = Flask(__name__)
 PORT = os.environ.get("PORT")
@@ -26,20 +31,42 @@ CORS(
 		"https://heap-2025-client.vercel.app",
 	], 
 	supports_credentials=True, 
-	methods=["GET", "POST", "OPTIONS", "DELETE", "PATCH"], 
+	methods=["GET", "POST", "OPTIONS", "DELETE", "PATCH", "PUT"], 
 	allow_headers=["Content-Type", "Authorization"]
 )
 
 scheduler = APScheduler()
 scheduler.init_app(app)
 
+# Scrapes run in a separate worker process which takes jobs from a queue (see
+# services/scrape_worker.py). It is started with the server unless SCRAPE_WORKER is
+# "external", and restarted when a job is queued if it died.
+def start_scrape_worker():
+	if os.environ.get("SCRAPE_WORKER") != "external":
+		scrape_worker_service.spawn()
+
 @scheduler.task('cron', id='do_scrape', minute='30', hour='14')
 def scrape():
-	print('Scrapping...')
-	webscrape_service.scrape(print_mode="all")
-	print('Scrapping ended.')
+	job, created = scrape_jobs_service.enqueue({"fullRefresh": os.environ.get("SCRAPE_FULL_REFRESH") == "true"}, trigger='cron')
+	print(f"Scrape job {job['jobId']} {'queued' if created else 'is already queued or running'}.")
+	start_scrape_worker()
+
+@scheduler.task('cron', id='asset_gc', minute='0', hour='19')
+def collect_assets():
+	print('Collecting orphaned assets...')
+	asset_gc_service.run(dry_run=os.environ.get("ASSET_GC_DRY_RUN") == "true")
+	print('Asset collection ended.')
+
+# Runs once at startup: move uploads from the old flat folder into the sharded layout
+# (resumes where a previous run stopped), then build the asset registry and report
+# drift against the stored files
+@scheduler.task('date', id='prepare_assets')
+def prepare_assets():
+	asset_service.migrate_storage_layout()
+	asset_service.reconcile_assets()
 
 scheduler.start()
+start_scrape_worker()
 
 @app.route("/")
 def index():
@@ -59,12 +86,89 @@ def list_jobs():
         })
     return web_service.sendSuccess(job_list)
 
+# POST /jobs queues a scrape (admins only, with an optional {"fullRefresh": true} body),
+# GET /jobs/<job_id> reports its status, stage, counts and ETA in seconds, and
+# DELETE /jobs/<job_id> cancels it (admins only)
+@app.route('/jobs', methods=["POST"])
+def create_job():
+	match request.method:
+		case "POST": # start a scrape
+			# authentication
+			try:
+				user_id = auth_service.validate_user_session(request.headers)
+			except AuthApiError:
+				return web_service.sendUnauthorised('You do not have access to this item')
+			except Exception:
+				return web_service.sendInternalError('Unable to perform authentication')
+
+			try:
+				full_refresh = (request.get_json(silent=True) or {}).get('fullRefresh', False) == True
+			except:
+				return web_service.sendBadRequest("Invalid request body")
+
+			try:
+				user = user_service.get_user_detail(user_id)
+				if (user == {}):
+					return web_service.sendInternalError("Unexpected error. Please contact admin")
+				if user['role'] != 'admin':
+					return web_service.sendUnauthorised("You cannot start a scrape")
+
+				job, created = scrape_jobs_service.enqueue({"fullRefresh": full_refresh}, trigger='manual')
+				# also when the job exists already: it may be a stale one which was just requeued
+				start_scrape_worker()
+				if not created:
+					return web_service.sendConflict("A scrape is already queued or running", job)
+				return web_service.sendSuccess(job)
+			except Exception as e:
+				print(e)
+				return web_service.sendInternalError('Cannot start scrape')
+		case _:
+			return web_service.sendMethodNotAllowed()
+
+@app.route('/jobs/<int:job_id>', methods=["GET", "DELETE"])
+def scrape_job(job_id):
+	match request.method:
+		case "GET": # progress of a scrape
+			try:
+				job = scrape_jobs_service.get_job(job_id)
+				if job == {}:
+					return web_service.sendBadRequest("Job not exists")
+				return web_service.sendSuccess(job)
+			except Exception as e:
+				print(e)
+				return web_service.sendInternalError('Unable to fetch job')
+		case "DELETE": # cancel a scrape
+			# authentication
+			try:
+				user_id = auth_service.validate_user_session(request.headers)
+			except AuthApiError:
+				return web_service.sendUnauthorised('You do not have access to this item')
+			except Exception:
+				return web_service.sendInternalError('Unable to perform authentication')
+
+			try:
+				user = user_service.get_user_detail(user_id)
+				if (user == {}):
+					return web_service.sendInternalError("Unexpected error. Please contact admin")
+				if user['role'] != 'admin':
+					return web_service.sendUnauthorised("You cannot cancel a scrape")
+
+				job = scrape_jobs_service.cancel(job_id)
+				if job == {}:
+					return web_service.sendBadRequest("Job not exists")
+				return web_service.sendSuccess(job)
+			except Exception as e:
+				print(e)
+				return web_service.sendInternalError('Cannot cancel scrape')
+		case _:
+			return web_service.sendMethodNotAllowed()
+
 @app.route("/get_all", methods=["GET", "POST"])
 def get_all():
 	if request.method == "GET":
 		try:
 			events = event_service.list_events()
-			assets = asset_service.get_all_assets()
+			assets = asset_service.get_all_assets(with_variants=request.args.get('variants') == 'true')
 			for event in events:
 				if not event['image']:
 					event['image'] = assets.get(event['eventId'])
@@ -85,7 +189,7 @@ def get_all():
 		try:
 			events = event_service.list_events()
 			events = [event for event in events if event["createdUserId"] == user_id]
-			assets = asset_service.get_all_assets()
+			assets = asset_service.get_all_assets(with_variants=request.args.get('variants') == 'true')
 			for event in events:
 				if not event['image']:
 					event['image'] = assets.get(event['eventId'])
@@ -112,7 +216,7 @@ def event():
 					return web_service.sendBadRequest("Event not exists")
 
 				if (not event['image']):
-					event['image'] = asset_service.get_assets_by_event_id(event_id)
+					event['image'] = asset_service.get_assets_by_event_id(event_id, with_variants=request.args.get('variants') == 'true')
 				return web_service.sendSuccess(event)
 			except Exception as e:
 				print(e)
@@ -151,14 +255,13 @@ def event():
 				
 				# handle file uploads
 				files = request.files.getlist("image")
-				for file in files:
-					if file.filename != '':
-						asset_id = asset_service.create_asset(file)
-						if asset_id == "":
-							return web_service.sendInternalError("Cannot create asset")
-						link_success = asset_service.link_asset(event_id, asset_id)
-						if not link_success:
-							return web_service.sendInternalError("Cannot link asset")
+				files = [file for file in files if file.filename != '']
+				if len(files) > 0:
+					asset_ids, linked = asset_service.create_and_link_assets(event_id, files)
+					if "" in asset_ids:
+						return web_service.sendInternalError("Cannot create asset")
+					if not linked:
+						return web_service.sendInternalError("Cannot link asset")
 				return web_service.sendSuccess(event_id)
 			except Exception as e:
 				print(e)
@@ -207,14 +310,13 @@ def event():
 					else:
 						update_data['ímage'] = None
 
-				for file in files:
-					if file.filename != '':
-						asset_id = asset_service.create_asset(file)
-						if asset_id == "":
-							return web_service.sendInternalError("Cannot create asset")
-						link_success = asset_service.link_asset(event_id, asset_id)
-						if not link_success:
-							return web_service.sendInternalError("Cannot link asset")
+				files = [file for file in files if file.filename != '']
+				if len(files) > 0:
+					asset_ids, linked = asset_service.create_and_link_assets(event_id, files)
+					if "" in asset_ids:
+						return web_service.sendInternalError("Cannot create asset")
+					if not linked:
+						return web_service.sendInternalError("Cannot link asset")
 
 				result = event_service.edit_event(event_id, update_data)
 				if result == "":
@@ -457,14 +559,13 @@ def asset():
 
 				# handle file uploads
 				files = request.files.getlist("file")
-				for file in files:
-					if file.filename != '':
-						asset_id = asset_service.create_asset(file)
-						if asset_id == "":
-							return web_service.sendInternalError("Cannot create asset")
-						link_success = asset_service.link_asset(event_id, asset_id)
-						if not link_success:
-							return web_service.sendInternalError("Cannot link asset")
+				files = [file for file in files if file.filename != '']
+				if len(files) > 0:
+					asset_ids, linked = asset_service.create_and_link_assets(event_id, files)
+					if "" in asset_ids:
+						return web_service.sendInternalError("Cannot create asset")
+					if not linked:
+						return web_service.sendInternalError("Cannot link asset")
 				return web_service.sendSuccess(event_id)
 			except Exception as e:
 				print(e)
@@ -507,6 +608,102 @@ def asset():
 		case _:
 			return web_service.sendMethodNotAllowed()
 
+# Resumable chunked upload: POST /asset/upload to start, PUT /asset/upload/<upload_id>?offset=<n>
+# with the raw bytes of each chunk, GET /asset/upload/<upload_id> to find the offset to resume
+# from, then POST /asset/upload/<upload_id>/finalize to verify the hash and link the asset
+@app.route('/asset/upload', methods=["POST"])
+def create_upload():
+	match request.method:
+		case "POST": # start an upload
+			# authentication
+			try:
+				user_id = auth_service.validate_user_session(request.headers)
+			except AuthApiError:
+				return web_service.sendUnauthorised('You do not have access to this item')
+			except Exception:
+				return web_service.sendInternalError('Unable to perform authentication')
+
+			try:
+				req = request.get_json()
+				event_id = req['eventId']
+				file_name = req['fileName']
+				file_size = int(req['fileSize'])
+				sha256 = req['sha256']
+			except:
+				return web_service.sendBadRequest("Invalid request body")
+
+			try:
+				user = user_service.get_user_detail(user_id)
+				if (user == {}):
+					return web_service.sendInternalError("Unexpected error. Please contact admin")
+
+				event = event_service.get_event_detail(event_id)
+				if (event == {}):
+					return web_service.sendBadRequest("Event not exists")
+
+				if user['role'] != 'admin' and user_id != event['createdUserId']:
+					return web_service.sendUnauthorised("You cannot upload to this event")
+
+				session = upload_session_service.create_session(event_id, user_id, file_name, file_size, sha256)
+				return web_service.sendSuccess(session)
+			except upload_session_service.UploadSessionError as e:
+				return web_service.sendBadRequest(str(e))
+			except Exception as e:
+				print(e)
+				return web_service.sendInternalError('Cannot start upload')
+		case _:
+			return web_service.sendMethodNotAllowed()
+
+@app.route('/asset/upload/<upload_id>', methods=["GET", "PUT"])
+@app.route('/asset/upload/<upload_id>/finalize', methods=["POST"], endpoint='finalize_upload')
+def upload(upload_id):
+	# authentication
+	try:
+		user_id = auth_service.validate_user_session(request.headers)
+	except AuthApiError:
+		return web_service.sendUnauthorised('You do not have access to this item')
+	except Exception:
+		return web_service.sendInternalError('Unable to perform authentication')
+
+	session = upload_session_service.get_session(upload_id)
+	if session == {}:
+		return web_service.sendBadRequest("Upload not exists")
+	if session['userId'] != user_id:
+		return web_service.sendUnauthorised("You cannot access this upload")
+
+	match request.method:
+		case "GET": # current offset to resume from
+			return web_service.sendSuccess(session)
+		case "PUT": # append a chunk
+			try:
+				offset = int(request.args['offset'])
+			except:
+				return web_service.sendBadRequest("Invalid offset")
+
+			try:
+				new_offset = upload_session_service.write_chunk(upload_id, offset, request.stream)
+				return web_service.sendSuccess({"uploadId": upload_id, "offset": new_offset})
+			except upload_session_service.OffsetMismatchError as e:
+				return web_service.sendConflict(str(e), {"uploadId": upload_id, "offset": e.offset})
+			except upload_session_service.UploadSessionError as e:
+				return web_service.sendBadRequest(str(e))
+			except Exception as e:
+				print(e)
+				return web_service.sendInternalError('Cannot upload chunk')
+		case "POST": # verify and store the file
+			try:
+				asset_id = upload_session_service.finalize(upload_id)
+				return web_service.sendSuccess(asset_id)
+			except upload_session_service.OffsetMismatchError as e:
+				return web_service.sendConflict(str(e), {"uploadId": upload_id, "offset": e.offset})
+			except upload_session_service.UploadSessionError as e:
+				return web_service.sendBadRequest(str(e))
+			except Exception as e:
+				print(e)
+				return web_service.sendInternalError('Cannot finalize upload')
+		case _:
+			return web_service.sendMethodNotAllowed()
+
 @app.route('/login', methods=["POST"])
 def login():
 	match request.method:
@@ -533,8 +730,18 @@ def login():
 
 @app.route('/uploads/<path:filename>')
 def serve_upload(filename):
-    uploads_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-    return send_from_directory(uploads_dir, filename)
+	# ?variant=thumb|card|full serves a resized WebP copy of an image
+	asset_file = asset_service.get_asset_file(filename, request.args.get('variant'))
+	if asset_file == {}:
+		abort(404)
+	return delivery_service.send_asset(
+		asset_file['path'],
+		asset_file['relativePath'],
+		mimetype=asset_file['mimeType'],
+		etag=asset_file['etag'],
+		precompressed_path=asset_file['precompressedPath'],
+		immutable=asset_file['immutable']
+	)
 
 @app.route('/health')
 def health():
@@ -0,0 +1,148 @@
+# Benchmark for parsing scraped pages
+#
+# Compares the previous parsing of every page (BeautifulSoup with html5lib for the Cordy
+# listing, BeautifulSoup with html.parser then etree.HTML on the re-serialized soup for
+# the other pages) with the single lxml parse in webscrape.parse_html(). For each page
+# fixture it checks that the extracted events are the same, then reports:
+#   (1) CPU time per parse
+#   (2) peak Python memory during a parse (tracemalloc)
+#   (3) growth of the resident set size during a parse in a fresh process, which also
+#       counts the memory libxml2 allocates outside of Python
+# Memory is measured on the page with its body repeated --scale times (the fixtures are
+# too small to move the resident set size) and reported per copy of the page.
+#
+# Run from server-python:
+#   python -m benchmarks.parse_pages [--repeat 50] [--scale 200]
+
+import os
+import sys
+import glob
+import time
+import resource
+import argparse
+import tracemalloc
+import multiprocessing
+from bs4 import BeautifulSoup
+from lxml import etree
+
+from services import webscrape
+from services import scrape_sources
+
+FIXTURE_FOLDER = os.path.join(os.path.dirname(__file__), 'fixtures', 'pages')
+
+def legacy_parse(name, content):
+    if name == 'cordy_listing.html':
+        return BeautifulSoup(content, 'html5lib')
+    soup = BeautifulSoup(content, 'html.parser')
+    return etree.HTML(text=str(soup), parser=None)
+
+def legacy_parse_cordy_listing(soup):
+    # Cordy listing extraction before the single parse, on the html5lib soup
+    def text(element):
+        return element.get_text(strip=True) if element else None
+    events = []
+    for event in soup.select('.opp-cms-wrapper.w-dyn-item'):
+        link = event.select_one('.opp-cms-link-item')
+        img = event.select_one('.opp-cms-thumbnail img')
+        events.append({
+            "title": text(event.select_one('.text-block-6')),
+            "link": "https://www.cordy.sg" + str(link['href']) if link else None,
+            "signupDeadline": webscrape.format_date(text(event.select_one('.text-block-10'))),
+            "tags": [tag.get_text(strip=True) for tag in event.select('.text-block-18')],
+            "organisation": text(event.select_one('.opp-cms-organisation')),
+            "briefDescription": text(event.select_one('.opp-cms-caption')),
+            "image": img['src'] if img else None,
+            "origin": "web",
+            "mode": "unknown",
+        })
+    return events
+
+def extract(name, dom, legacy=False):
+    # Events extracted from a parsed page with the scraper functions
+    if name == 'cordy_listing.html':
+        if legacy:
+            return legacy_parse_cordy_listing(dom)
+        # origin and mode are filled in from the source fields since they moved out of the listing parser
+        cordy = scrape_sources.get_source('cordy')
+        return [cordy.apply_fields(event) for event in webscrape.parse_cordy_listing(dom)]
+    if name == 'cordy_detail.html':
+        return webscrape.parse_cordy_detail(dom, {"briefDescription": ""})
+    if name == 'sginnovate_listing.html':
+        return webscrape.parse_innovate_listing(dom)
+    return webscrape.parse_innovate_detail(dom, {})
+
+def scaled(content, scale):
+    # The page with the contents of its body repeated scale times
+    start = content.index(b'<body')
+    start = content.index(b'>', start) + 1
+    end = content.rindex(b'</body>')
+    return content[:start] + content[start:end] * scale + content[end:]
+
+def cpu_time(function, content, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        function(content)
+    return (time.process_time() - start) / repeat
+
+def python_peak(function, content):
+    tracemalloc.start()
+    dom = function(content)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del dom
+    return peak
+
+def _rss_growth(function, content, queue):
+    # A tiny page is parsed first, so that lazy imports and parser setup are not counted
+    function(b"<html><body><p>warm up</p></body></html>")
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    dom = function(content)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) # KiB on Linux
+    del dom
+
+def rss_growth(function, content):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_rss_growth, args=(function, content, queue))
+    process.start()
+    growth = queue.get()
+    process.join()
+    return growth
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=50, help="parses per page for the CPU time")
+    parser.add_argument('--scale', type=int, default=200, help="copies of the page body for the memory measurements")
+    args = parser.parse_args()
+
+    mismatches = 0
+    print(f"{'page':<26}{'KiB':>6}{'legacy ms':>11}{'new ms':>8}{'speedup':>9}{'legacy py KiB':>15}{'new py KiB':>12}{'legacy rss KiB':>16}{'new rss KiB':>13}")
+    for path in sorted(glob.glob(os.path.join(FIXTURE_FOLDER, '*.html'))):
+        name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+        legacy = lambda content, name=name: legacy_parse(name, content)
+
+        expected = extract(name, legacy(content), legacy=True)
+        output = extract(name, webscrape.parse_html(content))
+        if output != expected:
+            mismatches += 1
+            print(f"{name}: extracted events differ\n--- legacy ---\n{expected!r}\n--- new ---\n{output!r}")
+            continue
+
+        legacy_time = cpu_time(legacy, content, args.repeat)
+        new_time = cpu_time(webscrape.parse_html, content, args.repeat)
+        large = scaled(content, args.scale)
+        print(
+            f"{name:<26}{len(content) / 1024:>6.1f}"
+            f"{legacy_time * 1000:>11.2f}{new_time * 1000:>8.2f}{legacy_time / new_time:>8.1f}x"
+            f"{python_peak(legacy, large) / 1024 / args.scale:>15.1f}{python_peak(webscrape.parse_html, large) / 1024 / args.scale:>12.1f}"
+            f"{rss_growth(legacy, large) / args.scale:>16.1f}{rss_growth(webscrape.parse_html, large) / args.scale:>13.1f}"
+        )
+
+    if mismatches:
+        print(f"{mismatches} page(s) give different events than the legacy parsing.")
+        sys.exit(1)
+    print("Every page gives the same events as the legacy parsing.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Micro-benchmark for webscrape.parse_paragraphs()
+#
+# Checks that parse_paragraphs() gives the same output as the previous implementation
+# (serialize to html, str.replace the tags, strip tags character by character and
+# unescape with BeautifulSoup) on the description fixtures, then times both on every
+# fixture and on a large description made by repeating all fixtures.
+#
+# Run from server-python:
+#   python -m benchmarks.parse_paragraphs [--scale 200] [--repeat 5]
+
+import os
+import sys
+import glob
+import timeit
+import argparse
+from bs4 import BeautifulSoup
+from lxml import etree
+
+from services import webscrape
+
+FIXTURE_FOLDER = os.path.join(os.path.dirname(__file__), 'fixtures', 'descriptions')
+
+def legacy_parse_paragraphs(paragraphs):
+    # parse_paragraphs() before it was rewritten as a tree walker
+    return_str = ""
+    for para in paragraphs:
+        write = True
+        if str(etree.tostring(para, method="text", encoding='unicode')) == "": continue # type: ignore
+        html = str(etree.tostring(para, method="html", encoding='unicode')) # type: ignore
+        if "data-cfemail=" in html:
+            return_str += str(webscrape.deCFEmail(para.xpath('.//a/@data-cfemail')[0])) + "\n"
+            continue
+        newline_tags = (
+            '<br>', '</li>', '<p>', '</p>',
+            '<h1>', '</h1>', '<h2>', '</h2>',
+            '<h3>', '</h3>', '<h4>', '</h4>',
+            '<h5>', '</h5>', '<h6>', '</h6>',
+            )
+        for tag in newline_tags:
+            html = html.replace(tag, "\n")
+        html = html.replace("<li>", "\n-")
+        for ch in html:
+            if write and ch == "<":
+                write = False
+            if not write and ch == ">":
+                write = True
+                continue
+            if write:
+                return_str += ch
+        return_str += "\n"
+    while "\n\n" in return_str:
+        return_str = return_str.replace("\n\n", "\n")
+    return_str = return_str.replace("-\n", "- ")
+    soup = BeautifulSoup(f"<p>{return_str.strip()}<p>", 'html.parser')
+    return_str = soup.get_text().strip("\n")
+    return return_str
+
+def load_fixtures():
+    # Output: dict of fixture name -> element holding the paragraphs (first element in <body>),
+    # parsed the same way as the scrapers parse detail pages
+    fixtures = dict()
+    for path in sorted(glob.glob(os.path.join(FIXTURE_FOLDER, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            soup = BeautifulSoup(f.read(), 'html.parser')
+        dom = etree.HTML(text=str(soup), parser=None)
+        fixtures[os.path.basename(path)] = dom.xpath('/html/body/*[1]')[0]
+    return fixtures
+
+def large_description(fixtures, scale, nested=False):
+    # One element with the paragraphs of every fixture repeated scale times
+    # If nested, they are wrapped in a single paragraph, like a description without <p> tags
+    # (leaving out fixtures with a protected email, which replaces the whole paragraph)
+    html = "".join(
+        "".join(etree.tostring(para, method="html", encoding='unicode') for para in paragraphs)
+        for paragraphs in fixtures.values()
+        if not (nested and paragraphs.xpath('.//@data-cfemail'))
+    ) * scale
+    if nested:
+        html = f"<div>{html}</div>"
+    return etree.HTML(f"<div>{html}</div>").xpath('/html/body/div')[0]
+
+def best_time(function, paragraphs, repeat):
+    number = max(1, int(0.2 / max(timeit.timeit(lambda: function(paragraphs), number=1), 1e-6)))
+    return min(timeit.repeat(lambda: function(paragraphs), number=number, repeat=repeat)) / number
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=int, default=200, help="times the fixtures are repeated in the large description")
+    parser.add_argument('--repeat', type=int, default=5, help="timing runs per case (the best is reported)")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures()
+    cases = dict(fixtures)
+    cases[f"all fixtures x{args.scale}"] = large_description(fixtures, args.scale)
+    cases[f"all fixtures x{args.scale}, one block"] = large_description(fixtures, args.scale, nested=True)
+
+    mismatches = 0
+    print(f"{'case':<36}{'chars':>9}{'legacy ms':>12}{'new ms':>10}{'speedup':>9}")
+    for name, paragraphs in cases.items():
+        expected = legacy_parse_paragraphs(paragraphs)
+        output = webscrape.parse_paragraphs(paragraphs)
+        if output != expected:
+            mismatches += 1
+            print(f"{name}: output differs\n--- legacy ---\n{expected!r}\n--- new ---\n{output!r}")
+            continue
+        legacy = best_time(legacy_parse_paragraphs, paragraphs, args.repeat)
+        new = best_time(webscrape.parse_paragraphs, paragraphs, args.repeat)
+        print(f"{name:<36}{len(output):>9}{legacy * 1000:>12.3f}{new * 1000:>10.3f}{legacy / new:>8.1f}x")
+
+    if mismatches:
+        print(f"{mismatches} case(s) differ from the legacy output.")
+        sys.exit(1)
+    print("Output identical to the legacy implementation on every case.")
+
+if __name__ == "__main__":
+    main()
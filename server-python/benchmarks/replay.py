@@ -0,0 +1,363 @@
+# Record/replay harness for the scrape pipeline
+#
+# Recording runs a scrape and saves every HTTP response the scrapers get and every reply
+# from Gemini into a fixture bundle (gzipped JSON). The scrape runs with return_data and
+# full_refresh on a throwaway cache folder, so it writes nothing to the database and
+# fetches every page. The upstream is either the live sites and Gemini API, or the page
+# fixtures in fixtures/pages (every listing card repeated --scale times) with a stand-in
+# Gemini that gives a valid enrichment for every event, so a bundle can be made offline.
+#
+# install() serves a bundle to the pipeline from local stand-ins: a requests adapter for
+# the sites, an httpx transport for Gemini and an in-memory Supabase client, each of
+# which answers after a configurable latency (see benchmarks.scrape_pipeline).
+#
+# Image mirroring is turned off in both modes. The services are only imported inside the
+# functions, because their cache folder is read from the environment on import.
+#
+# Run from server-python:
+#   python -m benchmarks.replay --out bundle.json.gz              (live sites and Gemini)
+#   python -m benchmarks.replay --out bundle.json.gz --fixtures [--scale 20]
+
+import os
+import sys
+import json
+import gzip
+import time
+import uuid
+import base64
+import hashlib
+import argparse
+import tempfile
+import threading
+from copy import deepcopy
+from types import SimpleNamespace
+from datetime import datetime, timezone
+import httpx
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+FIXTURE_FOLDER = os.path.join(os.path.dirname(__file__), 'fixtures', 'pages')
+ROOT_USER_ID = "00000000-0000-0000-0000-000000000000"
+# The body is stored decoded, so these headers no longer describe it
+DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+def new_bundle(upstream):
+    return {"version": 1, "recordedAt": datetime.now(timezone.utc).isoformat(), "upstream": upstream, "http": {}, "gemini": {}}
+
+def load_bundle(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_bundle(bundle, path):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(bundle, f)
+
+def _headers(headers):
+    return {name: value for name, value in headers.items() if name.lower() not in DROPPED_HEADERS}
+
+def gemini_key(body):
+    # Requests are matched on their JSON body (not the model in the URL), so a replay still
+    # matches when gemini_quota picks another model than during the recording
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True)
+    except ValueError:
+        body = body.decode('utf-8', 'replace') if isinstance(body, bytes) else body
+    return hashlib.sha256(body.encode()).hexdigest()
+
+# ---------------------- HTTP (scrape_http) ----------------------
+
+class RecordingAdapter(BaseAdapter):
+    # Sends requests through another adapter and records the responses in the bundle
+    def __init__(self, bundle, adapter=None):
+        super().__init__()
+        self.bundle = bundle
+        self.adapter = adapter or HTTPAdapter()
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        body = response.content
+        with self.lock:
+            self.bundle['http'][request.url] = {
+                "status": response.status_code,
+                "headers": _headers(response.headers),
+                "body": base64.b64encode(body).decode(),
+            }
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+class ReplayAdapter(BaseAdapter):
+    # Answers requests from the bundle after latency seconds (404 for URLs it does not have)
+    def __init__(self, responses, latency=0.0):
+        super().__init__()
+        self.responses = responses
+        self.latency = latency
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        entry = self.responses.get(request.url)
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        if entry is None:
+            response.status_code, response.reason = 404, "Not Found"
+            response._content = b""
+        else:
+            response.status_code, response.reason = entry['status'], "OK" if entry['status'] == 200 else ""
+            response.headers = CaseInsensitiveDict(entry['headers'])
+            response._content = base64.b64decode(entry['body'])
+        response._content_consumed = True
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    def close(self):
+        pass
+
+# ---------------------- Gemini (gemini_client) ----------------------
+
+class RecordingTransport(httpx.BaseTransport):
+    # Sends requests through another transport and records the replies in the bundle
+    # A successful reply is not replaced by a later error for the same request
+    def __init__(self, bundle, transport=None):
+        self.bundle = bundle
+        self.transport = transport or httpx.HTTPTransport()
+        self.lock = threading.Lock()
+
+    def handle_request(self, request):
+        response = self.transport.handle_request(request)
+        body = response.read()
+        headers = _headers(response.headers)
+        key = gemini_key(request.read())
+        with self.lock:
+            recorded = self.bundle['gemini'].get(key)
+            if recorded is None or recorded['status'] != 200 or response.status_code == 200:
+                self.bundle['gemini'][key] = {"status": response.status_code, "headers": headers, "body": body.decode('utf-8')}
+        return httpx.Response(response.status_code, headers=headers, content=body, request=request)
+
+    def close(self):
+        self.transport.close()
+
+class ReplayTransport(httpx.BaseTransport):
+    # Answers Gemini requests from the bundle after latency seconds
+    # A request which was not recorded gets a 400, which fails the enrichment loudly
+    def __init__(self, replies, latency=0.0):
+        self.replies = replies
+        self.latency = latency
+
+    def handle_request(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        reply = self.replies.get(gemini_key(request.read()))
+        if reply is None:
+            error = {"error": {"code": 400, "message": "Request not in the replay bundle", "status": "INVALID_ARGUMENT"}}
+            return httpx.Response(400, json=error, request=request)
+        return httpx.Response(reply['status'], headers=reply['headers'], content=reply['body'].encode('utf-8'), request=request)
+
+class FakeGeminiTransport(httpx.BaseTransport):
+    # Stand-in Gemini for bundles made from the fixtures: answers every enrichment request
+    # with a valid result for each event, picking the event type from words in the title
+    EVENT_TYPES = (("hack", "Hackathons"), ("case", "Case Comps"), ("workshop", "Workshops"))
+
+    def _result(self, index, item):
+        # Answers the fields the item asks for (all of them for items without a list)
+        fields = item.get('fields') or ("eventType", "mode", "briefDescription")
+        title = str(item.get('title') or "")
+        result = {"index": index}
+        if "eventType" in fields:
+            result["eventType"] = next((event_type for word, event_type in self.EVENT_TYPES if word in title.lower()), "Talks")
+            result["confidence"] = 90
+        if "mode" in fields:
+            result["mode"] = "offline" if item.get('location') else "unknown"
+        if "briefDescription" in fields:
+            words = str(item.get('description') or title).split()
+            result["briefDescription"] = " ".join(words[:25]) or title
+        return result
+
+    def handle_request(self, request):
+        body = json.loads(request.read())
+        content = body['contents'][0]['parts'][0]['text']
+        try:
+            items = json.loads(content)
+        except ValueError:
+            items = []
+        results = [self._result(item.get('index', i), item) for i, item in enumerate(items)] if isinstance(items, list) else []
+        text = json.dumps(results)
+        reply = {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {"promptTokenCount": len(content) // 4, "candidatesTokenCount": len(text) // 4, "totalTokenCount": (len(content) + len(text)) // 4},
+        }
+        return httpx.Response(200, json=reply, request=request)
+
+# ---------------------- Supabase (database) ----------------------
+
+class StandInDB:
+    # In-memory stand-in for the Supabase client, with the table and rpc calls that
+    # insert_to_database() makes. Every call takes latency seconds.
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = dict()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def table(self, name):
+        return _StandInQuery(self, name)
+
+    def rpc(self, name, params):
+        return _StandInQuery(self, None, rpc=name)
+
+class _StandInQuery:
+    def __init__(self, db, table, rpc=None):
+        self.db = db
+        self.name = table
+        self.rpc = rpc
+        self.operation = 'select'
+        self.payload = None
+        self.filters = []
+
+    def select(self, *columns):
+        self.operation = 'select'
+        return self
+
+    def insert(self, rows):
+        self.operation, self.payload = 'insert', rows
+        return self
+
+    def update(self, data):
+        self.operation, self.payload = 'update', data
+        return self
+
+    def delete(self):
+        self.operation = 'delete'
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, value))
+        return self
+
+    def execute(self):
+        if self.db.latency:
+            time.sleep(self.db.latency)
+        with self.db.lock:
+            self.db.calls += 1
+            if self.rpc is not None:
+                return SimpleNamespace(data=1)
+            rows = self.db.tables.setdefault(self.name, [])
+            matches = [row for row in rows if all(row.get(column) == value for column, value in self.filters)]
+            if self.operation == 'insert':
+                matches = [dict(row) for row in (self.payload if isinstance(self.payload, list) else [self.payload])]
+                for row in matches:
+                    if self.name == 'Event':
+                        row.setdefault('eventId', str(uuid.uuid4()))
+                rows.extend(matches)
+            elif self.operation == 'update':
+                for row in matches:
+                    row.update(self.payload)
+            elif self.operation == 'delete':
+                self.db.tables[self.name] = [row for row in rows if row not in matches]
+            return SimpleNamespace(data=[dict(row) for row in matches])
+
+# ---------------------- Setup ----------------------
+
+def install(bundle, http_latency=0.0, gemini_latency=0.0, db_latency=0.0):
+    """
+    Points the scrapers, Gemini client and database at stand-ins serving the bundle
+
+    Args:
+        bundle (dict): the fixture bundle
+        http_latency (float): seconds each page request takes
+        gemini_latency (float): seconds each Gemini request takes
+        db_latency (float): seconds each database call takes
+
+    Return:
+        StandInDB: the stand-in database, with the events written by the scrape
+    """
+    from services import scrape_http, gemini_client, asset as asset_service, database as database_service
+    scrape_http.configure(ReplayAdapter(bundle['http'], http_latency))
+    gemini_client.configure(api_key="replay", transport=ReplayTransport(bundle['gemini'], gemini_latency))
+    asset_service.SERVER_ASSET_PATH = ""
+    db = StandInDB(db_latency)
+    database_service.db = db
+    database_service.get_root_user_id = lambda: ROOT_USER_ID
+    return db
+
+def fixture_pages(scale):
+    """
+    Args:
+        scale (int): times every card of the listing fixtures is repeated, each copy with its own link and title
+
+    Return:
+        dict: URL -> bundle entry of the listing pages and of the detail page of every event on them
+    """
+    import lxml.html
+    from lxml import etree
+    from services import webscrape, scrape_sources
+    listings = {
+        # source -> (listing fixture, detail fixture, cards, title of a card)
+        "cordy": ("cordy_listing.html", "cordy_detail.html", webscrape.CORDY_EVENTS, webscrape.CORDY_TITLE),
+        "sginnovate": ("sginnovate_listing.html", "sginnovate_detail.html", webscrape.INNOVATE_CARDS, etree.XPath('.//h4/a')),
+    }
+
+    def entry(content):
+        return {"status": 200, "headers": {"Content-Type": "text/html; charset=utf-8"}, "body": base64.b64encode(content).decode()}
+
+    pages = dict()
+    for name, (listing, detail, cards, title) in listings.items():
+        source = scrape_sources.get_source(name)
+        with open(os.path.join(FIXTURE_FOLDER, listing), 'rb') as f:
+            dom = webscrape.parse_html(f.read())
+        for card in cards(dom):
+            parent = card.getparent()
+            for i in range(scale - 1, 0, -1):
+                copy = deepcopy(card)
+                for link in copy.iter('a'):
+                    if (link.get('href') or "").startswith('/'):
+                        link.set('href', f"{link.get('href')}-{i}")
+                for element in title(copy)[:1]:
+                    element.text = f"{element.text or ''} ({i + 1})"
+                card.addnext(copy)
+        content = lxml.html.tostring(dom, encoding='utf-8', doctype='<!DOCTYPE html>')
+        pages[source.listing_url] = entry(content)
+        with open(os.path.join(FIXTURE_FOLDER, detail), 'rb') as f:
+            detail_page = entry(f.read())
+        for event in source.parse_listing(webscrape.parse_html(content)):
+            pages[event['link']] = detail_page
+    return pages
+
+def record(path, fixtures=False, scale=1):
+    """
+    Runs a scrape and saves its HTTP responses and Gemini replies as a bundle
+
+    Args:
+        path (string): where the bundle is saved
+        fixtures (boolean): scrape the page fixtures with a stand-in Gemini instead of the live sites and API
+        scale (int): times every listing card is repeated when scraping the fixtures
+    """
+    from services import webscrape, scrape_http, gemini_client, asset as asset_service
+    bundle = new_bundle("fixtures" if fixtures else "live")
+    if fixtures:
+        scrape_http.configure(RecordingAdapter(bundle, ReplayAdapter(fixture_pages(scale))))
+        gemini_client.configure(api_key="replay", transport=RecordingTransport(bundle, FakeGeminiTransport()))
+    else:
+        scrape_http.configure(RecordingAdapter(bundle))
+        gemini_client.configure(transport=RecordingTransport(bundle))
+    asset_service.SERVER_ASSET_PATH = ""
+    data = webscrape.scrape(print_mode='critical', return_data=True, full_refresh=True)
+    save_bundle(bundle, path)
+    print(f"Recorded {len(bundle['http'])} pages and {len(bundle['gemini'])} Gemini replies for {len(data)} events into {path}.")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--out', required=True, help="path of the bundle (.json.gz)")
+    parser.add_argument('--fixtures', action='store_true', help="record the page fixtures with a stand-in Gemini instead of the live sites")
+    parser.add_argument('--scale', type=int, default=1, help="times every listing card is repeated with --fixtures")
+    args = parser.parse_args()
+    # A throwaway cache, so that every page is fetched and every event enriched
+    os.environ['SCRAPE_CACHE_FOLDER'] = tempfile.mkdtemp(prefix='scrape_replay_')
+    record(args.out, fixtures=args.fixtures, scale=args.scale)
+
+if __name__ == "__main__":
+    sys.exit(main())
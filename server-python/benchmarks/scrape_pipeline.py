@@ -0,0 +1,111 @@
+# Benchmark of the whole scrape pipeline, replayed from a fixture bundle (see benchmarks.replay)
+#
+# Every run is a fresh process with an empty cache folder and a full refresh, so it fetches,
+# parses, enriches and inserts every event of the bundle, from local stand-ins for the
+# sites, Gemini and Supabase which answer after the given latencies. The scrape settings
+# from the environment (SCRAPE_HOST_RATE, GEMINI_BATCH_SIZE, SCRAPE_QUEUE_SIZE...) apply as
+# in production. Reports, as the median over the runs:
+#   (1) the items and busy seconds of every stage, summed over the sources, and its rate
+#   (2) the events written to the stand-in database, the wall time and the events/s
+#
+# Run from server-python:
+#   python -m benchmarks.scrape_pipeline --bundle bundle.json.gz [--repeat 3]
+#   python -m benchmarks.scrape_pipeline --fixtures [--scale 20]   (records a bundle from the page fixtures first)
+# with --http-latency, --gemini-latency and --db-latency in seconds per request.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import contextlib
+import multiprocessing
+
+STAGES = ("list", "fetch", "parse", "enrich", "upsert")
+
+def _cold_start():
+    # A new cache folder, also the working directory so that output.json is written there
+    folder = tempfile.mkdtemp(prefix='scrape_bench_')
+    os.environ['SCRAPE_CACHE_FOLDER'] = folder
+    os.chdir(folder)
+
+def _record(path, scale, queue):
+    _cold_start()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        from benchmarks import replay
+        replay.record(path, fixtures=True, scale=scale)
+    queue.put(None)
+
+def _run(path, latencies, queue):
+    # The services are imported after the cache folder is set, so that the run starts cold
+    _cold_start()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        from benchmarks import replay
+        from services import webscrape, scrape_pipeline, scrape_sources
+        db = replay.install(replay.load_bundle(path), *latencies)
+        start = time.perf_counter()
+        webscrape.scrape(print_mode='critical', full_refresh=True)
+        wall = time.perf_counter() - start
+    stages = {stage: {"items": 0, "seconds": 0.0} for stage in STAGES}
+    for name, stats in scrape_pipeline.get_stats().items():
+        stage = stages.setdefault(name.split('/')[-1], {"items": 0, "seconds": 0.0})
+        stage["items"] += stats["items"]
+        stage["seconds"] += stats["seconds"]
+    queue.put({
+        "wall": wall,
+        "stages": stages,
+        "events": len(db.tables.get('Event', [])),
+        "dbCalls": db.calls,
+        "sources": {name: stats['status'] for name, stats in scrape_sources.get_stats().items()},
+    })
+
+def in_process(target, *args):
+    # Runs target in a new interpreter, so that the services are imported fresh
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bundle', help="fixture bundle made with benchmarks.replay")
+    parser.add_argument('--fixtures', action='store_true', help="record a bundle from the page fixtures instead of using --bundle")
+    parser.add_argument('--scale', type=int, default=20, help="times every listing card is repeated with --fixtures")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of the pipeline")
+    parser.add_argument('--http-latency', type=float, default=0.2, help="seconds per page request")
+    parser.add_argument('--gemini-latency', type=float, default=1.5, help="seconds per Gemini request")
+    parser.add_argument('--db-latency', type=float, default=0.05, help="seconds per database call")
+    args = parser.parse_args()
+    if args.fixtures == bool(args.bundle):
+        parser.error("give either --bundle or --fixtures")
+
+    path = os.path.abspath(args.bundle) if args.bundle else None
+    if args.fixtures:
+        path = os.path.join(tempfile.mkdtemp(prefix='scrape_bench_'), 'bundle.json.gz')
+        in_process(_record, path, args.scale)
+
+    latencies = (args.http_latency, args.gemini_latency, args.db_latency)
+    runs = [in_process(_run, path, latencies) for _ in range(args.repeat)]
+    for i, run in enumerate(runs):
+        failed = {name: status for name, status in run['sources'].items() if status != "ok"}
+        if failed:
+            print(f"Run {i + 1}: sources did not finish: {failed}")
+            sys.exit(1)
+
+    print(f"latency: {args.http_latency}s per page, {args.gemini_latency}s per Gemini request, {args.db_latency}s per database call")
+    print(f"{'stage':<10}{'items':>8}{'busy s':>10}{'items/s':>10}")
+    for stage in runs[0]['stages']:
+        items = statistics.median(run['stages'][stage]['items'] for run in runs)
+        seconds = statistics.median(run['stages'][stage]['seconds'] for run in runs)
+        print(f"{stage:<10}{items:>8.0f}{seconds:>10.2f}{items / seconds if seconds else 0:>10.1f}")
+    events = statistics.median(run['events'] for run in runs)
+    wall = statistics.median(run['wall'] for run in runs)
+    db_calls = statistics.median(run['dbCalls'] for run in runs)
+    print(f"{events:.0f} events inserted with {db_calls:.0f} database calls in {wall:.2f}s: {events / wall:.1f} events/s (median of {len(runs)} runs)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+-- Content hash and sniffed MIME type of each stored asset, used to deduplicate uploads
+-- without comparing them byte by byte against every file on disk.
+alter table "Asset" add column if not exists "contentHash" text;
+alter table "Asset" add column if not exists "mimeType" text;
+
+create index if not exists "Asset_contentHash_idx" on "Asset" ("contentHash");
@@ -0,0 +1,78 @@
+-- Atomic link/unlink of an asset to an event. Each function inserts or deletes the
+-- AssetMap row and adjusts Asset."numberOfReference" in a single transaction, so
+-- concurrent uploads of the same deduplicated file cannot lose updates.
+
+-- Remove duplicate links before enforcing uniqueness
+delete from "AssetMap" a
+    using "AssetMap" b
+    where a.ctid > b.ctid
+        and a."eventId" = b."eventId"
+        and a."assetId" = b."assetId";
+
+create unique index if not exists "AssetMap_eventId_assetId_idx" on "AssetMap" ("eventId", "assetId");
+
+-- Returns the new reference count of the asset
+create or replace function link_asset(
+    p_event_id "AssetMap"."eventId"%type,
+    p_asset_id "AssetMap"."assetId"%type
+) returns integer
+language plpgsql
+as $$
+declare
+    inserted integer;
+    new_count integer;
+begin
+    insert into "AssetMap" ("eventId", "assetId")
+        values (p_event_id, p_asset_id)
+        on conflict ("eventId", "assetId") do nothing;
+    get diagnostics inserted = row_count;
+
+    if inserted = 0 then
+        -- already linked, nothing to count
+        select "numberOfReference" into new_count from "Asset" where "assetId" = p_asset_id;
+        return new_count;
+    end if;
+
+    update "Asset"
+        set "numberOfReference" = "numberOfReference" + 1
+        where "assetId" = p_asset_id
+        returning "numberOfReference" into new_count;
+
+    if new_count is null then
+        raise exception 'Asset % does not exist', p_asset_id;
+    end if;
+    return new_count;
+end;
+$$;
+
+-- Returns the remaining reference count of the asset (0 when the Asset row was
+-- deleted, -1 when the link did not exist)
+create or replace function unlink_asset(
+    p_event_id "AssetMap"."eventId"%type,
+    p_asset_id "AssetMap"."assetId"%type
+) returns integer
+language plpgsql
+as $$
+declare
+    removed integer;
+    new_count integer;
+begin
+    delete from "AssetMap" where "eventId" = p_event_id and "assetId" = p_asset_id;
+    get diagnostics removed = row_count;
+
+    if removed = 0 then
+        return -1;
+    end if;
+
+    update "Asset"
+        set "numberOfReference" = greatest("numberOfReference" - 1, 0)
+        where "assetId" = p_asset_id
+        returning "numberOfReference" into new_count;
+
+    if coalesce(new_count, 0) = 0 then
+        delete from "Asset" where "assetId" = p_asset_id;
+        return 0;
+    end if;
+    return new_count;
+end;
+$$;
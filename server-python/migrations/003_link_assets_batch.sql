@@ -0,0 +1,22 @@
+-- Links several assets to one event in a single call, e.g. for a multi-image upload.
+-- Ids are locked in sorted order so concurrent batches cannot deadlock.
+create or replace function link_assets(
+    p_event_id "AssetMap"."eventId"%type,
+    p_asset_ids text[]
+) returns table ("assetId" text, "numberOfReference" integer)
+language plpgsql
+as $$
+declare
+    raw_id text;
+    v_asset_id "AssetMap"."assetId"%type;
+begin
+    foreach raw_id in array (
+        select coalesce(array_agg(id order by id), '{}') from (select distinct unnest(p_asset_ids) as id) ids
+    ) loop
+        v_asset_id := raw_id;
+        "assetId" := raw_id;
+        "numberOfReference" := link_asset(p_event_id, v_asset_id);
+        return next;
+    end loop;
+end;
+$$;
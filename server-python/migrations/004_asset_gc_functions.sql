@@ -0,0 +1,99 @@
+-- Sweeps of asset_gc which decide what to delete or fix when they write, instead of
+-- trusting the snapshot the collector took earlier. Each function locks the Asset row
+-- first: a link_asset/unlink_asset call in progress on it finishes before the AssetMap
+-- check, which is a new statement and so sees its link, and one which starts later
+-- waits for the collector (and fails if the Asset row is gone). Rows newer than
+-- p_grace_seconds are left alone, as the upload which made them may still be running.
+
+alter table "Asset" add column if not exists "createdAt" timestamptz not null default now();
+alter table "AssetMap" add column if not exists "createdAt" timestamptz not null default now();
+
+-- Deletes the Asset rows which no AssetMap row references. Returns the ids deleted.
+create or replace function gc_delete_unreferenced_assets(
+    p_asset_ids text[],
+    p_grace_seconds integer
+) returns table ("assetId" text)
+language plpgsql
+as $$
+declare
+    raw_id text;
+    v_asset_id "Asset"."assetId"%type;
+begin
+    foreach raw_id in array (
+        select coalesce(array_agg(id order by id), '{}') from (select distinct unnest(p_asset_ids) as id) ids
+    ) loop
+        v_asset_id := raw_id;
+        perform 1 from "Asset" a
+            where a."assetId" = v_asset_id
+                and a."createdAt" < now() - make_interval(secs => p_grace_seconds)
+            for update;
+        if found and not exists (select 1 from "AssetMap" m where m."assetId" = v_asset_id) then
+            delete from "Asset" a where a."assetId" = v_asset_id;
+            "assetId" := raw_id;
+            return next;
+        end if;
+    end loop;
+end;
+$$;
+
+-- Deletes the AssetMap rows of the given assets which point at a missing Asset row.
+-- Returns the number of rows deleted.
+create or replace function gc_delete_dangling_links(
+    p_asset_ids text[],
+    p_grace_seconds integer
+) returns integer
+language plpgsql
+as $$
+declare
+    raw_id text;
+    v_asset_id "AssetMap"."assetId"%type;
+    removed integer;
+    total integer := 0;
+begin
+    foreach raw_id in array (
+        select coalesce(array_agg(id order by id), '{}') from (select distinct unnest(p_asset_ids) as id) ids
+    ) loop
+        v_asset_id := raw_id;
+        delete from "AssetMap" m
+            where m."assetId" = v_asset_id
+                and m."createdAt" < now() - make_interval(secs => p_grace_seconds)
+                and not exists (select 1 from "Asset" a where a."assetId" = v_asset_id);
+        get diagnostics removed = row_count;
+        total := total + removed;
+    end loop;
+    return total;
+end;
+$$;
+
+-- Sets "numberOfReference" of the given assets to their number of AssetMap rows.
+-- Returns the assets whose count changed, with the new count.
+create or replace function gc_fix_reference_counts(
+    p_asset_ids text[]
+) returns table ("assetId" text, "numberOfReference" integer)
+language plpgsql
+as $$
+declare
+    raw_id text;
+    v_asset_id "Asset"."assetId"%type;
+    actual integer;
+begin
+    foreach raw_id in array (
+        select coalesce(array_agg(id order by id), '{}') from (select distinct unnest(p_asset_ids) as id) ids
+    ) loop
+        v_asset_id := raw_id;
+        perform 1 from "Asset" a where a."assetId" = v_asset_id for update;
+        if not found then
+            continue;
+        end if;
+        select count(*) into actual from "AssetMap" m where m."assetId" = v_asset_id;
+        update "Asset" a
+            set "numberOfReference" = actual
+            where a."assetId" = v_asset_id and a."numberOfReference" is distinct from actual;
+        if found then
+            "assetId" := raw_id;
+            "numberOfReference" := actual;
+            return next;
+        end if;
+    end loop;
+end;
+$$;
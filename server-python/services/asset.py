@@ -1,21 +1,120 @@
 import os
 import uuid
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
+from postgrest.exceptions import APIError
 from services import database as database_service
+from services import asset_registry
+from services import derivative
+from services import storage
 from services import utils
 
-UPLOAD_FOLDER = './uploads'
+UPLOAD_FOLDER = storage.UPLOAD_FOLDER
 SERVER_ASSET_PATH = os.getenv("SERVER_ASSET_PATH")
+CHUNK_SIZE = 64 * 1024 # bytes read from the request stream per iteration
+UPLOAD_WORKERS = 4 # files of one request written and hashed concurrently
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)  # This will create the folder if it doesn't exist
+_removal_queue = queue.Queue()
+_removal_lock = threading.Lock()
+_removal_worker = None
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+
+class MissingAssetError(Exception):
+    """
+    Raised when an asset could not be linked because its Asset row no longer exists, e.g.
+    when the registry of this process still had an asset deleted by another process
+    """
+    pass
+
+def _is_missing_asset(error):
+    # link_asset raises 'Asset <id> does not exist' (see migrations/002_asset_reference_functions.sql)
+    return error.code == '23503' or 'does not exist' in str(error.message)
 
 def validate_asset_id(asset_id):
-    return asset_id in [f for f in os.listdir(UPLOAD_FOLDER)]
+    return asset_registry.exists(asset_id)
+
+def get_asset_url(asset_id):
+    """
+    Args:
+        asset_id (string): asset UUID
+
+    Return:
+        string: public URL of the asset (e.g. https://localhost:5000/uploads/<asset_id>)
+    """
+    return f"{SERVER_ASSET_PATH or '/uploads/'}{asset_id}"
+
+def parse_asset_url(url):
+    """
+    Args:
+        url (string): an image URL
+
+    Return:
+        string: asset UUID if the URL points at one of our assets (empty string otherwise)
+    """
+    prefix = SERVER_ASSET_PATH or '/uploads/'
+    if not url or not url.startswith(prefix):
+        return ""
+    asset_id = url[len(prefix):].split('?', 1)[0]
+    return asset_id if asset_id and '/' not in asset_id else ""
+
+def get_asset_variants(asset_id):
+    """
+    Args:
+        asset_id (string): asset UUID
 
-def get_assets_by_event_id(event_id):
+    Return:
+        dict: asset UUID with the URLs of its resized image variants (e.g. {"assetId": ..., "variants": {"thumb": ...}})
+    """
+    return {
+        "assetId": asset_id,
+        "variants": derivative.get_variant_urls(asset_id, SERVER_ASSET_PATH or '/uploads/')
+    }
+
+def get_asset_file(asset_id, variant=None):
+    """
+    Args:
+        asset_id (string): asset UUID
+        variant (string): resized image variant (thumb, card or full), None for the original file
+
+    Return:
+        dict: path, relativePath, mimeType, etag, precompressedPath and immutable of the file to serve (empty dict if it does not exist).
+        The original is served, not immutable, while the variant is being generated.
+    """
+    path = storage.locate(asset_id)
+    if path is None:
+        return {}
+
+    record = asset_registry.get(asset_id) or {}
+    content_hash = record.get('contentHash')
+    if variant:
+        variant_path = derivative.get_variant(asset_id, path, variant)
+        if variant_path:
+            return {
+                "path": os.path.abspath(variant_path),
+                "relativePath": os.path.relpath(variant_path, UPLOAD_FOLDER),
+                "mimeType": "image/webp",
+                "etag": f"{content_hash}-{variant}",
+                "precompressedPath": None,
+                "immutable": True
+            }
+
+    return {
+        "path": os.path.abspath(path),
+        "relativePath": os.path.relpath(path, UPLOAD_FOLDER),
+        "mimeType": record.get('mimeType'),
+        "etag": content_hash,
+        "precompressedPath": os.path.abspath(derivative.precompressed_path(content_hash)) if content_hash else None,
+        "immutable": not (variant in derivative.VARIANTS and derivative.is_image(record))
+    }
+
+def get_assets_by_event_id(event_id, with_variants=False):
     """
     Args: 
         event_id (string): event id that is realted to the assets
+        with_variants (boolean): return the variant URLs of each asset instead of only the id
 
     Return:
         array of string: a list of paths to the asset access route (e.g. https://localhost:5000/uploads/<asset_id>)
@@ -31,12 +130,18 @@ def get_assets_by_event_id(event_id):
     result = []
     if (response and response.data):
         for record in response.data:
-            result.append(record['assetId'])
+            if with_variants:
+                result.append(get_asset_variants(record['assetId']))
+            else:
+                result.append(record['assetId'])
 
     return result   
          
-def get_all_assets():
+def get_all_assets(with_variants=False):
     """
+    Args:
+        with_variants (boolean): return the variant URLs of each asset instead of only the id
+
     Return:
         array of tuple (event_id, paths to the asset): all records in the assetMap table
     """
@@ -52,68 +157,54 @@ def get_all_assets():
         for record in response.data:
             if record['eventId'] not in result:
                 result[record['eventId']] = []
-            result[record['eventId']].append((record['assetId']))
+            if with_variants:
+                result[record['eventId']].append(get_asset_variants(record['assetId']))
+            else:
+                result[record['eventId']].append((record['assetId']))
 
     return result       
 
 def link_asset(event_id, asset_id):
     """
+    Links the asset to the event and increments its reference count in one atomic
+    database call (see migrations/002_asset_reference_functions.sql)
+
     Args:
         event_id (string): event eventId
         asset_id (string): asset UUID
 
     Return:
         boolean: True if the operation is successful
-    """
-    # check if the link has existed
-    response = (
-        database_service.get_db()
-        .table("AssetMap")
-        .select("*")
-        .eq("assetId", asset_id)
-        .eq("eventId", event_id)
-        .execute()
-    )
-    if len(response.data) > 0:
-        return True
 
-    # link the asset with event
-    response = (
-        database_service.get_db()
-        .table("AssetMap")
-        .insert(dict({
-            "eventId": str(event_id),
-            "assetId": str(asset_id)
-        }))
-        .execute()
-    )
-    if len(response.data) != 1:
+    Raises:
+        MissingAssetError: the Asset row no longer exists
+    """
+    try:
+        response = (
+            database_service.get_db()
+            .rpc("link_asset", {
+                "p_event_id": str(event_id),
+                "p_asset_id": str(asset_id)
+            })
+            .execute()
+        )
+    except APIError as e:
+        if not _is_missing_asset(e):
+            raise
+        asset_registry.remove(asset_id)
+        raise MissingAssetError(asset_id) from e
+    if response.data is None:
         return False
-    
-    # update the asset table for number of reference
-    currentCount = (
-        database_service.get_db()
-        .table("Asset")
-        .select("numberOfReference")
-        .eq("assetId", asset_id)
-        .single()
-        .execute()
-        .data
-        .get("numberOfReference")
-    )
 
-    response = (
-        database_service.get_db()
-        .table("Asset")
-        .update({"numberOfReference": currentCount + 1})
-        .eq("assetId", asset_id)
-        .execute()
-    )
-
-    return len(response.data) == 1
+    asset_registry.update(asset_id, numberOfReference=response.data)
+    return True
 
 def unlink_asset(event_Id, asset_id):
     """
+    Unlinks the asset from the event and decrements its reference count in one atomic
+    database call. The Asset row is deleted when no event references it anymore and
+    the file removal is queued.
+
     Args:
         event_Id (string): event eventId
         asset_id (string): asset UUID
@@ -121,101 +212,334 @@ def unlink_asset(event_Id, asset_id):
     Return:
         boolean: True if the operation is successful  
     """
-    # Remove from db
     response = (
         database_service.get_db()
-        .table("AssetMap")
-        .delete()
-        .eq("eventId", event_Id)
-        .eq("assetId", asset_id)
+        .rpc("unlink_asset", {
+            "p_event_id": str(event_Id),
+            "p_asset_id": str(asset_id)
+        })
         .execute()
     )
-    if (len(response.data) != 1):
-        return False        
+    remaining = response.data
+    if remaining is None or remaining < 0:
+        return False
+
+    if remaining == 0:
+        asset_registry.remove(asset_id)
+        queue_file_removal(asset_id)
+    else:
+        asset_registry.update(asset_id, numberOfReference=remaining)
+    return True
+
+def _remove_queued_files():
+    while True:
+        asset_id = _removal_queue.get()
+        try:
+            storage.remove(asset_id)
+        except Exception as e:
+            print(f"Unable to remove asset file {asset_id}: {e}")
+        _removal_queue.task_done()
+
+def queue_file_removal(asset_id):
+    """
+    Removes the file of a deleted asset on a background thread so the request does not wait on disk I/O
+
+    Args:
+        asset_id (string): asset UUID
+    """
+    global _removal_worker
+    with _removal_lock:
+        if _removal_worker is None:
+            _removal_worker = threading.Thread(target=_remove_queued_files, daemon=True)
+            _removal_worker.start()
+    _removal_queue.put(asset_id)
+
+def write_upload(stream):
+    """
+    Streams a file into a temporary file inside the upload folder in fixed size chunks,
+    computing its content hash, size and MIME type in the same pass.
+
+    Args:
+        stream (file-like): readable binary stream of the upload
+
+    Return:
+        tuple (temp_path, content_hash, file_size, mime_type)
+    """
+    fd, temp_path = storage.new_temp_file()
+    hasher = hashlib.sha256()
+    file_size = 0
+    mime_type = None
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if mime_type is None:
+                    mime_type = utils.sniff_mime(chunk)
+                hasher.update(chunk)
+                f.write(chunk)
+                file_size += len(chunk)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    return temp_path, hasher.hexdigest(), file_size, mime_type or 'application/octet-stream'
+
+def scan_file(path):
+    """
+    Reads a file in fixed size chunks to compute its content hash, size and MIME type
+
+    Args:
+        path (string): path of the file
+
+    Return:
+        tuple (content_hash, file_size, mime_type)
+    """
+    hasher = hashlib.sha256()
+    file_size = 0
+    mime_type = None
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if mime_type is None:
+                mime_type = utils.sniff_mime(chunk)
+            hasher.update(chunk)
+            file_size += len(chunk)
+    return hasher.hexdigest(), file_size, mime_type or 'application/octet-stream'
+
+def get_asset_id_by_hash(content_hash):
+    """
+    Args:
+        content_hash (string): sha256 hex digest of the file content
+
+    Return:
+        string: asset UUID of the stored file with the same content (empty string if none)
+    """
+    record = asset_registry.get_by_hash(content_hash)
+    if record:
+        return record['assetId']
+    return ""
+
+def ingest_file(temp_path, content_hash, file_size, mime_type, file_name, keep_duplicate=False):
+    """
+    Stores a fully written temporary file as an asset, or discards it when an asset with
+    the same content already exists.
+
+    Args:
+        temp_path (string): temporary file inside the upload folder
+        content_hash (string): sha256 hex digest of the file content
+        file_size (int): size of the file in bytes
+        mime_type (string): sniffed MIME type of the file
+        file_name (string): original file name from the client
+        keep_duplicate (boolean): leave the temporary file in place when the content already exists
+    Return:
+        string: asset UUID (empty string if failed)
+    """
+    # check if file is totally new
+    asset_id = get_asset_id_by_hash(content_hash)
+    if asset_id:
+        if not keep_duplicate:
+            os.remove(temp_path)
+        return asset_id
     
-    # check if still referenced by others
-    currentCount = (
+    # save asset
+    asset_id = _new_asset_id()
+    asset_path = storage.store(temp_path, asset_id)
+
+    # insert and entry in db
+    response = (
         database_service.get_db()
         .table("Asset")
-        .select("numberOfReference")
-        .eq("assetId", asset_id)
-        .single()
+        .insert(_asset_data(asset_id, content_hash, file_size, mime_type, file_name))
         .execute()
-        .data
-        .get("numberOfReference")
     )
 
-    if currentCount > 1:
-        response = (
-            database_service.get_db()
-            .table("Asset")
-            .update({"numberOfReference": currentCount - 1})
-            .eq("assetId", asset_id)
-            .execute()
-        )
-    else:
-        response = (
-            database_service.get_db()
-            .table("Asset")
-            .delete()
-            .eq("assetId", asset_id)
-            .execute()
-        )
+    if len(response.data) != 1:
+        os.remove(asset_path)
+        return ""
+    _register_asset(response.data[0], asset_path)
+    return asset_id
 
-        if len(response.data) != 1:
-            return False
-        
-        os.remove(os.path.join(UPLOAD_FOLDER, asset_id))
-    return len(response.data) == 1
+def create_assets(assets):
+    """
+    Takes in uploaded files and saves those which are not in the system yet. Each upload is
+    written to disk exactly once: the files are streamed to temporary files and hashed
+    concurrently, deduplicated with one lookup for the whole batch, and the new ones are
+    renamed into place and inserted with one bulk insert.
 
-def create_asset(asset):
+    Args:
+        assets (list of file): files that are being uploaded
+    Return:
+        list of string: asset UUID of each file, in the same order (empty strings if failed)
+    """
+    uploads = _write_uploads(assets)
+    try:
+        return _store_uploads(assets, uploads)
+    finally:
+        _discard_uploads(uploads)
+
+def create_and_link_assets(event_id, assets):
     """
-    Takes in an asset and save it to file system if the file has not been in the system. Otherwise, return UUID associated to the asset. 
+    create_assets followed by link_assets. The files which matched an existing asset are
+    kept until the link succeeded: if one of those assets was deleted in the meantime
+    (another process removed it while this one still had it in its registry), they are
+    stored as new assets and linked again.
 
     Args:
-        asset (file): a file that is being uploaded
+        event_id (string): event eventId
+        assets (list of file): files that are being uploaded
     Return:
-        string: asset UUID (empty string if failed)    
+        tuple (list of string, boolean): asset UUID of each file (empty strings if failed),
+        and True if they were all linked to the event
     """
-    # check if file is totally new
-    for f in os.listdir(UPLOAD_FOLDER):
-        if (f == "temp"):
-            continue
-        if utils.files_are_equal(os.path.join(UPLOAD_FOLDER, f), asset):
-            asset.seek(0)
-            asset_id = str(f)
-            return asset_id
-    
-    # generate asset UUID
-    asset_id = str(uuid.uuid4())
-    all_assets_id = [f for f in os.listdir(UPLOAD_FOLDER)]
-    while (asset_id in all_assets_id):
-        asset_id = str(uuid.uuid4())
+    uploads = _write_uploads(assets)
+    try:
+        asset_ids = _store_uploads(assets, uploads)
+        if "" in asset_ids:
+            return asset_ids, False
+        try:
+            return asset_ids, link_assets(event_id, asset_ids)
+        except MissingAssetError as e:
+            print(f"Asset {e} no longer exists, storing the upload again")
+        # the registry no longer has the missing assets, so their files are stored as new
+        asset_ids = _store_uploads(assets, uploads)
+        if "" in asset_ids:
+            return asset_ids, False
+        try:
+            return asset_ids, link_assets(event_id, asset_ids)
+        except MissingAssetError:
+            return asset_ids, False
+    finally:
+        _discard_uploads(uploads)
 
-    # save asset
-    asset.seek(0)
-    asset.save(os.path.join(UPLOAD_FOLDER, asset_id))
+def _write_uploads(assets):
+    # Streams the files to temporary files concurrently, see write_upload
+    futures = [_upload_executor.submit(write_upload, asset.stream) for asset in assets]
+    uploads = []
+    error = None
+    for future in futures:
+        try:
+            uploads.append(future.result())
+        except Exception as e:
+            error = e
+    if error is not None:
+        _discard_uploads(uploads)
+        raise error
+    return uploads
 
-    # insert and entry in db
-    asset.seek(0, 2)  # Move to end of file
-    file_size = asset.tell()
-    asset.seek(0)     # Reset pointer to start
+def _discard_uploads(uploads):
+    # Removes the temporary files which were not stored as an asset
+    for temp_path, _, _, _ in uploads:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
-    file_name = secure_filename(asset.filename)
-    asset_data = dict({
-        "assetId": asset_id,
-        "fileSize": file_size,
-        "originalFileName": file_name,
-        "numberOfReference": 0
-    })
+def _store_uploads(assets, uploads):
+    # Stores the uploads whose content is not an asset yet and inserts their Asset rows.
+    # The temporary files of the others are left in place for the caller to discard.
+    existing = asset_registry.get_by_hashes([content_hash for _, content_hash, _, _ in uploads])
+    asset_ids = []
+    new_assets = dict() # content hash -> (Asset row, stored path), also dedups files repeated in the batch
+    for asset, (temp_path, content_hash, file_size, mime_type) in zip(assets, uploads):
+        if content_hash in existing:
+            asset_ids.append(existing[content_hash]['assetId'])
+        elif content_hash in new_assets:
+            asset_ids.append(new_assets[content_hash][0]['assetId'])
+        else:
+            asset_id = _new_asset_id()
+            asset_path = storage.store(temp_path, asset_id)
+            new_assets[content_hash] = (_asset_data(asset_id, content_hash, file_size, mime_type, asset.filename), asset_path)
+            asset_ids.append(asset_id)
+
+    if len(new_assets) == 0:
+        return asset_ids
 
     response = (
         database_service.get_db()
         .table("Asset")
-        .insert(asset_data)
+        .insert([asset_data for asset_data, _ in new_assets.values()])
         .execute()
     )
+    if len(response.data) != len(new_assets):
+        for _, asset_path in new_assets.values():
+            os.remove(asset_path)
+        return [""] * len(assets)
 
-    if len(response.data) != 1:
-        return ""
+    for record in response.data:
+        _register_asset(record, new_assets[record['contentHash']][1])
+    return asset_ids
+
+def link_assets(event_id, asset_ids):
+    """
+    Links several assets to the event in one atomic database call
+    (see migrations/003_link_assets_batch.sql)
+
+    Args:
+        event_id (string): event eventId
+        asset_ids (list of string): asset UUIDs
+
+    Return:
+        boolean: True if the operation is successful
+
+    Raises:
+        MissingAssetError: one of the Asset rows no longer exists, nothing was linked
+    """
+    try:
+        response = (
+            database_service.get_db()
+            .rpc("link_assets", {
+                "p_event_id": str(event_id),
+                "p_asset_ids": [str(asset_id) for asset_id in asset_ids]
+            })
+            .execute()
+        )
+    except APIError as e:
+        if not _is_missing_asset(e):
+            raise
+        # drop the registry entries of the assets which are gone
+        missing = set(asset_ids) - asset_registry.refresh(asset_ids)
+        raise MissingAssetError(", ".join(missing)) from e
+    for record in response.data:
+        asset_registry.update(record['assetId'], numberOfReference=record['numberOfReference'])
+    return len(response.data) == len(set(asset_ids))
+
+def _new_asset_id():
+    asset_id = str(uuid.uuid4())
+    while asset_registry.contains(asset_id) or storage.exists(asset_id):
+        asset_id = str(uuid.uuid4())
     return asset_id
+
+def _asset_data(asset_id, content_hash, file_size, mime_type, file_name):
+    return dict({
+        "assetId": asset_id,
+        "fileSize": file_size,
+        "originalFileName": secure_filename(file_name),
+        "numberOfReference": 0,
+        "contentHash": content_hash,
+        "mimeType": mime_type
+    })
+
+def _register_asset(record, asset_path):
+    asset_registry.add(record)
+    derivative.queue_variants(record['assetId'], asset_path)
+    derivative.queue_precompressed(record['assetId'], asset_path)
+
+def reconcile_assets():
+    """
+    Rebuilds the asset registry and reports drift between the Asset table and the stored files
+
+    Return:
+        dict: drift report from asset_registry.reconcile
+    """
+    return asset_registry.reconcile()
+
+def migrate_storage_layout():
+    """
+    Moves assets stored in the legacy flat upload folder into the sharded layout
+
+    Return:
+        int: number of files moved
+    """
+    return storage.migrate_flat_layout()
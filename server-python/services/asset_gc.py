@@ -0,0 +1,187 @@
+import os
+import time
+from services import database as database_service
+from services import asset_registry
+from services import storage
+from services import upload_session
+
+# Mark-and-sweep garbage collection between the stored files, the Asset table and
+# the AssetMap table. Requests that fail halfway (file saved but Asset insert failed,
+# rows deleted but file removal lost, abandoned temp uploads) leave these out of sync.
+#
+# Mark: load every Asset and AssetMap row and every stored file.
+# Sweep, in batches of batch_size with at most max_ops_per_second deletions:
+#   (1) temp upload files older than GRACE_SECONDS and chunked upload sessions idle
+#       for upload_session.SESSION_TTL
+#   (2) stored files without an Asset row
+#   (3) Asset rows that no AssetMap row references (and their files)
+#   (4) AssetMap rows that point at a missing Asset row
+#   (5) Asset.numberOfReference values that disagree with AssetMap
+# Only files and rows older than GRACE_SECONDS are touched so that uploads in progress
+# (file stored, rows not yet inserted) are never collected. The mark only picks the
+# candidates of (3) to (5): the database functions of migrations/004 check each one
+# again when they write, so a link made while the collector runs is never lost.
+
+GRACE_SECONDS = 60 * 60
+PAGE_SIZE = 1000
+
+def _fetch_all_links():
+    db = database_service.get_db()
+    records = []
+    start = 0
+    while True:
+        response = (
+            db
+            .table("AssetMap")
+            .select("eventId, assetId")
+            .range(start, start + PAGE_SIZE - 1)
+            .execute()
+        )
+        records.extend(response.data)
+        if len(response.data) < PAGE_SIZE:
+            return records
+        start += PAGE_SIZE
+
+def _is_old(path, now):
+    try:
+        return now - os.path.getmtime(path) > GRACE_SECONDS
+    except FileNotFoundError:
+        return False
+
+def _batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+class _RateLimiter:
+    def __init__(self, ops_per_second):
+        self.interval = 1 / ops_per_second if ops_per_second else 0
+        self.next_time = time.monotonic()
+
+    def wait(self, ops=1):
+        now = time.monotonic()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time = max(now, self.next_time) + self.interval * ops
+
+def run(dry_run=False, batch_size=100, max_ops_per_second=50):
+    """
+    Runs one garbage collection pass
+
+    Args:
+        dry_run (boolean): only report what would be collected
+        batch_size (int): number of files or rows handled per database call
+        max_ops_per_second (int): upper bound on deletions per second (0 for no limit)
+
+    Return:
+        dict: report with counts per sweep step and reclaimedBytes
+    """
+    now = time.time()
+    limiter = _RateLimiter(max_ops_per_second)
+    db = database_service.get_db()
+    report = {
+        "dryRun": dry_run,
+        "tempFiles": 0,
+        "expiredUploads": 0,
+        "untrackedFiles": 0,
+        "unreferencedAssets": 0,
+        "danglingLinks": 0,
+        "referenceCountsFixed": 0,
+        "missingFiles": [],
+        "reclaimedBytes": 0
+    }
+
+    # Mark
+    assets = {record['assetId']: record for record in asset_registry.fetch_all_assets()}
+    links = _fetch_all_links()
+    files = dict(storage.iter_asset_files())
+    references = dict()
+    for link in links:
+        references[link['assetId']] = references.get(link['assetId'], 0) + 1
+
+    # (1) abandoned temp uploads
+    for path in storage.iter_temp_files():
+        if os.path.isfile(path) and _is_old(path, now):
+            report["tempFiles"] += 1
+            report["reclaimedBytes"] += os.path.getsize(path)
+            if not dry_run:
+                limiter.wait()
+                os.remove(path)
+
+    expired, freed = upload_session.expire_sessions(dry_run=dry_run)
+    report["expiredUploads"] = expired
+    report["reclaimedBytes"] += freed
+
+    # (2) files without an Asset row
+    untracked = [asset_id for asset_id, path in files.items() if asset_id not in assets and _is_old(path, now)]
+    for asset_id in untracked:
+        report["untrackedFiles"] += 1
+        if dry_run:
+            report["reclaimedBytes"] += os.path.getsize(files[asset_id])
+        else:
+            limiter.wait()
+            report["reclaimedBytes"] += storage.remove(asset_id)
+
+    # (3) Asset rows without any AssetMap row
+    unreferenced = [
+        asset_id for asset_id in assets
+        if asset_id not in references and (asset_id not in files or _is_old(files[asset_id], now))
+    ]
+    for batch in _batches(unreferenced, batch_size):
+        if dry_run:
+            report["unreferencedAssets"] += len(batch)
+            report["reclaimedBytes"] += sum(os.path.getsize(files[asset_id]) for asset_id in batch if asset_id in files)
+            continue
+        limiter.wait(len(batch))
+        response = db.rpc("gc_delete_unreferenced_assets", {
+            "p_asset_ids": batch,
+            "p_grace_seconds": GRACE_SECONDS
+        }).execute()
+        for record in response.data or []:
+            report["unreferencedAssets"] += 1
+            asset_registry.remove(record['assetId'])
+            report["reclaimedBytes"] += storage.remove(record['assetId'])
+
+    # (4) AssetMap rows pointing at a missing Asset row
+    dangling = sorted(set(link['assetId'] for link in links if link['assetId'] not in assets))
+    for batch in _batches(dangling, batch_size):
+        if dry_run:
+            report["danglingLinks"] += sum(references[asset_id] for asset_id in batch)
+            continue
+        limiter.wait(len(batch))
+        response = db.rpc("gc_delete_dangling_links", {
+            "p_asset_ids": batch,
+            "p_grace_seconds": GRACE_SECONDS
+        }).execute()
+        report["danglingLinks"] += response.data or 0
+
+    # (5) reference counts that drifted from AssetMap, and referenced assets whose file is gone
+    drifted = []
+    for asset_id, count in references.items():
+        if asset_id not in assets:
+            continue
+        if asset_id not in files:
+            report["missingFiles"].append(asset_id)
+        if assets[asset_id].get('numberOfReference') != count:
+            drifted.append(asset_id)
+    for batch in _batches(drifted, batch_size):
+        if dry_run:
+            report["referenceCountsFixed"] += len(batch)
+            continue
+        limiter.wait(len(batch))
+        response = db.rpc("gc_fix_reference_counts", {"p_asset_ids": batch}).execute()
+        for record in response.data or []:
+            report["referenceCountsFixed"] += 1
+            asset_registry.update(record['assetId'], numberOfReference=record['numberOfReference'])
+
+    print(
+        f"asset_gc.run(): {'[dry run] ' if dry_run else ''}"
+        f"{report['tempFiles']} temp files, "
+        f"{report['expiredUploads']} expired uploads, "
+        f"{report['untrackedFiles']} untracked files, "
+        f"{report['unreferencedAssets']} unreferenced assets, "
+        f"{report['danglingLinks']} dangling links, "
+        f"{report['referenceCountsFixed']} reference counts fixed, "
+        f"{len(report['missingFiles'])} referenced assets missing their file, "
+        f"{report['reclaimedBytes']} bytes reclaimed"
+    )
+    return report
@@ -0,0 +1,276 @@
+import os
+import time
+import threading
+from services import database as database_service
+from services import storage
+
+# In-memory index of the Asset table so that existence and metadata lookups do not
+# need a directory scan or a database round trip. Each process keeps its own copy,
+# so a miss falls back to the database before answering "not found", and an entry is
+# checked against the database again once it is older than ENTRY_TTL, since another
+# process (the server, the scrape worker, the garbage collector) may have deleted it.
+
+PAGE_SIZE = 1000 # rows fetched per request when loading the Asset table
+ENTRY_TTL = int(os.getenv("ASSET_REGISTRY_TTL", 5 * 60)) # seconds before an entry is checked again
+
+_lock = threading.Lock()
+_assets = dict()  # assetId -> Asset record
+_hashes = dict()  # contentHash -> assetId
+_checked = dict() # assetId -> time.monotonic() of the last time the entry was read from the database
+_loaded = False
+
+def _put(record):
+    _assets[record['assetId']] = record
+    _checked[record['assetId']] = time.monotonic()
+    if record.get('contentHash'):
+        _hashes[record['contentHash']] = record['assetId']
+
+def _cached(asset_id):
+    # The entry of the asset if it was read from the database less than ENTRY_TTL ago
+    if asset_id is None or time.monotonic() - _checked.get(asset_id, float('-inf')) > ENTRY_TTL:
+        return None
+    return _assets.get(asset_id)
+
+def fetch_all_assets():
+    """
+    Return:
+        list of dict: every record of the Asset table, fetched in pages of PAGE_SIZE
+    """
+    db = database_service.get_db()
+    records = []
+    start = 0
+    while True:
+        response = (
+            db
+            .table("Asset")
+            .select("*")
+            .range(start, start + PAGE_SIZE - 1)
+            .execute()
+        )
+        records.extend(response.data)
+        if len(response.data) < PAGE_SIZE:
+            return records
+        start += PAGE_SIZE
+
+def load():
+    """
+    (Re)builds the registry from the Asset table
+
+    Return:
+        int: number of assets loaded
+    """
+    global _loaded
+    records = fetch_all_assets()
+    with _lock:
+        _assets.clear()
+        _hashes.clear()
+        _checked.clear()
+        for record in records:
+            _put(record)
+        _loaded = True
+    return len(records)
+
+def _ensure_loaded():
+    if not _loaded:
+        load()
+
+def _fetch_one(column, value):
+    response = (
+        database_service.get_db()
+        .table("Asset")
+        .select("*")
+        .eq(column, value)
+        .limit(1)
+        .execute()
+    )
+    if response and response.data:
+        add(response.data[0])
+        return response.data[0]
+    return None
+
+def get(asset_id):
+    """
+    Args:
+        asset_id (string): asset UUID
+
+    Return:
+        dict: Asset record (None if the asset does not exist)
+    """
+    _ensure_loaded()
+    record = _cached(asset_id)
+    if record is None:
+        record = _fetch_one("assetId", asset_id)
+        if record is None:
+            remove(asset_id)
+    return record
+
+def exists(asset_id):
+    return get(asset_id) is not None
+
+def contains(asset_id):
+    # In-memory check only, for callers such as UUID collision checks that must not hit the database
+    _ensure_loaded()
+    return asset_id in _assets
+
+def get_by_hash(content_hash):
+    """
+    Args:
+        content_hash (string): sha256 hex digest of the file content
+
+    Return:
+        dict: Asset record with the same content (None if there is none)
+    """
+    _ensure_loaded()
+    record = _cached(_hashes.get(content_hash))
+    if record is not None:
+        return record
+    record = _fetch_one("contentHash", content_hash)
+    if record is None and content_hash in _hashes:
+        remove(_hashes[content_hash])
+    return record
+
+def get_by_hashes(content_hashes):
+    """
+    Looks up several content hashes at once, with at most one database call for the misses
+
+    Args:
+        content_hashes (list of string): sha256 hex digests
+
+    Return:
+        dict: content hash -> Asset record, for the hashes that are stored
+    """
+    _ensure_loaded()
+    result = dict()
+    missing = []
+    for content_hash in set(content_hashes):
+        record = _cached(_hashes.get(content_hash))
+        if record is not None:
+            result[content_hash] = record
+        else:
+            missing.append(content_hash)
+
+    if missing:
+        response = (
+            database_service.get_db()
+            .table("Asset")
+            .select("*")
+            .in_("contentHash", missing)
+            .execute()
+        )
+        for record in response.data:
+            add(record)
+            result[record['contentHash']] = record
+        for content_hash in missing:
+            if content_hash not in result and content_hash in _hashes:
+                remove(_hashes[content_hash])
+    return result
+
+def refresh(asset_ids):
+    """
+    Reads the assets from the database again with one call, dropping the entries of the
+    assets which no longer exist
+
+    Args:
+        asset_ids (list of string): asset UUIDs
+
+    Return:
+        set of string: the asset UUIDs which exist
+    """
+    asset_ids = list(set(asset_ids))
+    if len(asset_ids) == 0:
+        return set()
+    response = (
+        database_service.get_db()
+        .table("Asset")
+        .select("*")
+        .in_("assetId", asset_ids)
+        .execute()
+    )
+    for record in response.data:
+        add(record)
+    existing = set(record['assetId'] for record in response.data)
+    for asset_id in asset_ids:
+        if asset_id not in existing:
+            remove(asset_id)
+    return existing
+
+def add(record):
+    with _lock:
+        _put(record)
+
+def update(asset_id, **fields):
+    with _lock:
+        if asset_id in _assets:
+            _put({**_assets[asset_id], **fields})
+
+def remove(asset_id):
+    with _lock:
+        record = _assets.pop(asset_id, None)
+        _checked.pop(asset_id, None)
+        if record and _hashes.get(record.get('contentHash')) == asset_id:
+            del _hashes[record['contentHash']]
+
+def reconcile(backfill_hashes=True):
+    """
+    Reloads the registry and compares it against the stored files.
+    Assets stored before content hashes and MIME types were recorded get them filled in,
+    so they take part in deduplication and are served with their sniffed type.
+
+    Args:
+        backfill_hashes (boolean): compute and save missing content hashes and MIME types
+
+    Return:
+        dict: drift report with the keys missingFiles, untrackedFiles, sizeMismatch, hashesBackfilled
+        and mimeTypesBackfilled
+    """
+    # asset imports this module, so its file scanning is only imported when it is needed
+    from services import asset as asset_service
+    load()
+    files = dict(storage.iter_asset_files())
+    with _lock:
+        records = list(_assets.values())
+
+    report = {
+        "missingFiles": [],
+        "untrackedFiles": sorted(set(files.keys()) - set(_assets.keys())),
+        "sizeMismatch": [],
+        "hashesBackfilled": 0,
+        "mimeTypesBackfilled": 0
+    }
+    for record in records:
+        asset_id = record['assetId']
+        if asset_id not in files:
+            report["missingFiles"].append(asset_id)
+            continue
+
+        path = files[asset_id]
+        if record.get('fileSize') is not None and os.path.getsize(path) != record['fileSize']:
+            report["sizeMismatch"].append(asset_id)
+
+        if backfill_hashes and not (record.get('contentHash') and record.get('mimeType')):
+            # one read of the file gives both, only the missing ones are written
+            content_hash, _, mime_type = asset_service.scan_file(path)
+            fields = dict()
+            if not record.get('contentHash'):
+                fields['contentHash'] = content_hash
+                report["hashesBackfilled"] += 1
+            if not record.get('mimeType'):
+                fields['mimeType'] = mime_type
+                report["mimeTypesBackfilled"] += 1
+            (
+                database_service.get_db()
+                .table("Asset")
+                .update(fields)
+                .eq("assetId", asset_id)
+                .execute()
+            )
+            update(asset_id, **fields)
+
+    print(
+        f"asset_registry.reconcile(): {len(records)} assets, "
+        f"{len(report['missingFiles'])} missing files, "
+        f"{len(report['untrackedFiles'])} untracked files, "
+        f"{len(report['sizeMismatch'])} size mismatches, "
+        f"{report['hashesBackfilled']} hashes and {report['mimeTypesBackfilled']} MIME types backfilled"
+    )
+    return report
@@ -0,0 +1,56 @@
+import os
+from flask import request, send_file, make_response
+
+# Assets never change once stored (a new upload always gets a new UUID), so they are
+# served with year-long immutable caching and a strong ETag from the content hash.
+# Set ASSET_OFFLOAD to hand the file transfer to the front web server:
+#   nginx    -> X-Accel-Redirect to ASSET_ACCEL_PREFIX + path (an `internal` location)
+#   sendfile -> X-Sendfile with the absolute path (Apache mod_xsendfile, lighttpd)
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+FALLBACK_CACHE_CONTROL = 'no-cache' # the original served while an image variant is generated
+ASSET_OFFLOAD = os.getenv("ASSET_OFFLOAD", "").lower()
+ASSET_ACCEL_PREFIX = os.getenv("ASSET_ACCEL_PREFIX", "/protected-uploads/")
+
+def send_asset(path, relative_path, mimetype=None, etag=None, precompressed_path=None, immutable=True):
+    """
+    Builds the response for a stored asset file. Range requests are answered with 206
+    and conditional requests with 304 by send_file.
+
+    Args:
+        path (string): absolute path of the file
+        relative_path (string): path of the file relative to the upload folder, used for X-Accel-Redirect
+        mimetype (string): Content-Type of the file
+        etag (string): strong ETag, usually the content hash of the file
+        precompressed_path (string): gzip copy of the file to send when the client accepts it
+        immutable (boolean): False when the URL will serve another file later, which is then revalidated
+
+    Return:
+        flask.Response: response sending the file
+    """
+    if ASSET_OFFLOAD == 'nginx':
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = ASSET_ACCEL_PREFIX + relative_path.replace(os.sep, '/')
+        if mimetype:
+            response.headers['Content-Type'] = mimetype
+        if etag:
+            response.set_etag(etag)
+    elif (
+        precompressed_path and os.path.exists(precompressed_path) and
+        'gzip' in request.accept_encodings and 'Range' not in request.headers
+    ):
+        response = send_file(
+            precompressed_path,
+            mimetype=mimetype or 'application/octet-stream',
+            etag=f"{etag}-gzip" if etag else True,
+            conditional=True
+        )
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    else:
+        response = send_file(path, mimetype=mimetype, etag=etag or True, conditional=True)
+        if precompressed_path:
+            response.vary.add('Accept-Encoding')
+
+    response.headers['Cache-Control'] = CACHE_CONTROL if immutable else FALLBACK_CACHE_CONTROL
+    return response
@@ -0,0 +1,189 @@
+import os
+import gzip
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from services import asset_registry
+from services import storage
+
+# Resized WebP copies of uploaded images. Variants are keyed by the content hash of
+# the original so deduplicated uploads share them, and the cache is trimmed back to
+# VARIANT_CACHE_BYTES by evicting the least recently used files. Variants are rendered
+# on a background thread, and the original is served until they are ready.
+
+VARIANT_FOLDER = os.path.join(storage.UPLOAD_FOLDER, '.variants')
+VARIANT_CACHE_BYTES = int(os.getenv("VARIANT_CACHE_BYTES", 512 * 1024 * 1024))
+VARIANTS = {
+    "thumb": 320,  # longest side in pixels
+    "card": 640,
+    "full": 1600,
+}
+IMAGE_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+WEBP_QUALITY = 80
+COMPRESSIBLE_MIME_TYPES = {'text/plain', 'application/pdf'}
+MIN_COMPRESSION_GAIN = 0.1 # gzip copies saving less than this fraction are discarded
+
+os.makedirs(VARIANT_FOLDER, exist_ok=True)
+
+_lock = threading.Lock()
+_cache_size = None # bytes currently used by VARIANT_FOLDER, computed on first use
+_executor = ThreadPoolExecutor(max_workers=1)
+_pending = set() # variant paths queued for rendering
+_failed = set() # content hashes of images which could not be rendered
+
+def is_image(record):
+    return bool(record) and record.get('mimeType') in IMAGE_MIME_TYPES and bool(record.get('contentHash'))
+
+def variant_path(content_hash, variant):
+    return os.path.join(VARIANT_FOLDER, f"{content_hash}-{variant}.webp")
+
+def precompressed_path(content_hash):
+    return os.path.join(VARIANT_FOLDER, f"{content_hash}.gz")
+
+def _render(source_path, target_path, size):
+    temp_path = f"{target_path}.{threading.get_ident()}.tmp"
+    try:
+        with Image.open(source_path) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            image.save(temp_path, 'WEBP', quality=WEBP_QUALITY)
+        os.replace(temp_path, target_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.path.getsize(target_path)
+
+def _evict():
+    # Drops the least recently used variants until the cache fits the budget
+    global _cache_size
+    entries = [entry for entry in os.scandir(VARIANT_FOLDER) if entry.is_file()]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries:
+        if _cache_size <= VARIANT_CACHE_BYTES:
+            break
+        try:
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            _cache_size -= size
+        except FileNotFoundError:
+            pass
+
+def _generate(asset_id, source_path, variant, content_hash, path):
+    # Renders a variant and adds it to the cache. A corrupt, truncated or oversized
+    # (DecompressionBombError) image is logged and remembered, so it is not rendered again.
+    global _cache_size
+    try:
+        if not os.path.exists(path):
+            size = _render(source_path, path, VARIANTS[variant])
+            with _lock:
+                if _cache_size is None:
+                    _cache_size = sum(entry.stat().st_size for entry in os.scandir(VARIANT_FOLDER) if entry.is_file())
+                else:
+                    _cache_size += size
+                if _cache_size > VARIANT_CACHE_BYTES:
+                    _evict()
+    except Exception as e:
+        print(f"Unable to generate {variant} variant of asset {asset_id}: {e!r}")
+        with _lock:
+            _failed.add(content_hash)
+    finally:
+        with _lock:
+            _pending.discard(path)
+
+def _queue(asset_id, source_path, variant):
+    # Queues the render of a variant unless it is already queued or the image failed to render
+    record = asset_registry.get(asset_id)
+    path = variant_path(record['contentHash'], variant)
+    with _lock:
+        if path in _pending or record['contentHash'] in _failed:
+            return
+        _pending.add(path)
+    _executor.submit(_generate, asset_id, source_path, variant, record['contentHash'], path)
+
+def get_variant(asset_id, source_path, variant):
+    """
+    Returns the path of a resized WebP copy of an image asset. A variant which is not
+    generated yet is queued on the background thread instead of blocking the request.
+
+    Args:
+        asset_id (string): asset UUID
+        source_path (string): path of the original upload
+        variant (string): one of VARIANTS
+
+    Return:
+        string: path of the variant file (None if it is not generated yet, the asset is not an image or the variant is unknown)
+    """
+    record = asset_registry.get(asset_id)
+    if variant not in VARIANTS or not is_image(record):
+        return None
+
+    path = variant_path(record['contentHash'], variant)
+    if os.path.exists(path):
+        # mtime doubles as the last access time for LRU eviction
+        os.utime(path)
+        return path
+
+    _queue(asset_id, source_path, variant)
+    return None
+
+def queue_variants(asset_id, source_path):
+    """
+    Generates all variants of an image asset on a background thread, e.g. right after upload
+
+    Args:
+        asset_id (string): asset UUID
+        source_path (string): path of the original upload
+    """
+    if is_image(asset_registry.get(asset_id)):
+        for variant in VARIANTS:
+            _queue(asset_id, source_path, variant)
+
+def queue_precompressed(asset_id, source_path):
+    """
+    Writes a gzip copy of a compressible asset on a background thread so it can be
+    served with Content-Encoding: gzip. The copy is kept only if it is meaningfully smaller.
+
+    Args:
+        asset_id (string): asset UUID
+        source_path (string): path of the original upload
+    """
+    record = asset_registry.get(asset_id)
+    if not record or record.get('mimeType') not in COMPRESSIBLE_MIME_TYPES or not record.get('contentHash'):
+        return
+
+    def compress():
+        global _cache_size
+        path = precompressed_path(record['contentHash'])
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(source_path, 'rb') as source, gzip.open(temp_path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            size = os.path.getsize(temp_path)
+            if size > os.path.getsize(source_path) * (1 - MIN_COMPRESSION_GAIN):
+                os.remove(temp_path)
+                return
+            os.replace(temp_path, path)
+            with _lock:
+                if _cache_size is not None:
+                    _cache_size += size
+        except Exception as e:
+            print(f"Unable to precompress asset {asset_id}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    _executor.submit(compress)
+
+def get_variant_urls(asset_id, base_url):
+    """
+    Args:
+        asset_id (string): asset UUID
+        base_url (string): public URL prefix of the uploads route
+
+    Return:
+        dict: variant name -> URL (empty if the asset is not an image)
+    """
+    if not is_image(asset_registry.get(asset_id)):
+        return {}
+    return {variant: f"{base_url}{asset_id}?variant={variant}" for variant in VARIANTS}
@@ -0,0 +1,86 @@
+import os
+import time
+import hashlib
+from services import http_cache
+from services import local_state
+
+# Persistent cache of Gemini responses for the scrapers, stored in SQLite next to the
+# HTTP cache. Entries are keyed by model, system prompt and content, so the daily
+# scrape does not spend quota on descriptions and locations it has already sent.
+# The prompt text is part of the key, so editing a prompt invalidates its old
+# entries; those are no longer read and expire after TTL like any other entry.
+
+DB_PATH = os.path.join(http_cache.CACHE_FOLDER, 'gemini_cache.sqlite')
+TTL = int(os.getenv("GEMINI_CACHE_TTL", 30 * 24 * 60 * 60)) # seconds
+
+_db = local_state.Database(DB_PATH, ["""
+    create table if not exists response (
+        key text primary key,
+        model text not null,
+        prompt_hash text not null,
+        response text not null,
+        created_at real not null
+    )
+"""], wal=True)
+_stats = local_state.Stats(hits=0, misses=0)
+
+def _hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _key(model, prompt, content):
+    return _hash(f"{model}\0{_hash(prompt)}\0{_hash(content)}")
+
+def lookup(models, prompt, content):
+    """
+    Args:
+        models (list of string): Gemini model names, in order of preference
+        prompt (string): system prompt
+        content (string): request content
+
+    Return:
+        string: cached response text of the most preferred model (None if not cached or older than TTL)
+    """
+    keys = [_key(model, prompt, content) for model in models]
+    rows = dict(_db().execute(
+        f"select key, response from response where key in ({', '.join('?' * len(keys))}) and created_at > ?",
+        (*keys, time.time() - TTL)
+    ).fetchall())
+    response = next((rows[key] for key in keys if key in rows), None)
+    _stats.add(**{"hits" if response is not None else "misses": 1})
+    return response
+
+def store(model, prompt, content, response):
+    db = _db()
+    db.execute(
+        "insert or replace into response values (?, ?, ?, ?, ?)",
+        (_key(model, prompt, content), model, _hash(prompt), response, time.time())
+    )
+    db.commit()
+
+def evict(ttl=TTL):
+    """
+    Removes entries older than ttl seconds
+
+    Return:
+        int: number of entries removed
+    """
+    db = _db()
+    removed = db.execute("delete from response where created_at < ?", (time.time() - ttl,)).rowcount
+    db.commit()
+    return removed
+
+def reset_stats():
+    _stats.reset()
+
+def get_stats():
+    """
+    Return:
+        dict: number of cache hits and misses since the last reset_stats()
+    """
+    return _stats.get()
+
+def print_report():
+    stats = get_stats()
+    total = stats["hits"] + stats["misses"]
+    rate = stats["hits"] / total * 100 if total else 0
+    print(f"gemini_cache: {total} requests, {stats['hits']} cached ({rate:.0f}% hit rate), {stats['misses']} sent to Gemini")
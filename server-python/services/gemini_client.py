@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+import httpx
+from google import genai
+from google.genai import types
+from dotenv import load_dotenv
+from services import local_state
+
+# One long-lived Gemini client for the whole process. It is created on first use,
+# with the API key and settings read from the environment once, and keeps its
+# HTTP connections alive between calls. configure() points it somewhere else, e.g.
+# a local fake server (base_url) or an in-process stand-in (an httpx transport),
+# for benchmarks and tests. The latency and token counts of every call are
+# recorded per model for the run report.
+
+TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 120)) # seconds
+CONNECT_TIMEOUT = 10 # seconds
+POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", 4)) # keep-alive connections
+
+_lock = threading.Lock()
+_client = None
+_settings = {"apiKey": None, "baseUrl": None, "timeout": None, "transport": None}
+_stats = local_state.Stats(keyed=True, calls=0, errors=0, seconds=0.0, promptTokens=0, outputTokens=0) # per model
+
+def configure(api_key=None, base_url=None, timeout=None, transport=None):
+    """
+    Overrides the client settings from the environment. The client is recreated on next use.
+
+    Args:
+        api_key (string): Gemini API key (defaults to GEMINI_API_KEY)
+        base_url (string): API endpoint (defaults to GEMINI_BASE_URL, else the Google endpoint)
+        timeout (float): read timeout in seconds (defaults to GEMINI_TIMEOUT)
+        transport (httpx.BaseTransport): transport which handles the requests instead of the network
+    """
+    global _client
+    with _lock:
+        _settings.update({"apiKey": api_key, "baseUrl": base_url, "timeout": timeout, "transport": transport})
+        _client = None
+
+def get_client():
+    """
+    Return:
+        genai.Client: the shared client
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            load_dotenv()
+            timeout = _settings["timeout"] or TIMEOUT
+            http_client = httpx.Client(
+                timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+                transport=_settings["transport"],
+            )
+            _client = genai.Client(
+                api_key=_settings["apiKey"] or os.getenv('GEMINI_API_KEY'),
+                http_options=types.HttpOptions(
+                    base_url=_settings["baseUrl"] or os.getenv('GEMINI_BASE_URL'),
+                    timeout=int(timeout * 1000),
+                    httpx_client=http_client,
+                ),
+            )
+        return _client
+
+def _record(model, seconds, response):
+    usage = response.usage_metadata if response is not None else None
+    _stats.add(
+        model,
+        calls=1,
+        seconds=seconds,
+        errors=1 if response is None else 0,
+        promptTokens=(usage.prompt_token_count or 0) if usage is not None else 0,
+        outputTokens=(usage.candidates_token_count or 0) if usage is not None else 0,
+    )
+
+def generate(model, prompt, content, response_schema=None):
+    """
+    Args:
+        model (string): Gemini model name
+        prompt (string): system prompt
+        content (string): request content
+        response_schema (dict): JSON schema of the response (plain text if None)
+
+    Return:
+        types.GenerateContentResponse: the response
+
+    Raises:
+        genai.errors.APIError: the request failed
+    """
+    client = get_client()
+    start = time.perf_counter()
+    response = None
+    try:
+        response = client.models.generate_content(
+            model=model,
+            contents=content,
+            config=types.GenerateContentConfig(
+                system_instruction=[prompt],
+                response_mime_type='application/json' if response_schema else None,
+                response_schema=response_schema,
+            ),
+        )
+        return response
+    finally:
+        _record(model, time.perf_counter() - start, response)
+
+def reset_stats():
+    _stats.reset()
+
+def get_stats():
+    """
+    Return:
+        dict: model -> call count, error count, total seconds and token counts since the last reset_stats()
+    """
+    return _stats.get()
+
+def print_report():
+    for model, stats in get_stats().items():
+        average = stats["seconds"] / stats["calls"] if stats["calls"] else 0
+        print(
+            f"gemini_client: {model}: {stats['calls']} calls, {stats['errors']} errors, "
+            f"{average:.2f}s average, {stats['promptTokens']} prompt tokens, {stats['outputTokens']} output tokens"
+        )
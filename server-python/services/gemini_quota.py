@@ -0,0 +1,211 @@
+import os
+import re
+import time
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from services import http_cache
+from services import local_state
+
+# Quota scheduler for Gemini calls. Every model has a requests-per-minute budget
+# (token bucket) and a requests-per-day budget. acquire() hands out the most
+# preferred model that has budget left, and only waits when every model is out of
+# per-minute budget, for as long as it takes the first bucket to refill. A 429
+# blocks its model for the retry delay the server asked for, or for the rest of
+# the day if the daily quota is used up. A model which no longer exists (404) is
+# skipped for MODEL_GONE_DELAY and one whose server fails (5xx) for SERVER_ERROR_DELAY,
+# so the requests move on to the next model. Daily usage is persisted in SQLite, so a
+# restarted process does not spend quota it no longer has. Daily quotas reset at
+# midnight Pacific time.
+
+DB_PATH = os.path.join(http_cache.CACHE_FOLDER, 'gemini_quota.sqlite')
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+DEFAULT_RETRY_DELAY = 30 # seconds, when a 429 carries no retry delay
+MODEL_GONE_DELAY = 60 * 60 # seconds a model answering 404 (retired or renamed) is skipped
+SERVER_ERROR_DELAY = 60 # seconds a model answering 5xx is skipped
+
+# name:requests per minute:requests per day, in order of preference
+MODELS = os.getenv("GEMINI_MODELS", ",".join((
+    'gemini-2.0-flash:15:200', # Ideal
+    'gemini-2.5-flash:10:250', # Slow output due to thinking
+    'gemini-2.5-flash-lite-preview-06-17:15:1000', # Low request limit
+    'gemini-2.0-flash-lite:30:200', # Still works I guess
+)))
+
+class QuotaExhaustedError(Exception):
+    # Raised when every model has used up its daily quota or no longer exists
+    pass
+
+class ModelQuota:
+    def __init__(self, name, rpm, rpd):
+        self.name = name
+        self.rpm = rpm
+        self.rpd = rpd
+        self.tokens = rpm
+        self.updated = time.monotonic()
+        self.used_today = 0
+        self.blocked_until = 0 # time.monotonic() until which the server rejects requests
+        self.gone_until = 0 # time.monotonic() until which the model is skipped as not existing
+
+    def refill(self, now):
+        self.tokens = min(self.rpm, self.tokens + (now - self.updated) * self.rpm / 60)
+        self.updated = now
+
+    def available(self, now):
+        return self.used_today < self.rpd and self.gone_until <= now
+
+    def wait_time(self, now):
+        # Seconds until this model can take a request (None if it is out of daily quota or does not exist)
+        if not self.available(now):
+            return None
+        return max(self.blocked_until - now, (1 - self.tokens) * 60 / self.rpm, 0)
+
+_lock = threading.Lock()
+_models = None
+_day = None
+_db = local_state.Database(DB_PATH, ["""
+    create table if not exists usage (
+        day text not null,
+        model text not null,
+        requests integer not null,
+        primary key (day, model)
+    )
+"""])
+
+def _today():
+    return datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+def _load():
+    # Called with _lock held: sets up the models, and reloads the daily usage when the day changes
+    global _models, _day
+    if _models is None:
+        _models = []
+        for entry in MODELS.split(','):
+            name, rpm, rpd = entry.strip().split(':')
+            _models.append(ModelQuota(name, int(rpm), int(rpd)))
+    today = _today()
+    if _day != today:
+        usage = dict(_db().execute("select model, requests from usage where day = ?", (today,)).fetchall())
+        for model in _models:
+            model.used_today = usage.get(model.name, 0)
+        _day = today
+    return _models
+
+def _save(model):
+    db = _db()
+    db.execute(
+        "insert or replace into usage values (?, ?, ?)",
+        (_day, model.name, model.used_today)
+    )
+    db.commit()
+
+def model_names():
+    """
+    Return:
+        list of string: model names in order of preference
+    """
+    with _lock:
+        return [model.name for model in _load()]
+
+def acquire():
+    """
+    Takes one request from the budget of the most preferred model that has budget left,
+    waiting only if every model is out of per-minute budget
+
+    Return:
+        string: name of the model to send the request to
+
+    Raises:
+        QuotaExhaustedError: every model has used up its daily quota or does not exist
+    """
+    while True:
+        with _lock:
+            now = time.monotonic()
+            waits = []
+            for model in _load():
+                model.refill(now)
+                wait = model.wait_time(now)
+                if wait is None:
+                    continue
+                if wait == 0:
+                    model.tokens -= 1
+                    model.used_today += 1
+                    _save(model)
+                    return model.name
+                waits.append(wait)
+            if len(waits) == 0:
+                raise QuotaExhaustedError("All Gemini models have used up their daily quota or do not exist.")
+            wait = min(waits)
+        time.sleep(wait)
+
+def exhausted():
+    """
+    Return:
+        boolean: True if every model has used up its daily quota or does not exist
+    """
+    with _lock:
+        now = time.monotonic()
+        return not any(model.available(now) for model in _load())
+
+def rate_limited(model_name, error):
+    """
+    Records a 429 from the server for a model
+
+    Args:
+        model_name (string): model that rejected the request
+        error (Exception): the error, whose message carries the quota that was hit and the retry delay
+
+    Return:
+        float: seconds the model is blocked for
+    """
+    message = str(error)
+    retry_delay = re.search(r"retryDelay['\"]?:\s*['\"](\d+(?:\.\d+)?)s", message)
+    retry_delay = float(retry_delay.group(1)) if retry_delay else DEFAULT_RETRY_DELAY
+    with _lock:
+        for model in _load():
+            if model.name != model_name:
+                continue
+            if "PerDay" in message:
+                # Daily quota used up (possibly by another process): skip the model until tomorrow
+                model.used_today = model.rpd
+                _save(model)
+            else:
+                model.blocked_until = time.monotonic() + retry_delay
+                model.tokens = 0
+    return retry_delay
+
+def unavailable(model_name, error):
+    """
+    Records an error of a model other than a 429, so that the next requests go to another model
+
+    Args:
+        model_name (string): model that failed
+        error (Exception): the error, a 404 when the model does not exist, else a server error or timeout
+
+    Return:
+        float: seconds the model is skipped for
+    """
+    gone = getattr(error, 'code', None) == 404
+    delay = MODEL_GONE_DELAY if gone else SERVER_ERROR_DELAY
+    with _lock:
+        for model in _load():
+            if model.name != model_name:
+                continue
+            if gone:
+                model.gone_until = time.monotonic() + delay
+            else:
+                model.blocked_until = time.monotonic() + delay
+                model.tokens = 0
+    return delay
+
+def get_usage():
+    """
+    Return:
+        dict: model name -> requests made today and daily quota
+    """
+    with _lock:
+        return {model.name: {"requests": model.used_today, "quota": model.rpd} for model in _load()}
+
+def print_report():
+    for name, usage in get_usage().items():
+        print(f"gemini_quota: {name}: {usage['requests']}/{usage['quota']} requests today")
@@ -0,0 +1,142 @@
+import os
+import time
+import zlib
+import hashlib
+from services import local_state
+
+# Persistent HTTP response cache for the scrapers, stored in SQLite. For every URL it
+# keeps the (compressed) body, ETag, Last-Modified and a content hash. scrape_http
+# sends If-None-Match/If-Modified-Since from the cache and rebuilds the response from
+# the stored body on 304, and every response says whether its content changed since
+# the last run. Entries unused for MAX_AGE or beyond MAX_ENTRIES are evicted, least
+# recently used first.
+
+CACHE_FOLDER = os.getenv("SCRAPE_CACHE_FOLDER", './cache')
+DB_PATH = os.path.join(CACHE_FOLDER, 'http_cache.sqlite')
+MAX_ENTRIES = int(os.getenv("HTTP_CACHE_MAX_ENTRIES", 5000))
+MAX_AGE = 30 * 24 * 60 * 60 # seconds
+
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+
+_db = local_state.Database(DB_PATH, ["""
+    create table if not exists response (
+        url text primary key,
+        etag text,
+        last_modified text,
+        content_type text,
+        content_hash text not null,
+        body blob not null,
+        fetched_at real not null,
+        accessed_at real not null
+    )
+"""], wal=True)
+_stats = local_state.Stats(revalidated=0, unchanged=0, changed=0, new=0)
+
+def _count(key):
+    _stats.add(**{key: 1})
+
+def lookup(url):
+    """
+    Return:
+        dict: cached entry with etag, lastModified, contentType, contentHash and body (None if not cached)
+    """
+    row = _db().execute(
+        "select etag, last_modified, content_type, content_hash, body from response where url = ?", (url,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {
+        "etag": row[0],
+        "lastModified": row[1],
+        "contentType": row[2],
+        "contentHash": row[3],
+        "body": zlib.decompress(row[4])
+    }
+
+def conditional_headers(entry):
+    headers = dict()
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('lastModified'):
+        headers['If-Modified-Since'] = entry['lastModified']
+    return headers
+
+def revalidated(url):
+    # Called on 304: the cached body is still current
+    _count("revalidated")
+    db = _db()
+    db.execute("update response set accessed_at = ? where url = ?", (time.time(), url))
+    db.commit()
+
+def store(url, response, previous=None):
+    """
+    Saves a 200 response
+
+    Args:
+        url (string): requested URL
+        response (requests.Response): the response
+        previous (dict): entry from lookup() before the request
+
+    Return:
+        tuple (string, boolean): content hash of the body and whether it differs from the previous entry
+    """
+    body = response.content
+    content_hash = hashlib.sha256(body).hexdigest()
+    changed = previous is None or previous['contentHash'] != content_hash
+    if previous is None:
+        _count("new")
+    else:
+        _count("changed" if changed else "unchanged")
+
+    now = time.time()
+    db = _db()
+    db.execute(
+        "insert or replace into response values (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            url,
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified'),
+            response.headers.get('Content-Type'),
+            content_hash,
+            zlib.compress(body),
+            now,
+            now
+        )
+    )
+    db.commit()
+    return content_hash, changed
+
+def evict(max_entries=MAX_ENTRIES, max_age=MAX_AGE):
+    """
+    Removes entries unused for max_age seconds, then the least recently used ones beyond max_entries
+
+    Return:
+        int: number of entries removed
+    """
+    db = _db()
+    removed = db.execute("delete from response where accessed_at < ?", (time.time() - max_age,)).rowcount
+    removed += db.execute(
+        "delete from response where url in (select url from response order by accessed_at desc limit -1 offset ?)",
+        (max_entries,)
+    ).rowcount
+    db.commit()
+    return removed
+
+def reset_stats():
+    _stats.reset()
+
+def get_stats():
+    """
+    Return:
+        dict: number of revalidated (304), unchanged, changed and new pages since the last reset_stats()
+    """
+    return _stats.get()
+
+def print_report():
+    stats = get_stats()
+    total = sum(stats.values())
+    hits = stats["revalidated"] + stats["unchanged"]
+    print(
+        f"http_cache: {total} pages, {hits} unchanged ({stats['revalidated']} revalidated with 304), "
+        f"{stats['changed']} changed, {stats['new']} new"
+    )
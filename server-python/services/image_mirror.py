@@ -0,0 +1,195 @@
+import os
+import json
+import threading
+from collections import Counter
+from urllib.parse import urlparse
+from services import asset as asset_service
+from services import asset_registry
+from services import storage
+from services import scrape_http
+
+# Mirrors the images of scraped events into our own asset storage so clients do not
+# hot-link third party CDNs. Each remote URL is downloaded once; later runs send
+# If-None-Match/If-Modified-Since and reuse the stored asset on 304. Downloads go
+# through scrape_http, with the same per-host limits and retries as the pages, and
+# through the normal dedup path, so the same picture used by several events is
+# stored once.
+
+INDEX_PATH = os.path.join(storage.UPLOAD_FOLDER, '.mirror.json')
+TIMEOUT = 30 # seconds
+MAX_IMAGE_SIZE = 20 * 1024 * 1024
+IMAGE_MIME_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+_lock = threading.Lock()
+_index = None # remote URL -> {"assetId", "etag", "lastModified"}
+_asset_ids = Counter() # asset UUID -> number of remote URLs mirrored into it
+
+class _LimitedReader:
+    # Reads at most limit bytes of a stream, so an oversized body is never downloaded in full
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.remaining = limit
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        chunk = self.stream.read(self.remaining if size < 0 else min(size, self.remaining))
+        self.remaining -= len(chunk)
+        return chunk
+
+def _load_index():
+    global _index
+    if _index is None:
+        try:
+            with open(INDEX_PATH, encoding='utf-8') as f:
+                _index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _index = dict()
+        _asset_ids.update(entry['assetId'] for entry in _index.values())
+    return _index
+
+def _set_entry(url, entry):
+    index = _load_index()
+    if url in index:
+        _asset_ids[index[url]['assetId']] -= 1
+    index[url] = entry
+    _asset_ids[entry['assetId']] += 1
+
+def _forget(url):
+    index = _load_index()
+    if url in index:
+        _asset_ids[index.pop(url)['assetId']] -= 1
+
+def _save_index():
+    temp_path = f"{INDEX_PATH}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(_index, f)
+    os.replace(temp_path, INDEX_PATH)
+
+def mirror_image(url):
+    """
+    Downloads a remote image into asset storage, revalidating a previous download if there is one.
+    At most MAX_IMAGE_SIZE + 1 bytes are read, whatever size the server announces.
+
+    Args:
+        url (string): remote image URL
+
+    Return:
+        string: asset UUID of the mirrored image (empty string if it could not be mirrored)
+    """
+    with _lock:
+        entry = dict(_load_index().get(url, {}))
+
+    headers = dict()
+    if entry and asset_registry.exists(entry['assetId']):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('lastModified'):
+            headers['If-Modified-Since'] = entry['lastModified']
+    else:
+        entry = dict()
+
+    response = scrape_http.fetch(url, headers=headers, timeout=TIMEOUT, stream=True)
+    if response is None:
+        print(f"image_mirror.mirror_image(): Unable to download {url}")
+        return ""
+    with response:
+        if response.status_code == 304 and entry:
+            return entry['assetId']
+        if response.status_code != 200:
+            print(f"image_mirror.mirror_image(): {url} returned {response.status_code}")
+            return ""
+        if int(response.headers.get('Content-Length') or 0) > MAX_IMAGE_SIZE:
+            print(f"image_mirror.mirror_image(): {url} is larger than {MAX_IMAGE_SIZE} bytes")
+            return ""
+        response.raw.decode_content = True
+        temp_path, content_hash, file_size, mime_type = asset_service.write_upload(_LimitedReader(response.raw, MAX_IMAGE_SIZE + 1))
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    if file_size > MAX_IMAGE_SIZE:
+        os.remove(temp_path)
+        print(f"image_mirror.mirror_image(): {url} is larger than {MAX_IMAGE_SIZE} bytes")
+        return ""
+    if mime_type not in IMAGE_MIME_TYPES:
+        os.remove(temp_path)
+        print(f"image_mirror.mirror_image(): {url} is not a supported image ({mime_type})")
+        return ""
+
+    file_name = os.path.basename(urlparse(url).path) or 'image'
+    asset_id = asset_service.ingest_file(temp_path, content_hash, file_size, mime_type, file_name)
+    if asset_id == "":
+        return ""
+
+    with _lock:
+        _set_entry(url, {"assetId": asset_id, "etag": etag, "lastModified": last_modified})
+        _save_index()
+    return asset_id
+
+def is_mirrored(asset_id):
+    """
+    Return:
+        boolean: True if the asset was stored by mirroring a remote image
+    """
+    with _lock:
+        _load_index()
+        return _asset_ids[asset_id] > 0
+
+def mirror_events(events):
+    """
+    Replaces the remote image URL of each event with the URL of its mirrored copy.
+    Events whose image cannot be mirrored keep the remote URL.
+
+    Args:
+        events (list of dict): scraped events
+
+    Return:
+        list of dict: the same events
+    """
+    if not asset_service.SERVER_ASSET_PATH:
+        print("image_mirror.mirror_events(): SERVER_ASSET_PATH is not set, skipping.")
+        return events
+
+    mirrored = dict() # remote URL -> asset UUID
+    for event in events:
+        image = event.get('image')
+        if not image or not image.startswith(('http://', 'https://')) or asset_service.parse_asset_url(image):
+            continue
+        asset_id = _mirror_event(event, image)
+        if asset_id:
+            mirrored[image] = asset_id
+
+    # The registry of this process may still have assets which the server deleted since
+    # (the last event using them was removed): those are checked once for the whole batch,
+    # and their images downloaded again before the events are written with their URL.
+    existing = asset_registry.refresh(mirrored.values())
+    gone = set(image for image, asset_id in mirrored.items() if asset_id not in existing)
+    if gone:
+        with _lock:
+            for image in gone:
+                _forget(image)
+            _save_index()
+        for event in events:
+            image = event.get('_remoteImage')
+            if image in gone:
+                event['image'] = image
+                _mirror_event(event, image)
+    count = 0
+    for event in events:
+        if event.pop('_remoteImage', None) and asset_service.parse_asset_url(event['image']):
+            count += 1
+    print(f"image_mirror.mirror_events(): Mirrored {count}/{len(events)} event images.")
+    return events
+
+def _mirror_event(event, image):
+    # Points the event at the mirrored copy of its remote image
+    try:
+        asset_id = mirror_image(image)
+    except Exception as e:
+        # e.g. the connection dropped while the body was read
+        print(f"image_mirror.mirror_events(): Unable to download {image}: {e!r}")
+        return ""
+    if asset_id:
+        event['_remoteImage'] = image
+        event['image'] = asset_service.get_asset_url(asset_id)
+    return asset_id
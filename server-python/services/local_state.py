@@ -0,0 +1,105 @@
+import sqlite3
+import threading
+
+# State which the scrape services keep on their own side, outside of Supabase:
+#   (1) Database: a SQLite file of the cache folder (see http_cache.CACHE_FOLDER), with
+#       one connection per thread since sqlite connections cannot be shared between threads
+#   (2) Stats: the counters of a service for its run report, either one set of counters
+#       or one per key (host, model, source...), safe to update from several threads
+
+class Database:
+    """
+    A SQLite file whose connection is opened by each thread on first use, with the tables
+    of the schema created if they do not exist yet
+
+    Args:
+        path (string): SQLite file
+        schema (list of string): create table statements
+        wal (boolean): use write-ahead logging, so readers do not wait for a writer
+        autocommit (boolean): leave transactions to the caller (begin/commit) instead of
+            the implicit ones of the sqlite3 module
+        row_factory (function): row factory of the connections, e.g. sqlite3.Row
+    """
+    def __init__(self, path, schema, wal=False, autocommit=False, row_factory=None):
+        self.path = path
+        self.schema = schema
+        self.wal = wal
+        self.autocommit = autocommit
+        self.row_factory = row_factory
+        self._local = threading.local()
+
+    def __call__(self):
+        """
+        Return:
+            sqlite3.Connection: the connection of the calling thread
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            if self.autocommit:
+                db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            else:
+                db = sqlite3.connect(self.path, timeout=30)
+            if self.row_factory is not None:
+                db.row_factory = self.row_factory
+            if self.wal:
+                db.execute("pragma journal_mode=wal")
+            for statement in self.schema:
+                db.execute(statement)
+            if not self.autocommit:
+                db.commit()
+            self._local.db = db
+        return db
+
+class Stats:
+    """
+    Counters for a run report, reset at the start of every run
+
+    Args:
+        keyed (boolean): keep one set of counters per key, created on first use
+        **counters: name and initial value of each counter (0 or 0.0, or e.g. a status)
+    """
+    def __init__(self, keyed=False, **counters):
+        self.keyed = keyed
+        self.counters = counters
+        self.lock = threading.Lock()
+        self._stats = dict() if keyed else dict(counters)
+
+    def _group(self, key):
+        # Called with the lock held
+        if not self.keyed:
+            return self._stats
+        return self._stats.setdefault(key, dict(self.counters))
+
+    def group(self, key):
+        """
+        Return:
+            dict: the live counters of the key, to be updated with the lock held
+        """
+        with self.lock:
+            return self._group(key)
+
+    def add(self, key=None, **counts):
+        # Adds the counts to the counters (of the key when keyed)
+        with self.lock:
+            stats = self._group(key)
+            for name, count in counts.items():
+                stats[name] += count
+
+    def set(self, key=None, **values):
+        # Sets the counters (of the key when keyed) to the values
+        with self.lock:
+            self._group(key).update(values)
+
+    def reset(self):
+        with self.lock:
+            self._stats = dict() if self.keyed else dict(self.counters)
+
+    def get(self):
+        """
+        Return:
+            dict: copy of the counters, or key -> copy of its counters when keyed
+        """
+        with self.lock:
+            if not self.keyed:
+                return dict(self._stats)
+            return {key: dict(stats) for key, stats in self._stats.items()}
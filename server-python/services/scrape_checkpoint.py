@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+from services import http_cache
+from services import local_state
+
+# Checkpoint of the scrape that is running, so that a run which is interrupted (crash,
+# restart or deploy) resumes where it stopped instead of starting over. Events are
+# marked done once they have been written to the database or rejected, one transaction
+# per micro-batch. start() resumes the last run if it did not finish (and is not older
+# than RESUME_MAX_AGE), and the events that run already did are skipped, even on a full
+# refresh. finish() closes the run.
+
+DB_PATH = os.path.join(http_cache.CACHE_FOLDER, 'scrape_checkpoint.sqlite')
+RESUME_MAX_AGE = int(os.getenv("SCRAPE_RESUME_MAX_AGE", 24 * 60 * 60)) # seconds
+
+_lock = threading.Lock()
+_run = {"id": None, "done": set()}
+_db = local_state.Database(DB_PATH, [
+    """
+    create table if not exists run (
+        id integer primary key autoincrement,
+        full_refresh integer not null,
+        started_at real not null,
+        finished_at real
+    )
+    """,
+    """
+    create table if not exists done (
+        run_id integer not null,
+        link text not null,
+        primary key (run_id, link)
+    )
+    """,
+])
+_stats = local_state.Stats(skipped=0, marked=0)
+
+def start(full_refresh=False):
+    """
+    Starts a run, or resumes the last one if it did not finish
+
+    Args:
+        full_refresh (boolean): whether a new run processes unchanged events too
+
+    Return:
+        dict: id, fullRefresh (of the resumed run if resuming), resumed and done (number of events already done)
+    """
+    db = _db()
+    row = db.execute("select id, full_refresh, started_at from run where finished_at is null order by id desc limit 1").fetchone()
+    if row is not None and time.time() - row[2] < RESUME_MAX_AGE:
+        run_id, full_refresh, resumed = row[0], bool(row[1]), True
+    else:
+        # Unfinished runs too old to resume are closed
+        db.execute("update run set finished_at = ? where finished_at is null", (time.time(),))
+        run_id = db.execute("insert into run (full_refresh, started_at) values (?, ?)", (int(full_refresh), time.time())).lastrowid
+        resumed = False
+    db.execute("delete from done where run_id in (select id from run where finished_at is not null)")
+    db.commit()
+    done = {link for (link,) in db.execute("select link from done where run_id = ?", (run_id,))}
+    with _lock:
+        _run["id"] = run_id
+        _run["done"] = done
+    return {"id": run_id, "fullRefresh": full_refresh, "resumed": resumed, "done": len(done)}
+
+def is_done(link):
+    """
+    Return:
+        boolean: True if the event was already done by the run being resumed
+    """
+    with _lock:
+        done = link in _run["done"]
+    if done:
+        _stats.add(skipped=1)
+    return done
+
+def mark_done(links):
+    # Records a micro-batch of events as done in the current run, in one transaction
+    # Does nothing when no run was started (e.g. when the scraped data is only returned)
+    with _lock:
+        run_id = _run["id"]
+        if run_id is None:
+            return
+        links = [link for link in links if link and link not in _run["done"]]
+        if len(links) == 0:
+            return
+        _run["done"].update(links)
+    _stats.add(marked=len(links))
+    db = _db()
+    db.executemany("insert or ignore into done values (?, ?)", [(run_id, link) for link in links])
+    db.commit()
+
+def finish():
+    # Closes the current run, so the next one starts over
+    with _lock:
+        run_id = _run["id"]
+        _run["id"] = None
+        _run["done"] = set()
+    if run_id is None:
+        return
+    db = _db()
+    db.execute("update run set finished_at = ? where id = ?", (time.time(), run_id))
+    db.execute("delete from done where run_id = ?", (run_id,))
+    db.commit()
+
+def reset_stats():
+    _stats.reset()
+
+def get_stats():
+    return _stats.get()
+
+def print_report():
+    stats = get_stats()
+    print(
+        f"scrape_checkpoint: {stats['marked']} events checkpointed, "
+        f"{stats['skipped']} skipped as already done by the resumed run"
+    )
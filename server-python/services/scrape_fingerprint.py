@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from services import http_cache
+from services import local_state
+
+# Fingerprints of scraped events, keyed by the event detail page URL, so that a daily
+# scrape only does work for events that changed:
+#   (1) listing card unchanged and detail page checked within DETAIL_RECHECK -> skipped before any fetch
+#   (2) listing card and detail page unchanged -> skipped before parsing, LLM calls and DB writes
+# A fingerprint is staged while an event is processed and only committed once the event
+# has been written to the database (or rejected by classification), so events from a
+# failed run are processed again next time.
+
+DB_PATH = os.path.join(http_cache.CACHE_FOLDER, 'scrape_fingerprint.sqlite')
+DETAIL_RECHECK = int(os.getenv("SCRAPE_DETAIL_RECHECK", 7 * 24 * 60 * 60)) # seconds
+
+_staged = dict() # link -> (listing hash, detail hash)
+_lock = threading.Lock()
+_db = local_state.Database(DB_PATH, ["""
+    create table if not exists fingerprint (
+        link text primary key,
+        listing_hash text not null,
+        detail_hash text,
+        checked_at real not null
+    )
+"""])
+_stats = local_state.Stats(skippedBeforeFetch=0, skippedAfterFetch=0, processed=0)
+
+def _get(link):
+    return _db().execute(
+        "select listing_hash, detail_hash, checked_at from fingerprint where link = ?", (link,)
+    ).fetchone()
+
+def listing_hash(card):
+    """
+    Args:
+        card (dict): event fields scraped from the listing page
+
+    Return:
+        string: sha256 of the card
+    """
+    return hashlib.sha256(json.dumps(card, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+def is_fresh(link, card_hash):
+    """
+    Return:
+        boolean: True if the listing card is unchanged and the detail page was checked within DETAIL_RECHECK
+    """
+    row = _get(link)
+    fresh = row is not None and row[0] == card_hash and time.time() - row[2] < DETAIL_RECHECK
+    if fresh:
+        _stats.add(skippedBeforeFetch=1)
+    return fresh
+
+def is_unchanged(link, card_hash, detail_hash):
+    """
+    Return:
+        boolean: True if both the listing card and the detail page are the same as when the event was last stored
+    """
+    row = _get(link)
+    unchanged = row is not None and detail_hash is not None and row[0] == card_hash and row[1] == detail_hash
+    if unchanged:
+        db = _db()
+        db.execute("update fingerprint set checked_at = ? where link = ?", (time.time(), link))
+        db.commit()
+        _stats.add(skippedAfterFetch=1)
+    return unchanged
+
+def stage(link, card_hash, detail_hash):
+    # Remembers the fingerprint of an event that is being processed
+    with _lock:
+        _staged[link] = (card_hash, detail_hash)
+
+def commit(link):
+    # Stores the staged fingerprint once the event has been handled
+    with _lock:
+        fingerprint = _staged.pop(link, None)
+        if fingerprint is None:
+            return
+    _stats.add(processed=1)
+    db = _db()
+    db.execute(
+        "insert or replace into fingerprint values (?, ?, ?, ?)",
+        (link, fingerprint[0], fingerprint[1], time.time())
+    )
+    db.commit()
+
+def reset_stats():
+    with _lock:
+        _staged.clear()
+    _stats.reset()
+
+def get_stats():
+    return _stats.get()
+
+def print_report():
+    stats = get_stats()
+    print(
+        f"scrape_fingerprint: {stats['processed']} events processed, "
+        f"{stats['skippedBeforeFetch']} skipped before fetching, "
+        f"{stats['skippedAfterFetch']} skipped as unchanged after fetching"
+    )
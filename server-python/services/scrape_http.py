@@ -0,0 +1,226 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from services import http_cache
+from services import local_state
+
+try:
+    import brotli # noqa: F401 (lets urllib3 decode br responses)
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+# HTTP client for the scrapers. Every host gets one pooled keep-alive session with
+# the default headers, so DNS and TLS handshakes happen once per connection instead
+# of once per request. Detail pages are fetched concurrently, but each host gets at
+# most HOST_CONCURRENCY requests in flight and HOST_RATE requests per second (token
+# bucket, bursts of HOST_BURST) so the source sites are not hammered. The time and
+# size of every request are recorded per host for the run report. Responses are kept
+# in http_cache and revalidated with conditional requests; every 200 response carries
+# content_hash and unchanged (True when the body is the same as on the last fetch).
+
+HOST_CONCURRENCY = int(os.getenv("SCRAPE_HOST_CONCURRENCY", 4))
+HOST_RATE = float(os.getenv("SCRAPE_HOST_RATE", 2)) # requests per second per host
+HOST_BURST = int(os.getenv("SCRAPE_HOST_BURST", 4))
+TIMEOUT = (10, 30) # connect and read timeout in seconds
+RETRIES = 3
+RETRY_DELAY = 10 # seconds
+POOL_SIZE = int(os.getenv("SCRAPE_POOL_SIZE", HOST_CONCURRENCY)) # keep-alive connections per host
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept-Encoding': ACCEPT_ENCODING,
+}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a token is available
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_hosts = dict() # host -> (semaphore, token bucket)
+_hosts_lock = threading.Lock()
+_sessions = dict() # host -> requests.Session
+_adapter = None # see configure()
+_stats = local_state.Stats(keyed=True, requests=0, errors=0, seconds=0.0, bytes=0) # per host
+
+def configure(adapter=None):
+    """
+    Sends the requests of every session through adapter instead of the network, e.g. to
+    record or replay responses for benchmarks. The sessions are recreated on next use.
+
+    Args:
+        adapter (requests.adapters.BaseAdapter): adapter for http and https (None for the pooled HTTPAdapter)
+    """
+    global _adapter
+    with _hosts_lock:
+        _adapter = adapter
+        _sessions.clear()
+
+def get_session(url):
+    """
+    Args:
+        url (string): any URL on the host
+
+    Return:
+        requests.Session: the pooled session of the host of url
+    """
+    host = urlparse(url).netloc
+    with _hosts_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = _adapter or HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(DEFAULT_HEADERS)
+            _sessions[host] = session
+        return _sessions[host]
+
+def _record(url, seconds, response, stream=False):
+    host = urlparse(url).netloc
+    if response is None or response.status_code >= 400:
+        _stats.add(host, requests=1, seconds=seconds, errors=1)
+    elif stream:
+        # The body is read later by the caller, only its announced size is known
+        _stats.add(host, requests=1, seconds=seconds, bytes=int(response.headers.get('Content-Length') or 0))
+    else:
+        _stats.add(host, requests=1, seconds=seconds, bytes=len(response.content))
+
+def reset_stats():
+    _stats.reset()
+
+def get_stats():
+    """
+    Return:
+        dict: host -> request count, error count, total seconds and bytes since the last reset_stats()
+    """
+    return _stats.get()
+
+def print_report():
+    for host, stats in get_stats().items():
+        average = stats["seconds"] / stats["requests"] if stats["requests"] else 0
+        print(
+            f"scrape_http: {host}: {stats['requests']} requests, {stats['errors']} errors, "
+            f"{average:.2f}s average, {stats['bytes'] / 1024:.0f} KiB"
+        )
+
+def _host_limits(host):
+    with _hosts_lock:
+        if host not in _hosts:
+            _hosts[host] = (threading.Semaphore(HOST_CONCURRENCY), TokenBucket(HOST_RATE, HOST_BURST))
+        return _hosts[host]
+
+def _should_retry(response):
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+def _from_cache(response, entry):
+    # Rebuilds a 200 response from the cached body after a 304
+    cached = requests.Response()
+    cached.url = response.url
+    cached.status_code = 200
+    cached.headers = response.headers
+    if entry.get('contentType'):
+        cached.headers['Content-Type'] = entry['contentType']
+    cached.encoding = requests.utils.get_encoding_from_headers(cached.headers)
+    cached.request = response.request
+    cached.elapsed = response.elapsed
+    cached._content = entry['body']
+    return cached
+
+def fetch(url, headers=None, timeout=TIMEOUT, retries=RETRIES, use_cache=True, stream=False):
+    """
+    GETs a URL with the pooled session of its host within the per-host limits, retrying
+    connection errors, 429 and 5xx responses
+
+    Args:
+        url (string): URL to fetch
+        headers (dict): request headers in addition to DEFAULT_HEADERS
+        timeout (tuple): connect and read timeout in seconds
+        retries (int): number of attempts
+        use_cache (boolean): revalidate against and update the HTTP cache
+        stream (boolean): return before the body is read, e.g. for large downloads. The response
+            is not cached, and the caller has to close it.
+
+    Return:
+        requests.Response: the last response (None if no response was received)
+    """
+    if not url:
+        return None
+    use_cache = use_cache and not stream
+    entry = http_cache.lookup(url) if use_cache else None
+    headers = {**(headers or {}), **http_cache.conditional_headers(entry)}
+    session = get_session(url)
+    semaphore, bucket = _host_limits(urlparse(url).netloc)
+    response = None
+    for attempt in range(retries):
+        with semaphore:
+            bucket.acquire()
+            start = time.perf_counter()
+            try:
+                response = session.get(url, headers=headers, timeout=timeout, stream=stream)
+            except requests.RequestException as e:
+                print(f"scrape_http.fetch(): {url} failed: {e}")
+                response = None
+            _record(url, time.perf_counter() - start, response, stream)
+        if not _should_retry(response):
+            break
+        if response is not None and stream:
+            response.close()
+        if attempt + 1 < retries:
+            time.sleep(RETRY_DELAY)
+
+    if stream:
+        return response
+    if response is not None and response.status_code == 304 and entry is not None:
+        http_cache.revalidated(url)
+        response = _from_cache(response, entry)
+        response.content_hash = entry['contentHash']
+        response.unchanged = True
+    elif response is not None and response.status_code == 200:
+        response.content_hash, changed = http_cache.store(url, response, entry) if use_cache else (None, True)
+        response.unchanged = not changed
+    return response
+
+def fetch_all(urls, headers=None, max_workers=None):
+    """
+    Fetches URLs concurrently and yields the responses in the same order as urls, so the
+    caller can process early pages while later ones are still downloading. urls is read
+    lazily and at most twice max_workers requests are submitted ahead of the caller, so
+    it can be a stream and the responses waiting to be consumed stay bounded.
+
+    Args:
+        urls (iterable of string): URLs to fetch
+        headers (dict): request headers
+        max_workers (int): number of fetching threads (defaults to HOST_CONCURRENCY)
+
+    Return:
+        generator of requests.Response: one response per URL (None if no response was received)
+    """
+    max_workers = max_workers or HOST_CONCURRENCY
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for url in urls:
+            futures.append(executor.submit(fetch, url, headers))
+            if len(futures) >= 2 * max_workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import sqlite3
+from datetime import datetime, timezone
+from services import http_cache
+from services import local_state
+
+# Queue of scrape jobs, shared through SQLite between the Flask server (which enqueues
+# jobs, reports their progress and cancels them) and the scrape worker process (which
+# claims and runs them, see scrape_worker). Only one scrape is queued or running at a
+# time: enqueueing while one is active returns that job. The worker updates the
+# progress of its job every few seconds, which doubles as a heartbeat. A running job
+# whose heartbeat is older than STALE_AFTER (the worker died) is queued again, and
+# resumes where it stopped thanks to scrape_checkpoint.
+
+DB_PATH = os.path.join(http_cache.CACHE_FOLDER, 'scrape_jobs.sqlite')
+STALE_AFTER = int(os.getenv("SCRAPE_JOB_STALE_AFTER", 60)) # seconds without a heartbeat
+ACTIVE_STATUSES = ("queued", "running")
+
+_db = local_state.Database(DB_PATH, ["""
+    create table if not exists job (
+        id integer primary key autoincrement,
+        status text not null,
+        trigger text not null,
+        options text not null,
+        stage text not null,
+        progress text not null,
+        cancel_requested integer not null default 0,
+        error text,
+        created_at real not null,
+        started_at real,
+        heartbeat_at real,
+        finished_at real
+    )
+"""], autocommit=True, row_factory=sqlite3.Row) # transactions are explicit
+
+def _time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+def _eta(row, progress):
+    # Seconds left, from the rate at which the events of the job have been done so far
+    total, done = progress.get('total', 0), progress.get('done', 0)
+    if row['status'] != 'running' or not done or not row['started_at']:
+        return None
+    elapsed = row['heartbeat_at'] - row['started_at']
+    return round(elapsed / done * max(total - done, 0))
+
+def _to_job(row):
+    if row is None:
+        return {}
+    progress = json.loads(row['progress'])
+    return {
+        "jobId": row['id'],
+        "status": row['status'],
+        "trigger": row['trigger'],
+        "options": json.loads(row['options']),
+        "stage": row['stage'],
+        "progress": progress,
+        "eta": _eta(row, progress),
+        "cancelRequested": bool(row['cancel_requested']),
+        "error": row['error'],
+        "createdAt": _time(row['created_at']),
+        "startedAt": _time(row['started_at']),
+        "updatedAt": _time(row['heartbeat_at']),
+        "finishedAt": _time(row['finished_at']),
+    }
+
+def _requeue_stale(db):
+    db.execute(
+        "update job set status = 'queued', stage = 'queued' where status = 'running' and heartbeat_at < ?",
+        (time.time() - STALE_AFTER,)
+    )
+
+def enqueue(options, trigger='manual'):
+    """
+    Args:
+        options (dict): arguments of the scrape, e.g. {"fullRefresh": true}
+        trigger (string): what asked for the job, 'cron' or 'manual'
+
+    Return:
+        tuple (dict, boolean): the job, and True if it was created (False if a scrape was already queued or running)
+    """
+    db = _db()
+    db.execute("begin immediate")
+    try:
+        _requeue_stale(db)
+        row = db.execute(
+            "select * from job where status in (?, ?) order by id limit 1", ACTIVE_STATUSES
+        ).fetchone()
+        created = row is None
+        if created:
+            job_id = db.execute(
+                "insert into job (status, trigger, options, stage, progress, created_at) values ('queued', ?, ?, 'queued', '{}', ?)",
+                (trigger, json.dumps(options), time.time())
+            ).lastrowid
+            row = db.execute("select * from job where id = ?", (job_id,)).fetchone()
+        db.execute("commit")
+    except Exception:
+        db.execute("rollback")
+        raise
+    return _to_job(row), created
+
+def get_job(job_id):
+    """
+    Return:
+        dict: the job with its stage, progress and eta in seconds (empty dict if there is no such job)
+    """
+    return _to_job(_db().execute("select * from job where id = ?", (job_id,)).fetchone())
+
+def list_jobs(limit=20):
+    """
+    Return:
+        list of dict: the latest jobs, newest first
+    """
+    rows = _db().execute("select * from job order by id desc limit ?", (limit,)).fetchall()
+    return [_to_job(row) for row in rows]
+
+def cancel(job_id):
+    """
+    Cancels a queued job, or asks the worker to stop a running one
+
+    Return:
+        dict: the job (empty dict if there is no such job)
+    """
+    db = _db()
+    db.execute(
+        "update job set status = 'cancelled', stage = 'cancelled', cancel_requested = 1, finished_at = ? where id = ? and status = 'queued'",
+        (time.time(), job_id)
+    )
+    db.execute("update job set cancel_requested = 1 where id = ? and status = 'running'", (job_id,))
+    return get_job(job_id)
+
+def claim():
+    """
+    Takes the oldest queued job for the worker (including running jobs whose worker died)
+
+    Return:
+        dict: the job, now running (empty dict if there is none)
+    """
+    db = _db()
+    db.execute("begin immediate")
+    try:
+        _requeue_stale(db)
+        row = db.execute("select id from job where status = 'queued' order by id limit 1").fetchone()
+        if row is not None:
+            now = time.time()
+            db.execute(
+                "update job set status = 'running', stage = 'starting', started_at = coalesce(started_at, ?), heartbeat_at = ? where id = ?",
+                (now, now, row['id'])
+            )
+        db.execute("commit")
+    except Exception:
+        db.execute("rollback")
+        raise
+    return get_job(row['id']) if row is not None else {}
+
+def update(job_id, stage, progress):
+    """
+    Records the progress of a running job, and is its heartbeat
+
+    Args:
+        job_id (int): the job
+        stage (string): what the job is doing
+        progress (dict): counts of the job, with total and done events for the eta
+
+    Return:
+        boolean: True if the job should be cancelled
+    """
+    db = _db()
+    db.execute(
+        "update job set stage = ?, progress = ?, heartbeat_at = ? where id = ? and status = 'running'",
+        (stage, json.dumps(progress), time.time(), job_id)
+    )
+    row = db.execute("select cancel_requested from job where id = ?", (job_id,)).fetchone()
+    return row is not None and bool(row['cancel_requested'])
+
+def finish(job_id, status, progress, error=None):
+    """
+    Args:
+        job_id (int): the job
+        status (string): 'done', 'failed' or 'cancelled'
+        progress (dict): final counts of the job
+        error (string): what went wrong, if the job failed
+    """
+    now = time.time()
+    _db().execute(
+        "update job set status = ?, stage = ?, progress = ?, error = ?, heartbeat_at = ?, finished_at = ? where id = ?",
+        (status, status, json.dumps(progress), error, now, now, job_id)
+    )
@@ -0,0 +1,148 @@
+import os
+import time
+import queue
+import threading
+from services import local_state
+
+# Runs the scrape as streaming stages connected by bounded queues. Each stage is a
+# generator function which takes the items of the stage before it and yields its own
+# (the first stage takes no input), and runs in its own thread, so pages are parsed
+# while later pages are still downloading and events are written while others are
+# being enriched. A queue holds at most QUEUE_SIZE items, so a slow stage holds back
+# the stages before it instead of letting items pile up in memory. The first error in
+# any stage stops the whole pipeline and is raised to the caller. The busy time and
+# item count of every stage are recorded for the run report, per pipeline name when
+# several pipelines run at the same time.
+
+QUEUE_SIZE = int(os.getenv("SCRAPE_QUEUE_SIZE", 16))
+POLL_INTERVAL = 0.1 # seconds between checks for a stopped pipeline
+
+_DONE = object()
+_stats = local_state.Stats(keyed=True, items=0, seconds=0.0, waiting=0.0) # per "pipeline/stage" (or "stage")
+
+def _put(q, item, stop):
+    # Output: False if the pipeline was stopped before the item could be queued
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _receive(q, stop, stats):
+    # Items from the queue of a stage until the stage before it is done or the pipeline is stopped
+    while True:
+        start = time.perf_counter()
+        try:
+            item = q.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            item = _DONE if stop.is_set() else None
+        finally:
+            stats["waiting"] += time.perf_counter() - start
+        if item is _DONE:
+            return
+        if item is not None:
+            yield item
+
+def _timed(stats, items):
+    # Counts the items a stage yields and the time it takes to produce them
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stats["seconds"] += time.perf_counter() - start
+        stats["items"] += 1
+        yield item
+
+def _feed(items, q, stop, errors):
+    # Thread of a stage: runs it and queues its items for the next stage
+    try:
+        for item in items:
+            if not _put(q, item, stop):
+                return
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+        return
+    _put(q, _DONE, stop)
+
+def batched(items, size):
+    """
+    Groups items into micro-batches
+
+    Args:
+        items (iterable): items to group
+        size (int): maximum number of items in a batch
+
+    Return:
+        generator of list: the batches, the last one may be smaller
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def run(stages, queue_size=QUEUE_SIZE, name=None):
+    """
+    Args:
+        stages (list of (string, function)): name and generator function of every stage, in order
+        queue_size (int): maximum number of items waiting between two stages
+        name (string): name of the pipeline, the stats of its stages are recorded as "name/stage"
+
+    Return:
+        generator: the items yielded by the last stage, which runs in the caller's thread
+
+    Raises:
+        Exception: the first error raised by a stage
+    """
+    stop = threading.Event()
+    errors = []
+    threads = []
+    items = None
+    for stage, function in stages:
+        stage = f"{name}/{stage}" if name else stage
+        stats = _stats.group(stage)
+        if items is None:
+            items = _timed(stats, function())
+            continue
+        q = queue.Queue(maxsize=queue_size)
+        threads.append(threading.Thread(target=_feed, args=(items, q, stop, errors), name=f"scrape_pipeline-{stage}", daemon=True))
+        items = _timed(stats, function(_receive(q, stop, stats)))
+
+    for thread in threads:
+        thread.start()
+    try:
+        yield from items
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+def reset_stats():
+    _stats.reset()
+
+def get_stats():
+    """
+    Return:
+        dict: "pipeline/stage" (or "stage") -> number of items yielded and seconds spent working (not waiting for input) since the last reset_stats()
+    """
+    return {
+        name: {"items": stats["items"], "seconds": max(stats["seconds"] - stats["waiting"], 0.0)}
+        for name, stats in _stats.get().items()
+    }
+
+def print_report():
+    for name, stats in get_stats().items():
+        rate = stats["items"] / stats["seconds"] if stats["seconds"] else 0
+        print(f"scrape_pipeline: {name}: {stats['items']} items, {stats['seconds']:.1f}s busy, {rate:.1f} items/s")
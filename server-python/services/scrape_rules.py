@@ -0,0 +1,152 @@
+import os
+import re
+from services import http_cache
+from services import local_state
+
+# Local rules which answer the easy questions before the scrapers ask Gemini:
+#   (1) the mode of an event from its location, with keyword and address rules and a
+#       cache of the modes Gemini gave for locations seen before
+#   (2) a brief description, by extracting the leading sentences of the description
+# Each answer comes with a confidence, and Gemini is only asked for the fields whose
+# confidence is below CONFIDENCE_THRESHOLD. The event type is always left to Gemini, as
+# it also decides whether an event is academic at all, which a title keyword cannot tell
+# ("Pottery Workshop for Beginners"). The report counts the fields answered locally and
+# the (estimated) tokens this keeps out of the Gemini requests.
+
+DB_PATH = os.path.join(http_cache.CACHE_FOLDER, 'scrape_rules.sqlite')
+CONFIDENCE_THRESHOLD = 0.8
+BRIEF_MAX_WORDS = 30
+BRIEF_MIN_WORDS = 8
+
+HYBRID_PATTERN = re.compile(r"\bhybrid\b|\bin[- ]person (and|&|or) online\b", re.IGNORECASE)
+TBA_PATTERN = re.compile(r"\b(tba|tbc|to be (announced|confirmed))\b", re.IGNORECASE)
+ONLINE_PATTERN = re.compile(
+    r"\b(online|virtual|virtually|zoom|webinar|(ms|microsoft) teams|google meet|webex|livestream|live stream|youtube)\b",
+    re.IGNORECASE
+)
+ADDRESS_PATTERN = re.compile(r"\b(singapore\s*)?\d{6}\b|#\d{1,2}-\d{1,4}", re.IGNORECASE) # postal code or unit number
+PLACE_PATTERN = re.compile(
+    r"\b(road|rd|street|avenue|ave|drive|lane|blk|block|level|building|hall|auditorium|campus|centre|center|tower|room|theatre)\b",
+    re.IGNORECASE
+)
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+CHARS_PER_TOKEN = 4 # rough size of a Gemini token, for the estimate of the tokens avoided
+
+_db = local_state.Database(DB_PATH, ["create table if not exists location_mode (location text primary key, mode text not null)"])
+_stats = local_state.Stats(modeLocal=0, modeLLM=0, briefLocal=0, briefLLM=0, events=0, tokensAvoided=0)
+
+def _normalize(location):
+    return " ".join(location.lower().split())
+
+def classify_mode(location):
+    """
+    Args:
+        location (string): location of the event as scraped
+
+    Return:
+        tuple (string, float): mode (one of event.MODE_ENUM) and confidence from 0 to 1
+    """
+    location = location.strip()
+    if location == "":
+        return 'tba', 0.9
+    row = _db().execute("select mode from location_mode where location = ?", (_normalize(location),)).fetchone()
+    if row:
+        return row[0], 1.0
+    if HYBRID_PATTERN.search(location):
+        return 'hybrid', 0.9
+    online = ONLINE_PATTERN.search(location) is not None
+    address = ADDRESS_PATTERN.search(location) is not None
+    place = PLACE_PATTERN.search(location) is not None
+    if online and (address or place):
+        # e.g. "Register online, held at the LT27 hall" as often as a real hybrid event
+        return 'hybrid', 0.6
+    if online:
+        return 'online', 0.9
+    if TBA_PATTERN.search(location):
+        return 'tba', 0.9
+    if address:
+        return 'offline', 0.9
+    if place:
+        return 'offline', 0.6
+    return 'unknown', 0.0
+
+def remember_mode(location, mode):
+    # Caches the mode Gemini gave for a location, so it is answered locally next time
+    location = _normalize(location)
+    if location == "" or mode == 'unknown':
+        return
+    db = _db()
+    db.execute("insert or replace into location_mode values (?, ?)", (location, mode))
+    db.commit()
+
+def summarize(text, max_words=BRIEF_MAX_WORDS):
+    """
+    Extracts a brief description from the leading sentences of a description
+
+    Args:
+        text (string): description as returned by parse_paragraphs()
+        max_words (int): upper bound on the number of words
+
+    Return:
+        tuple (string, float): brief description and confidence from 0 to 1
+    """
+    sentences = []
+    for line in text.split("\n"):
+        line = line.strip()
+        # Headings, list items and short lines like "About the event" make poor summaries
+        if line.startswith("-") or len(line.split()) < 5:
+            continue
+        sentences.extend(sentence.strip() for sentence in SENTENCE_END_PATTERN.split(line) if sentence.strip())
+
+    brief = []
+    for sentence in sentences:
+        words = sentence.split()
+        if len(brief) + len(words) > max_words:
+            break
+        brief.extend(words)
+    if len(brief) < BRIEF_MIN_WORDS:
+        return "", 0.0
+    return " ".join(brief), 0.9
+
+def estimate_tokens(characters):
+    # Rough number of Gemini tokens in that many characters of prompt or output
+    return max(characters, 0) // CHARS_PER_TOKEN
+
+def record(field, local):
+    """
+    Counts one field for the run report
+
+    Args:
+        field (string): 'mode' or 'brief'
+        local (boolean): True if it was answered locally, False if Gemini was asked
+    """
+    _stats.add(**{f"{field}{'Local' if local else 'LLM'}": 1})
+
+def record_savings(events, tokens_avoided):
+    """
+    Counts what the local answers saved in one enrichment run
+
+    Args:
+        events (int): events which had to be enriched (not cached)
+        tokens_avoided (int): estimated prompt and output tokens not sent or generated
+    """
+    _stats.add(events=events, tokensAvoided=tokens_avoided)
+
+def reset_stats():
+    _stats.reset()
+
+def get_stats():
+    """
+    Return:
+        dict: number of modes and brief descriptions answered locally and by Gemini, and the
+        events enriched and tokens kept from Gemini since the last reset_stats()
+    """
+    return _stats.get()
+
+def print_report():
+    stats = get_stats()
+    print(
+        f"scrape_rules: ~{stats['tokensAvoided']} Gemini tokens avoided over {stats['events']} events "
+        f"(answered locally: mode {stats['modeLocal']}/{stats['modeLocal'] + stats['modeLLM']}, "
+        f"brief description {stats['briefLocal']}/{stats['briefLocal'] + stats['briefLLM']})"
+    )
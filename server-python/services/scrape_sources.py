@@ -0,0 +1,156 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from services import local_state
+
+# Registry of the sites the scraper reads. A source plugin says where its listing page
+# is, how to read the events off that page, how to extract the rest of an event from
+# its detail page, and which fields every one of its events gets. Sources are
+# independent of each other, so run_all() scrapes them in parallel threads, at most
+# SOURCE_CONCURRENCY at a time. Each source has its own timeout and fetch concurrency.
+# A source that fails or times out is reported and does not affect the others.
+# cancel() stops every source at its next deadline check. The time taken and the
+# number of events of every source are recorded for the run report.
+
+SOURCE_CONCURRENCY = int(os.getenv("SCRAPE_SOURCE_CONCURRENCY", 4)) # sources scraped at the same time
+SOURCE_TIMEOUT = int(os.getenv("SCRAPE_SOURCE_TIMEOUT", 4 * 60 * 60)) # seconds
+
+class SourceTimeoutError(Exception):
+    pass
+
+class SourceCancelledError(Exception):
+    pass
+
+class Source:
+    def __init__(self, name, listing_url, parse_listing, parse_detail, fields=None, timeout=SOURCE_TIMEOUT, concurrency=None):
+        """
+        Args:
+            name (string): unique name of the source, used in logs and reports
+            listing_url (string): URL of the page listing the events
+            parse_listing (function): parsed listing page -> list of events with the fields on their cards
+            parse_detail (function): (parsed detail page, event) -> the event with the fields on its detail page
+            fields (dict): field -> value every event of the source gets, unless its pages have the field
+            timeout (float): seconds the source may take before it is stopped
+            concurrency (int): detail pages fetched at the same time (defaults to scrape_http.HOST_CONCURRENCY)
+        """
+        self.name = name
+        self.listing_url = listing_url
+        self.parse_listing = parse_listing
+        self.parse_detail = parse_detail
+        self.fields = dict(fields or {})
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    def apply_fields(self, event):
+        # Fills in the fields of the source which the event does not have
+        for field, value in self.fields.items():
+            event.setdefault(field, value)
+        return event
+
+_sources = dict() # name -> Source, in registration order
+_stats = local_state.Stats(keyed=True, status="running", seconds=0.0, listed=0, queued=0, events=0, skipped=0) # per source name
+_cancelled = threading.Event()
+
+def register(source):
+    """
+    Args:
+        source (Source): the source to add
+
+    Raises:
+        ValueError: a source with the same name is already registered
+    """
+    if source.name in _sources:
+        raise ValueError(f"Source {source.name} is already registered")
+    _sources[source.name] = source
+
+def get_source(name):
+    """
+    Return:
+        Source: the registered source (None if there is none with that name)
+    """
+    return _sources.get(name)
+
+def get_sources():
+    """
+    Return:
+        list of Source: every registered source, in registration order
+    """
+    return list(_sources.values())
+
+def cancel():
+    # Stops the sources being scraped at their next check_deadline()
+    _cancelled.set()
+
+def is_cancelled():
+    return _cancelled.is_set()
+
+def check_deadline(deadline):
+    # Raises SourceCancelledError once cancel() is called, or SourceTimeoutError once the time given to a source is up
+    if _cancelled.is_set():
+        raise SourceCancelledError("cancelled")
+    if deadline is not None and time.monotonic() > deadline:
+        raise SourceTimeoutError("timed out")
+
+def record(name, **counts):
+    # Adds to the counts of a source:
+    #   listed: events on the listing page
+    #   queued: events which have to be processed (not done or unchanged)
+    #   events: events scraped
+    #   skipped: queued events which were dropped (not accessible, unchanged, rejected...)
+    _stats.add(name, **counts)
+
+def _finish(name, status, seconds):
+    _stats.set(name, status=status, seconds=seconds)
+
+def run_all(function, sources=None):
+    """
+    Runs function for every source, each in its own thread
+
+    Args:
+        function (function): (source, deadline) -> None, scrapes one source. deadline is a time.monotonic()
+            value, after which it should stop with SourceTimeoutError (see check_deadline())
+        sources (list of Source): sources to scrape (defaults to every registered source)
+
+    Return:
+        dict: source name -> "ok", "timed out", "cancelled" or "failed: <error>"
+    """
+    sources = get_sources() if sources is None else sources
+    _cancelled.clear()
+
+    def run(source):
+        start = time.monotonic()
+        try:
+            function(source, start + source.timeout)
+            status = "ok"
+        except SourceTimeoutError:
+            status = "timed out"
+        except SourceCancelledError:
+            status = "cancelled"
+        except Exception as e:
+            status = f"failed: {e!r}"
+        if status != "ok":
+            print(f"scrape_sources: {source.name} {status}")
+        _finish(source.name, status, time.monotonic() - start)
+        return status
+
+    with ThreadPoolExecutor(max_workers=max(1, min(SOURCE_CONCURRENCY, len(sources))), thread_name_prefix="scrape_source") as executor:
+        return dict(zip([source.name for source in sources], executor.map(run, sources)))
+
+def reset_stats():
+    _stats.reset()
+
+def get_stats():
+    """
+    Return:
+        dict: source name -> status, seconds taken and event counts (see record()) since the last reset_stats()
+    """
+    return _stats.get()
+
+def print_report():
+    for name, stats in get_stats().items():
+        print(
+            f"scrape_sources: {name}: {stats['status']}, {stats['seconds']:.1f}s, "
+            f"{stats['listed']} events listed, {stats['queued']} processed, "
+            f"{stats['events']} scraped, {stats['skipped']} skipped"
+        )
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import atexit
+import threading
+import subprocess
+from services import scrape_jobs
+from services import scrape_sources
+from services import scrape_pipeline
+
+# The scrape worker: a process of its own which takes jobs from scrape_jobs and runs
+# webscrape.scrape() for them, so the long, LLM-bound scrape does not compete with the
+# Flask server for the GIL, CPU and memory. While a job runs, its stage and counts are
+# written to the queue every PROGRESS_INTERVAL seconds, and a cancel requested through
+# the queue stops the sources at their next check (see scrape_sources.cancel()).
+#
+# The server starts the worker with spawn() (and restarts it if it died), unless
+# SCRAPE_WORKER is "external", in which case it is run separately from the working
+# directory of the server (server-python by default):
+#   python -m services.scrape_worker
+
+POLL_INTERVAL = int(os.getenv("SCRAPE_WORKER_POLL_INTERVAL", 5)) # seconds between checks for new jobs
+PROGRESS_INTERVAL = 2 # seconds
+
+_process = None
+_process_lock = threading.Lock()
+
+def spawn():
+    # Starts the worker process if it is not running
+    # It runs in the working directory of the server, which the cache, queue and upload
+    # folders are relative to, with the server folder on its path to import the services.
+    # Its stdin is closed, so nothing in the scrape can block waiting for input
+    global _process
+    with _process_lock:
+        if _process is not None and _process.poll() is None:
+            return
+        server_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        python_path = os.pathsep.join(filter(None, [server_folder, os.environ.get("PYTHONPATH")]))
+        _process = subprocess.Popen(
+            [sys.executable, '-m', 'services.scrape_worker'],
+            cwd=os.getcwd(),
+            stdin=subprocess.DEVNULL,
+            env={**os.environ, "PYTHONPATH": python_path, "PYTHONUNBUFFERED": "1"}, # logs show up as they are printed
+        )
+        print(f"scrape_worker.spawn(): Started worker process {_process.pid}.")
+
+def _stop_spawned():
+    if _process is not None and _process.poll() is None:
+        _process.terminate()
+
+atexit.register(_stop_spawned)
+
+def progress():
+    """
+    Return:
+        tuple (string, dict): stage of the running scrape, and its counts per source and per
+        pipeline stage, with the total number of events to process and the number done
+    """
+    sources = scrape_sources.get_stats()
+    stages = dict()
+    for name, stats in scrape_pipeline.get_stats().items():
+        stage = name.split('/')[-1]
+        stages[stage] = stages.get(stage, 0) + stats['items']
+    if len(sources) == 0:
+        stage = "starting"
+    elif any(stats['status'] == "running" for stats in sources.values()):
+        stage = "scraping"
+    else:
+        stage = "finishing"
+    return stage, {
+        "sources": sources,
+        "stages": stages,
+        "total": sum(stats['queued'] for stats in sources.values()),
+        "done": sum(stats['events'] + stats['skipped'] for stats in sources.values()),
+    }
+
+def _monitor(job_id, stop):
+    # Reports the progress of the job and passes on cancel requests until the job ends
+    while not stop.wait(PROGRESS_INTERVAL):
+        stage, counts = progress()
+        if scrape_jobs.update(job_id, stage, counts):
+            scrape_sources.cancel()
+
+def run_job(job):
+    """
+    Runs one scrape job and records how it ended
+
+    Args:
+        job (dict): the job, as returned by scrape_jobs.claim()
+    """
+    # webscrape is only imported here, so the server does not load it when it spawns the worker
+    from services import webscrape
+    options = job['options']
+    print(f"scrape_worker: Starting job {job['jobId']} ({job['trigger']}).")
+    scrape_sources.reset_stats()
+    scrape_pipeline.reset_stats()
+    stop = threading.Event()
+    monitor = threading.Thread(target=_monitor, args=(job['jobId'], stop), daemon=True)
+    monitor.start()
+    status, error = "done", None
+    try:
+        webscrape.scrape(print_mode=options.get('printMode', 'all'), full_refresh=options.get('fullRefresh', False))
+        statuses = {name: stats['status'] for name, stats in scrape_sources.get_stats().items()}
+        if scrape_sources.is_cancelled():
+            status = "cancelled"
+        elif any(source_status != "ok" for source_status in statuses.values()):
+            status = "failed"
+            error = ", ".join(f"{name} {source_status}" for name, source_status in statuses.items() if source_status != "ok")
+    except Exception as e:
+        status, error = "failed", repr(e)
+    finally:
+        stop.set()
+        monitor.join()
+    scrape_jobs.finish(job['jobId'], status, progress()[1], error)
+    print(f"scrape_worker: Job {job['jobId']} {status}{f': {error}' if error else ''}.")
+
+def run(once=False):
+    """
+    Runs jobs from the queue, one at a time
+
+    Args:
+        once (boolean): return when the queue is empty instead of waiting for more jobs
+    """
+    print(f"scrape_worker: Waiting for jobs (pid {os.getpid()}).")
+    while True:
+        job = scrape_jobs.claim()
+        if job:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(POLL_INTERVAL)
+
+if __name__ == "__main__":
+    run(once="--once" in sys.argv)
@@ -0,0 +1,162 @@
+import os
+import time
+import hashlib
+import itertools
+import tempfile
+
+# Assets are stored in a two level fan-out keyed by a hash of the asset id
+# (uploads/ab/cd/<asset_id>) so that no directory grows past a few hundred entries.
+# Files from the old flat layout (uploads/<asset_id>) are still found until
+# migrate_flat_layout has moved them.
+
+UPLOAD_FOLDER = './uploads'
+TEMP_PREFIX = '.upload-' # in-progress uploads, never a valid asset id
+LEGACY_TEMP_FOLDER = 'temp'
+
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)  # This will create the folder if it doesn't exist
+
+def relative_path(asset_id):
+    """
+    Args:
+        asset_id (string): asset UUID
+
+    Return:
+        string: path of the asset relative to UPLOAD_FOLDER (e.g. 3f/a2/<asset_id>)
+    """
+    digest = hashlib.sha1(asset_id.encode()).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], asset_id)
+
+def path_for(asset_id):
+    return os.path.join(UPLOAD_FOLDER, relative_path(asset_id))
+
+def _is_asset_name(name):
+    return not name.startswith('.') and name != LEGACY_TEMP_FOLDER and os.sep not in name and name not in ('', '..')
+
+def _legacy_path(asset_id):
+    return os.path.join(UPLOAD_FOLDER, asset_id)
+
+def locate(asset_id):
+    """
+    Args:
+        asset_id (string): asset UUID
+
+    Return:
+        string: path of the stored file, in the sharded or the legacy flat layout (None if it does not exist)
+    """
+    if not _is_asset_name(asset_id):
+        return None
+    path = path_for(asset_id)
+    if os.path.isfile(path):
+        return path
+    legacy_path = _legacy_path(asset_id)
+    if os.path.isfile(legacy_path):
+        return legacy_path
+    # the file may have been migrated between the two checks
+    if os.path.isfile(path):
+        return path
+    return None
+
+def exists(asset_id):
+    return locate(asset_id) is not None
+
+def new_temp_file():
+    """
+    Return:
+        tuple (file descriptor, path): a new temporary file inside UPLOAD_FOLDER, so it can be renamed into place atomically
+    """
+    return tempfile.mkstemp(prefix=TEMP_PREFIX, suffix='.part', dir=UPLOAD_FOLDER)
+
+def store(temp_path, asset_id):
+    """
+    Moves a finished temporary file to the storage path of the asset
+
+    Return:
+        string: path of the stored file
+    """
+    path = path_for(asset_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+    return path
+
+def remove(asset_id):
+    """
+    Return:
+        int: number of bytes freed
+    """
+    freed = 0
+    for path in (path_for(asset_id), _legacy_path(asset_id)):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except FileNotFoundError:
+            pass
+    return freed
+
+def _is_shard(name, length=2):
+    return len(name) == length and all(ch in '0123456789abcdef' for ch in name)
+
+def iter_asset_files():
+    """
+    Yields (asset_id, path) for every stored asset in both layouts
+    """
+    with os.scandir(UPLOAD_FOLDER) as top:
+        for entry in top:
+            if entry.is_file() and _is_asset_name(entry.name):
+                yield entry.name, entry.path
+            elif entry.is_dir() and _is_shard(entry.name):
+                with os.scandir(entry.path) as middle:
+                    for shard in middle:
+                        if not (shard.is_dir() and _is_shard(shard.name)):
+                            continue
+                        with os.scandir(shard.path) as files:
+                            for f in files:
+                                if f.is_file() and _is_asset_name(f.name):
+                                    yield f.name, f.path
+
+def iter_temp_files():
+    """
+    Yields the paths of in-progress upload files and of the legacy temp folder
+    """
+    with os.scandir(UPLOAD_FOLDER) as top:
+        for entry in top:
+            if entry.is_file() and entry.name.startswith(TEMP_PREFIX):
+                yield entry.path
+    legacy_temp = os.path.join(UPLOAD_FOLDER, LEGACY_TEMP_FOLDER)
+    if os.path.isdir(legacy_temp):
+        for name in os.listdir(legacy_temp):
+            yield os.path.join(legacy_temp, name)
+
+def migrate_flat_layout(batch_size=500, pause=0.1):
+    """
+    Moves files of the legacy flat layout into the sharded layout. Every move is an atomic
+    rename and locate() checks both layouts, so URLs keep working during the migration.
+    The remaining flat files are the migration state: an interrupted run resumes by running again.
+
+    Args:
+        batch_size (int): number of files moved between pauses
+        pause (float): seconds to sleep between batches to limit disk load
+
+    Return:
+        int: number of files moved
+    """
+    moved = 0
+    # One pass over the folder: the flat files are taken from the scan in slices, so the
+    # cost stays linear in the size of the folder however many batches there are
+    with os.scandir(UPLOAD_FOLDER) as top:
+        flat = (entry.name for entry in top if entry.is_file() and _is_asset_name(entry.name))
+        while True:
+            batch = list(itertools.islice(flat, batch_size))
+            if not batch:
+                break
+            for asset_id in batch:
+                path = path_for(asset_id)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.replace(_legacy_path(asset_id), path)
+                    moved += 1
+                except FileNotFoundError:
+                    pass
+            print(f"storage.migrate_flat_layout(): {moved} files moved.")
+            time.sleep(pause)
+    return moved
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import uuid
+import threading
+from services import asset as asset_service
+from services import storage
+
+# Resumable chunked uploads for large files:
+#   (1) create_session: client declares the file name, size and sha256
+#   (2) write_chunk: client sends the bytes at the current offset, in as many requests as it needs
+#       (after a dropped connection, get_session returns the offset to resume from)
+#   (3) finalize: the sha256 is verified and the file goes through the usual dedup/ingest path
+# Each session is a JSON metadata file and a .part file in SESSION_FOLDER. The size of the
+# .part file is the committed offset, so sessions survive server restarts.
+
+SESSION_FOLDER = os.path.join(storage.UPLOAD_FOLDER, '.sessions')
+MAX_FILE_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 100 * 1024 * 1024))
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+SESSION_TTL = 24 * 60 * 60 # seconds an idle session is kept
+
+os.makedirs(SESSION_FOLDER, exist_ok=True)
+
+_locks = dict()
+_locks_lock = threading.Lock()
+
+class UploadSessionError(Exception):
+    pass
+
+class OffsetMismatchError(UploadSessionError):
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+def _meta_path(upload_id):
+    return os.path.join(SESSION_FOLDER, f"{upload_id}.json")
+
+def _part_path(upload_id):
+    return os.path.join(SESSION_FOLDER, f"{upload_id}.part")
+
+def _lock_for(upload_id):
+    with _locks_lock:
+        return _locks.setdefault(upload_id, threading.Lock())
+
+def _valid_upload_id(upload_id):
+    try:
+        return str(uuid.UUID(upload_id)) == upload_id
+    except ValueError:
+        return False
+
+def create_session(event_id, user_id, file_name, file_size, sha256):
+    """
+    Args:
+        event_id (string): event the file will be linked to
+        user_id (string): UUID of the uploading user
+        file_name (string): original file name
+        file_size (int): total size of the file in bytes
+        sha256 (string): hex digest of the whole file, verified at finalize
+
+    Return:
+        dict: session data including uploadId and offset
+    """
+    file_size = int(file_size)
+    if file_size <= 0 or file_size > MAX_FILE_SIZE:
+        raise UploadSessionError(f"File size must be between 1 and {MAX_FILE_SIZE} bytes")
+    if len(sha256) != 64:
+        raise UploadSessionError("sha256 must be a hex digest")
+
+    upload_id = str(uuid.uuid4())
+    session = {
+        "uploadId": upload_id,
+        "eventId": event_id,
+        "userId": user_id,
+        "fileName": file_name,
+        "fileSize": file_size,
+        "sha256": sha256.lower()
+    }
+    open(_part_path(upload_id), 'wb').close()
+    with open(_meta_path(upload_id), 'w') as f:
+        json.dump(session, f)
+    session['offset'] = 0
+    return session
+
+def get_session(upload_id):
+    """
+    Return:
+        dict: session data with the current offset (empty dict if the session does not exist)
+    """
+    if not _valid_upload_id(upload_id):
+        return {}
+    try:
+        with open(_meta_path(upload_id)) as f:
+            session = json.load(f)
+        session['offset'] = os.path.getsize(_part_path(upload_id))
+    except FileNotFoundError:
+        return {}
+    return session
+
+def write_chunk(upload_id, offset, stream):
+    """
+    Appends the bytes of stream at offset, which must equal the current size of the upload.
+    The chunk is copied in bounded pieces and never held in memory as a whole.
+
+    Args:
+        upload_id (string): upload session id
+        offset (int): byte offset of the chunk in the file
+        stream (file-like): request body with the chunk bytes
+
+    Return:
+        int: the new offset
+    """
+    with _lock_for(upload_id):
+        session = get_session(upload_id)
+        if session == {}:
+            raise UploadSessionError("Upload not exists")
+        if int(offset) != session['offset']:
+            raise OffsetMismatchError(session['offset'])
+
+        limit = min(MAX_CHUNK_SIZE, session['fileSize'] - session['offset'])
+        written = 0
+        with open(_part_path(upload_id), 'ab') as f:
+            while True:
+                data = stream.read(asset_service.CHUNK_SIZE)
+                if not data:
+                    break
+                if written + len(data) > limit:
+                    f.truncate(session['offset'])
+                    raise UploadSessionError(f"Chunk exceeds {limit} bytes")
+                f.write(data)
+                written += len(data)
+        return session['offset'] + written
+
+def discard(upload_id):
+    for path in (_part_path(upload_id), _meta_path(upload_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    with _locks_lock:
+        _locks.pop(upload_id, None)
+
+def finalize(upload_id):
+    """
+    Verifies the assembled file against the declared size and sha256, then stores it through
+    the dedup path and links it to the event of the session
+
+    Return:
+        string: asset UUID
+    """
+    with _lock_for(upload_id):
+        session = get_session(upload_id)
+        if session == {}:
+            raise UploadSessionError("Upload not exists")
+        if session['offset'] != session['fileSize']:
+            raise OffsetMismatchError(session['offset'])
+
+        part_path = _part_path(upload_id)
+        content_hash, file_size, mime_type = asset_service.scan_file(part_path)
+        if content_hash != session['sha256']:
+            discard(upload_id)
+            raise UploadSessionError("File hash does not match")
+
+        # the file is kept until the link succeeded, in case the asset it matched was deleted
+        # by another process in the meantime and it has to be stored as a new asset
+        try:
+            asset_id = asset_service.ingest_file(part_path, content_hash, file_size, mime_type, session['fileName'], keep_duplicate=True)
+            if asset_id == "":
+                raise UploadSessionError("Cannot create asset")
+            try:
+                linked = asset_service.link_asset(session['eventId'], asset_id)
+            except asset_service.MissingAssetError:
+                if not os.path.exists(part_path):
+                    raise UploadSessionError("Cannot link asset")
+                asset_id = asset_service.ingest_file(part_path, content_hash, file_size, mime_type, session['fileName'])
+                if asset_id == "":
+                    raise UploadSessionError("Cannot create asset")
+                linked = asset_service.link_asset(session['eventId'], asset_id)
+        finally:
+            discard(upload_id)
+        if not linked:
+            raise UploadSessionError("Cannot link asset")
+        return asset_id
+
+def expire_sessions(dry_run=False):
+    """
+    Removes sessions that have not received data for SESSION_TTL seconds
+
+    Return:
+        tuple (int, int): number of sessions and bytes removed
+    """
+    now = time.time()
+    expired = 0
+    freed = 0
+    for name in os.listdir(SESSION_FOLDER):
+        if not name.endswith('.json'):
+            continue
+        upload_id = name[:-len('.json')]
+        part_path = _part_path(upload_id)
+        last_write = os.path.getmtime(part_path) if os.path.exists(part_path) else os.path.getmtime(_meta_path(upload_id))
+        if now - last_write <= SESSION_TTL:
+            continue
+        expired += 1
+        freed += os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if not dry_run:
+            discard(upload_id)
+    return expired, freed
@@ -1,11 +1,16 @@
 import re
-import filecmp
-import tempfile
-import os
-from werkzeug.utils import secure_filename
 
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
 
+# Leading bytes of the file formats we accept, used to sniff the real type of an upload
+MAGIC_NUMBERS = (
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
 def validate_email(email):
     # Simple regex for basic email validation
     pattern = r"^[\w\.-]+@[\w\.-]+\.\w+$"
@@ -21,12 +26,23 @@ def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def files_are_equal(file_path, asset):
-    asset_path = os.path.join("./uploads/temp", secure_filename(asset.filename))
-    asset.save(asset_path)
-    
-    cmp = filecmp.cmp(file_path, asset_path, shallow=False)
-
-    os.remove(asset_path)
-
-    return cmp
\ No newline at end of file
+def sniff_mime(head):
+    """
+    Args:
+        head (bytes): the first bytes of a file
+
+    Return:
+        string: MIME type detected from the magic number of the file
+    """
+    for magic, mime_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # a multi-byte character may have been cut off at the end of the chunk
+        if e.start < len(head) - 3:
+            return 'application/octet-stream'
+    return 'text/plain'
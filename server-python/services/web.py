@@ -11,4 +11,7 @@ def sendInternalError(error):
     return {"status": False, "error": error, "data": ""}, 500
 
 def sendMethodNotAllowed():
-    return {"status": False, "error": "Method Not Allowed", "data": ""}, 405
\ No newline at end of file
+    return {"status": False, "error": "Method Not Allowed", "data": ""}, 405
+
+def sendConflict(error, data=""):
+    return {"status": False, "error": error, "data": data}, 409
\ No newline at end of file
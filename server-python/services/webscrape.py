@@ -1,17 +1,33 @@
 #imports
 import json
-import requests
-from bs4 import BeautifulSoup
+import re
+from html import unescape
 from lxml import etree
+import lxml.html
+from lxml.cssselect import CSSSelector
 import os
 import time
+import textwrap
+import threading
+from collections import deque
+import httpx
 from google import genai
-from google.genai import types
-from dotenv import load_dotenv
 from datetime import datetime
 
 from services import event as event_service
 from services import database as database_service
+from services import asset as asset_service
+from services import image_mirror
+from services import scrape_http
+from services import http_cache
+from services import scrape_fingerprint
+from services import gemini_cache
+from services import gemini_quota
+from services import gemini_client
+from services import scrape_rules
+from services import scrape_pipeline
+from services import scrape_checkpoint
+from services import scrape_sources
 
 # Code is structured as the following:
 #   (1) Helper functions
@@ -19,6 +35,17 @@ from services import database as database_service
 #   (3) Funciton to run all the code
 #   (4) Sample run code
 
+# Set by scrape()
+PRINT_MODE = 1
+DEBUG_MODE = False
+FULL_REFRESH = False
+RETURN_DATA = False
+
+INSERT_BATCH_SIZE = int(os.getenv("SCRAPE_INSERT_BATCH_SIZE", 20)) # events written per micro-batch
+
+_output = {"file": None, "count": 0, "data": []} # see open_output()
+_output_lock = threading.Lock()
+
 # (1) ---------------------- HELPER FUNCTIONS ----------------------
 
 def debug_mode_input(msg=""):
@@ -40,204 +67,382 @@ def deCFEmail(fp):
     except (ValueError):
         pass
 
+NEWLINE_TAGS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+RAW_TEXT_TAGS = {'script', 'style'}
+PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+CF_EMAIL_XPATH = etree.XPath('.//a/@data-cfemail')
+ANY_CF_EMAIL_XPATH = etree.XPath('descendant-or-self::*/@data-cfemail')
+MARKUP_PATTERN = re.compile(r"<[^>]*(>|$)")
+NEWLINES_PATTERN = re.compile(r"\n{2,}")
+
+def strip_markup(html):
+    # Removes everything between < and > from serialized html, for the nodes parse_paragraphs()
+    # does not walk (comments and script/style elements)
+    for tag in NEWLINE_TAGS:
+        html = html.replace(f"<{tag}>", "\n").replace(f"</{tag}>", "\n")
+    html = html.replace("<br>", "\n").replace("</li>", "\n").replace("<li>", "\n-")
+    return unescape(MARKUP_PATTERN.sub("", html))
+
+def collapse_blank(text):
+    # Text made of whitespace only is collapsed to a single newline or space, the way
+    # BeautifulSoup did when pages were parsed with it
+    if text.strip(ASCII_SPACES) == "":
+        return "\n" if "\n" in text else " "
+    return text
+
 def parse_paragraphs(paragraphs):
     # Helper function to extract out all the text in a nested html paragraph properly.
     # Input: etree element with the paragraphs to be extracted out
     # Output: str with proper formating for display
     # This function formats the following:
     #   (1) Protected emails
-    #   (2) Newlines where necessary
-    #   (3) Lists items
-    #   (4) html/xml special characters
-    return_str = ""
-    for para in paragraphs:
-        write = True
-        # Ignore if it is a blank paragraph
-        if str(etree.tostring(para, method="text", encoding='unicode')) == "": continue # type: ignore
-        # Extract out in html to handle tags
-        html = str(etree.tostring(para, method="html", encoding='unicode')) # type: ignore
-        # Decrypt emails
-        if "data-cfemail=" in html:
-            return_str += str(deCFEmail(para.xpath('.//a/@data-cfemail')[0])) + "\n"
+    #   (2) Newlines at <br> and at the start and end of <p> and <h1> to <h6>
+    #   (3) Lists items, with a "-" bullet at the start of <li> and a newline at its end
+    # Tags with attributes do not get the newline or bullet at their start.
+    # Whitespace between tags is collapsed (except in <pre> and <textarea>).
+    # The element is walked once with lxml's iterwalk, so the time taken is linear in the size of the html.
+    return_str = []
+    pieces, has_text, has_cf_email = [], False, False
+    depth = 0
+    preserve_whitespace = 0
+    walker = etree.iterwalk(paragraphs, events=("start", "end", "comment", "pi"))
+    for event, node in walker:
+        if event == "start":
+            depth += 1
+            if depth == 1: continue # The element holding the paragraphs
+            if 'data-cfemail' in node.attrib:
+                has_cf_email = True
+            if node.tag in RAW_TEXT_TAGS:
+                # Raw text is not escaped when serialized, so it is stripped like before
+                has_text = has_text or bool(node.text)
+                pieces.append(strip_markup(etree.tostring(node, method="html", encoding='unicode', with_tail=False)))
+                walker.skip_subtree()
+            else:
+                if not node.attrib and (node.tag in NEWLINE_TAGS or node.tag == 'br'):
+                    pieces.append("\n")
+                elif not node.attrib and node.tag == 'li':
+                    pieces.append("\n-")
+                elif node.tag in PRESERVE_WHITESPACE_TAGS:
+                    preserve_whitespace += 1
+                if node.text:
+                    has_text = True
+                    pieces.append(node.text if preserve_whitespace else collapse_blank(node.text))
             continue
-        # Change the following tags which usually automatically creates a newline to \n
-        newline_tags = (
-            '<br>', '</li>', '<p>', '</p>',
-            '<h1>', '</h1>', '<h2>', '</h2>',
-            '<h3>', '</h3>', '<h4>', '</h4>',
-            '<h5>', '</h5>', '<h6>', '</h6>',
-            )
-        for tag in newline_tags:
-            html = html.replace(tag, "\n")
-        html = html.replace("<li>", "\n-")
-        # Only add in text that are outside the html tags <>
-        # i.e. remove the other tags like <strong> or <a>
-        for ch in html:
-            if write and ch == "<":
-                write = False
-            if not write and ch == ">":
-                write = True
-                continue
-            if write:
-                return_str += ch
-        return_str += "\n"
+        if event == "end":
+            depth -= 1
+            if depth == 0: break
+            if node.tag in NEWLINE_TAGS or node.tag == 'li':
+                pieces.append("\n")
+            elif node.tag in PRESERVE_WHITESPACE_TAGS:
+                preserve_whitespace -= 1
+        else:
+            # Comments are not escaped when serialized either
+            has_text = has_text or bool(node.text)
+            pieces.append(strip_markup(etree.tostring(node, method="html", encoding='unicode', with_tail=False)))
+        if node.tail:
+            has_text = True
+            pieces.append(node.tail if preserve_whitespace else collapse_blank(node.tail))
+        if depth > 1: continue
+
+        # End of a paragraph
+        # Ignore if it is a blank paragraph
+        if has_text:
+            if has_cf_email:
+                # Decrypt emails
+                fp = CF_EMAIL_XPATH(node) or ANY_CF_EMAIL_XPATH(node)
+                return_str.append(str(deCFEmail(fp[0])) + "\n")
+            else:
+                return_str.extend(pieces)
+                return_str.append("\n")
+        pieces, has_text, has_cf_email = [], False, False
+
     # Cleaning up the text
-    while "\n\n" in return_str:
-        return_str = return_str.replace("\n\n", "\n")
+    return_str = NEWLINES_PATTERN.sub("\n", "".join(return_str))
     return_str = return_str.replace("-\n", "- ")
-    # Handle special html/xml characters
-    soup = BeautifulSoup(f"<p>{return_str.strip()}<p>", 'html.parser')
-    return_str = soup.get_text().strip("\n")
-    return return_str
-
-def get_gemini_model(new=False):
-    if 'current_model' not in globals() or 'MODELS' not in globals():
-        if PRINT_MODE == 3 : print("get_gemini_model(): First Gemini call, creating global variables.")
-        global MODELS 
-        global current_model
-        MODELS = (
-            'gemini-2.0-flash', # Ideal
-            'gemini-2.5-flash', # Slow output due to thinking
-            'gemini-2.5-flash-lite-preview-06-17', # Low request limit
-            'gemini-2.0-flash-lite', # Still works I guess
-        )
-        current_model = 0
-        if PRINT_MODE == 3 : print("get_gemini_model(): Successful.")
-    if new:
-        if PRINT_MODE == 3 : print("get_gemini_model(): Switching models.")
-        if current_model + 1 == len(MODELS):
-            # If all models have been cycled through
-            if PRINT_MODE >= 2 : print("get_gemini_model(): ERROR: All models have exceeded their rate limits. Please try again later or add more models.")
-            if DEBUG_MODE: debug_mode_input()
-        if PRINT_MODE == 3 : print(f"get_gemini_model(): Switching from {MODELS[current_model]}", end=" ")
-        current_model = (current_model + 1)
-        if PRINT_MODE == 3 : print(f"to {MODELS[current_model]}")
-    return MODELS[current_model]
-
-def gemini_request(prompt, content):
-    # Makes a call to the gemini API while handling rate limit restrictions
-    # Input: prompt & content
-    # Output: string response from gemini
-    if PRINT_MODE == 3 : print(f"gemini_request(): Creating gemini request\n\tPrompt: {prompt}\n\tContent:{content}")
-    sleep_time = 25
-    load_dotenv()
-    client = genai.Client(api_key=os.getenv('GEMINI_API_KEY'))
+    return return_str.strip().strip("\n")
+
+def gemini_generate(prompt, content, response_schema=None):
+    # Makes a call to the gemini API on the model picked by gemini_quota
+    # A model which is rate limited, no longer exists (404), fails on Google's end (5xx) or
+    # does not answer (timeout, dropped connection) is skipped by gemini_quota for a while,
+    # and the request is sent to the next model
+    # Input: prompt & content, and optionally a JSON response schema
+    # Output: (string response from gemini, model which answered)
+    # Raises gemini_quota.QuotaExhaustedError once every model has used up its daily quota,
+    # the genai.errors.ClientError of other 4xx (e.g. a bad request), and the
+    # genai.errors.ServerError or httpx.TransportError after SERVER_ERROR_RETRIES of those
+    if PRINT_MODE == 3 : print(f"gemini_generate(): Creating gemini request\n\tPrompt: {prompt}\n\tContent:{content}")
+    server_errors = 0
     while True:
+        # Waits only if every model is out of its per minute budget
+        model = gemini_quota.acquire()
         try:
-            response = client.models.generate_content(
-                # model='gemini-2.5-flash',
-                model=get_gemini_model(),
-                contents=content,
-                config=types.GenerateContentConfig(
-                    system_instruction=[prompt]
-                ),       
-            )
+            response = gemini_client.generate(model, prompt, content, response_schema=response_schema)
             break
 
-        except genai.errors.ClientError: # type: ignore
-            # There can be 2 scenarios where a ClientError is raised:
-            #   (1) The request limit per minute is hit
-            #   (2) The request limit for the model per day is hit
-            if sleep_time < 100:
-                # Case (1): The request limit per minute is hit
-                # Apply a delay before trying again
-                if PRINT_MODE >= 2 : print(f"gemini_request(): Rate limit exceeded. Waiting {sleep_time} seconds.")
-                time.sleep(sleep_time)
-                sleep_time *= 2
-            else:
-                # Case 2: The request limit for the model per day is hit
-                # Change the model used
-                if PRINT_MODE >= 2 : print(f"gemini_request(): Error: Rate limit for current model has been reached.")
-                get_gemini_model(new=True)
-                # Reset the sleep time
-                sleep_time=25
-
-        except genai.errors.ServerError: # type: ignore
+        except genai.errors.ClientError as e: # type: ignore
+            if e.code == 404:
+                # Model retired or renamed
+                gemini_quota.unavailable(model, e)
+                if PRINT_MODE >= 2 : print(f"gemini_generate(): {model} does not exist. Moving on to the next model.")
+                continue
+            if e.code != 429:
+                raise
+            # The per minute or per day limit of the model is hit
+            # gemini_quota moves the next requests to another model until this one has budget again
+            retry_delay = gemini_quota.rate_limited(model, e)
+            if PRINT_MODE >= 2 : print(f"gemini_generate(): Rate limit of {model} exceeded. Blocked for {retry_delay:.0f} seconds.")
+
+        except genai.errors.ServerError as e: # type: ignore
             # Error on Google's end
-            # Continue using the same model and retry after delay
-            if PRINT_MODE >= 2 : print(f"gemini_request(): Model is overloaded. Waiting {sleep_time} seconds.")
-            time.sleep(sleep_time)
-            sleep_time *= 2
-        
-    if PRINT_MODE == 3 : print(f"gemini_request(): Success.")
-    return str(response.text).strip('\n')
-
-def classify(data):
-    # Calls gemini to classify the code
+            server_errors += 1
+            if server_errors >= SERVER_ERROR_RETRIES:
+                raise
+            retry_delay = gemini_quota.unavailable(model, e)
+            if PRINT_MODE >= 2 : print(f"gemini_generate(): {model} is overloaded. Blocked for {retry_delay:.0f} seconds.")
+
+        except httpx.TransportError as e:
+            # Timed out or lost the connection, counted like a 5xx
+            server_errors += 1
+            if server_errors >= SERVER_ERROR_RETRIES:
+                raise
+            retry_delay = gemini_quota.unavailable(model, e)
+            if PRINT_MODE >= 2 : print(f"gemini_generate(): {model} did not answer ({e!r}). Blocked for {retry_delay:.0f} seconds.")
+
+    if PRINT_MODE == 3 : print(f"gemini_generate(): Success with {model}.")
+    return str(response.text).strip('\n'), model
+
+SERVER_ERROR_RETRIES = 5 # 5xx responses or timeouts before gemini_generate() gives up on a request
+ENRICH_BATCH_SIZE = int(os.getenv("GEMINI_BATCH_SIZE", 10))
+ENRICH_PROMPT = """
+    You will now take on the role of a data engineer classifying data. You will be provided a json list of independent isolated events, each with an index. Each event is unrelated to the
+    other events. For every event, reply with an object with the same index and only the fields listed in its "fields", out of the following:
+        eventType: To be included in the database, the event must be academic related and be of one of the following categories: 'Talks', 'Workshops', 'Case Comps', 'Hackathons'.
+            Should the event not fulfil any criteria, reply with 'ERROR'. Otherwise, reply with the category it falls in. Always reply with confidence along with it.
+        confidence: your confidence in the eventType in percentage, from 0 to 100.
+        mode: classify the location of the event into 1 of 4 categories: offline, online, hybrid or TBA. Where hybrid implies that the event takes place both physically and online
+            while TBA implies that the location is yet to be announced. If you are unsure or no location is given, reply with unknown.
+        briefDescription: as a UX designer, summarize the description in 30 words or less such that it would catch a user's attention to find out more about the event. Without any
+            formating, titles, headings, special characters or newlines.
+"""
+ENRICH_FIELDS = ("eventType", "mode", "briefDescription") # fields gemini can be asked for, in order
+
+def enrich_schema(fields):
+    # Response schema of a batch: every field is allowed, and the fields which every item of
+    # the batch asks for are required. confidence comes with eventType.
+    required = ["index"] + [field for field in ENRICH_FIELDS if field in fields]
+    if "eventType" in fields:
+        required.insert(2, "confidence")
+    return {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "index": {"type": "INTEGER"},
+                "eventType": {"type": "STRING", "enum": sorted(event_service.EVENT_TYPE_ENUM - {"Others"}) + ["ERROR"]},
+                "confidence": {"type": "INTEGER"},
+                "mode": {"type": "STRING", "enum": ["offline", "online", "hybrid", "TBA", "unknown"]},
+                "briefDescription": {"type": "STRING"},
+            },
+            "required": required,
+        },
+    }
+
+def needs_brief_description(brief_desc):
+    # A new brief description is generated if there is none or it is longer than 30 words
+    return len(brief_desc) == 0 or len(brief_desc.split(" ")) > 30
+
+def local_enrichment(event):
+    # Answers the mode and brief description of an event with scrape_rules where its rules are confident
+    # Output: dict with the mode and/or briefDescription which were answered locally
+    answers = dict()
+    if 'location' in event:
+        mode, confidence = scrape_rules.classify_mode(event['location'])
+        if confidence >= scrape_rules.CONFIDENCE_THRESHOLD:
+            answers['mode'] = mode
+        scrape_rules.record('mode', 'mode' in answers)
+    if needs_brief_description(event['briefDescription']):
+        brief, confidence = scrape_rules.summarize(event['description'] if len(event['briefDescription']) == 0 else event['briefDescription'])
+        if confidence >= scrape_rules.CONFIDENCE_THRESHOLD:
+            answers['briefDescription'] = brief
+        scrape_rules.record('brief', 'briefDescription' in answers)
+    return answers
+
+def needed_fields(event, answers):
+    # Fields of an event which gemini still has to answer, always including its eventType
+    fields = ['eventType']
+    if 'location' in event and 'mode' not in answers:
+        fields.append('mode')
+    if needs_brief_description(event['briefDescription']) and 'briefDescription' not in answers:
+        fields.append('briefDescription')
+    return fields
+
+def enrichment_item(event, fields):
+    # Fields of an event which are sent to gemini for enrichment: only what the fields asked for need
+    item = {"fields": fields, "title": event.get('title')}
+    if 'eventType' in fields:
+        item.update({"organisation": event.get('organisation'), "tags": event.get('tags')})
+    if 'mode' in fields:
+        item["location"] = event.get('location')
+    if 'eventType' in fields or 'briefDescription' in fields:
+        item.update({"briefDescription": event.get('briefDescription'), "description": event.get('description')})
+    return item
+
+def validate_enrichment(result, fields):
+    # Checks the fields asked for in a single enrichment result against the event enums
+    if not isinstance(result, dict):
+        return False
+    if 'eventType' in fields and not (
+        (result.get('eventType') in event_service.EVENT_TYPE_ENUM or result.get('eventType') == "ERROR") and
+        isinstance(result.get('confidence'), (int, float))
+    ):
+        return False
+    if 'mode' in fields and str(result.get('mode')).lower() not in event_service.MODE_ENUM:
+        return False
+    if 'briefDescription' in fields and not (
+        isinstance(result.get('briefDescription'), str) and result['briefDescription'].strip() != ""
+    ):
+        return False
+    return True
+
+def request_enrichment(items):
+    # Sends one batch of items to gemini
+    # Output: (dict of index -> result with the fields each item asked for, for the results which are valid, model which answered)
+    content = json.dumps([{"index": i, **item} for i, item in enumerate(items)], ensure_ascii=False)
+    common = set.intersection(*[set(item['fields']) for item in items])
+    try:
+        response, model = gemini_generate(ENRICH_PROMPT, content, response_schema=enrich_schema(common))
+        results = json.loads(response)
+    except gemini_quota.QuotaExhaustedError:
+        if PRINT_MODE >= 2 : print(f"request_enrichment(): Error: All models have used up their daily quota.")
+        return dict(), None
+    except genai.errors.APIError as e: # type: ignore
+        # The batch fails, enrich_batch() retries its items in smaller batches
+        if PRINT_MODE >= 2 : print(f"request_enrichment(): Error: gemini returned {e.code}: {e.message}")
+        return dict(), None
+    except httpx.TransportError as e:
+        # Every attempt timed out or lost the connection, handled like a failed batch
+        if PRINT_MODE >= 2 : print(f"request_enrichment(): Error: gemini did not answer: {e!r}")
+        return dict(), None
+    except ValueError:
+        if PRINT_MODE >= 2 : print(f"request_enrichment(): Error: gemini did not return valid json.")
+        results = []
+    valid = dict()
+    for result in results if isinstance(results, list) else []:
+        index = result.pop('index', None) if isinstance(result, dict) else None
+        if not (isinstance(index, int) and 0 <= index < len(items)):
+            continue
+        fields = items[index]['fields']
+        if validate_enrichment(result, fields):
+            # Fields which were not asked for are dropped, the local answers are used for them
+            result = {field: result[field] for field in result if field in fields or (field == 'confidence' and 'eventType' in fields)}
+            if 'mode' in result:
+                result['mode'] = result['mode'].lower()
+            result['model'] = model
+            valid[index] = result
+    return valid, model
+
+def enrich_batch(items, retries=1):
+    # Enriches a batch of items. Only the items which failed are sent again, split in halves
+    # so that one bad item does not fail the rest.
+    # Output: list with the result of each item, including the model which answered (None if it could not be enriched)
+    if len(items) == 0:
+        return []
+    results, model = request_enrichment(items)
+    failed = [i for i in range(len(items)) if i not in results]
+    if len(failed) == 0:
+        return [results[i] for i in range(len(items))]
+    if gemini_quota.exhausted():
+        # No quota left, retrying would fail the same way
+        return [results.get(i) for i in range(len(items))]
+    if len(items) == 1:
+        return enrich_batch(items, retries - 1) if retries > 0 else [None]
+    if PRINT_MODE >= 2 : print(f"enrich_batch(): {len(failed)}/{len(items)} results invalid. Retrying them.")
+    half = (len(failed) + 1) // 2
+    for group in (failed[:half], failed[half:]):
+        for i, result in zip(group, enrich_batch([items[i] for i in group], retries)):
+            if result is not None:
+                results[i] = result
+    return [results.get(i) for i in range(len(items))]
+
+def enrich_events(data):
+    # Calls gemini to classify the events and fill in their mode and brief description,
+    # ENRICH_BATCH_SIZE events per request. Results are cached per event (see gemini_cache).
+    # Only the eventType and the fields which scrape_rules could not answer are asked for.
     # Removes events which gemini determines is useless
     length = len(data)
-    if PRINT_MODE >= 2 : print(f"classify(): Starting classification of {length} events.")
+    if PRINT_MODE >= 2 : print(f"enrich_events(): Starting enrichment of {length} events.")
+    local = [local_enrichment(event) for event in data]
+    fields = [needed_fields(event, answers) for event, answers in zip(data, local)]
+    items = [enrichment_item(event, event_fields) for event, event_fields in zip(data, fields)]
+    contents = [json.dumps(item, ensure_ascii=False, sort_keys=True) for item in items]
+    results = []
+    for content in contents:
+        cached = gemini_cache.lookup(gemini_quota.model_names(), ENRICH_PROMPT, content)
+        results.append(json.loads(cached) if cached else None)
+
+    # Events asking for the same fields are batched together, so that the schema requires them
+    pending = sorted((i for i in range(length) if results[i] is None), key=lambda i: fields[i])
+    count_savings(data, local, items, pending)
+    for start in range(0, len(pending), ENRICH_BATCH_SIZE):
+        if gemini_quota.exhausted():
+            # The remaining events are enriched in the next run
+            if PRINT_MODE >= 2 : print(f"enrich_events(): Error: All models have used up their daily quota. {len(pending) - start} events not enriched.")
+            break
+        batch = pending[start:start + ENRICH_BATCH_SIZE]
+        if PRINT_MODE >= 2 : print(f"enrich_events(): Enriching {start + len(batch)}/{len(pending)} uncached events.")
+        for i, result in zip(batch, enrich_batch([items[i] for i in batch])):
+            if result is None: continue
+            results[i] = result
+            gemini_cache.store(result.pop('model'), ENRICH_PROMPT, contents[i], json.dumps(result))
+
     return_data = []
-    for i in range(len(data)):
-        if PRINT_MODE >= 2 : print(f"classify(): Classifying {i+1}/{length} event.")
-        response = gemini_request(
-            prompt="""
-                You will now take on the role of a data engineer classifying data. You will be provided information of independent isolated events in a json format. Each json represents an independent event which is unrelated to other events. Based on the information provided for
-                an event, you are to determine if the event should be in the database. To be included in the database, the event must be academic related and be of one of the following categories: 'Talks', 'Workshops', 'Case Comps', 'Hackathons'. Should the event not fulfil any criteria,
-                you are to reply with: 'ERROR, reasoning'. Otherwise, you are to determine which category it falls in, along with your confidence in your categorization in percentage. You are to only reply with both information in the format: 'category, confidence'.
-            """,
-            content=json.dumps(data[i])
-        )
-        if PRINT_MODE == 3 : print(f"classify(): {data[i]['title']}: {response}")
-        eventType, confidence = response.split(", ", 1) # Confidence can be logged
-        if eventType == "ERROR": continue
-        data[i]['eventType'] = eventType
-        if PRINT_MODE == 3 : print(f"Added: {data[i]['title']}")
-        return_data.append(data[i])
-    if PRINT_MODE >= 2 : print(f"classify(): Done.")
+    rejected = []
+    for event, answers, result in zip(data, local, results):
+        if result is None:
+            if PRINT_MODE >= 2 : print(f"enrich_events(): Error: Unable to enrich {event['title']}. Skipping event.")
+            continue
+        result = {**answers, **result}
+        if PRINT_MODE == 3 : print(f"enrich_events(): {event['title']}: {result['eventType']}, {result['confidence']}%, {result.get('mode')}")
+        if result['eventType'] == "ERROR":
+            # Rejected events are done with until their listing or detail page changes
+            scrape_fingerprint.commit(event['link'])
+            rejected.append(event['link'])
+            continue
+        event['eventType'] = result['eventType']
+        if 'location' in event:
+            event['mode'] = result['mode']
+            if 'mode' not in answers:
+                scrape_rules.remember_mode(event['location'], result['mode'])
+        if needs_brief_description(event['briefDescription']):
+            event['briefDescription'] = result['briefDescription']
+        if PRINT_MODE == 3 : print(f"Added: {event['title']}")
+        return_data.append(event)
+    scrape_checkpoint.mark_done(rejected)
+    if PRINT_MODE >= 2 : print(f"enrich_events(): Done.")
     return return_data
 
+def count_savings(data, local, items, pending):
+    # Counts the gemini tokens which the local answers avoided for the events which are not
+    # cached: their items leave out the inputs and outputs of the fields answered locally
+    # Input: the events, their local answers and items, and the indexes of the events to send
+    characters = 0
+    for i in pending:
+        if len(local[i]) == 0:
+            continue
+        full = enrichment_item(data[i], needed_fields(data[i], dict()))
+        characters += len(json.dumps(full, ensure_ascii=False)) - len(json.dumps(items[i], ensure_ascii=False))
+        characters += len(json.dumps(local[i], ensure_ascii=False))
+    scrape_rules.record_savings(len(pending), scrape_rules.estimate_tokens(characters))
+
 def parse_descriptions(brief_desc, desc):
-    # Helper function to:
-    #   (1) Set the brief and full description based on the length
-    #   (2) Check if brief description is less than 30 words
-    #   (3) Use AI to generate a brief description should it be necessary
-    if PRINT_MODE == 3 : print(f"parse_descriptions(): Starting.")
+    # Helper function to set the brief and full description based on the length
+    # A brief description which is missing or too long is generated in enrich_events()
     if len(brief_desc) > len(desc):
         brief_desc, desc = desc, brief_desc
-    
-    # Cases where there needs to be a new description generated:
-    #   (1) No brief_desc
-    #   (2) brief_desc too long
-    if len(brief_desc) == 0 or len(brief_desc.split(" ")) > 30:
-        if PRINT_MODE == 3 : print(f"parse_descriptions(): Generating new brief description.")
-        brief_desc = gemini_request(
-            prompt="""
-                You will now take on the role of a UX designer. You are provided with the description of
-                an event. You are to summarize the description in 30 words or less and provide a brief 
-                description of the event such that it would catch a user's attention to find out more
-                about the event. Return only the attention grabbing description without any formating, 
-                titles, headings, special characters or newlines.
-            """,
-            content=desc if len(brief_desc) == 0 else brief_desc
-        )
-        if PRINT_MODE == 3 : print(f"parse_descriptions(): Successful.\n\tResponse: {brief_desc}")
-    if PRINT_MODE == 3 : print(f"parse_descriptions(): Done.")
     return brief_desc, desc
 
-def get_mode_from_location(location):
-    if PRINT_MODE == 3 : print(f"get_mode_from_location(): Determining mode from location.")
-    response = gemini_request(prompt="""
-            You will now take on the role of a data engineer. You are provided with the location of
-            an event. You are to classify the location into 1 of 4 categories: offline, online,
-            hybrid or TBA. Where hybrid implies that the event takes place both physically and online
-            while TBA implies that the location is yet to be announced. If you are unsure, reply 
-            with unknown. You are only allowed to respond with any of the following 5 words: offline,
-            online, hybrid, TBA, unknown.
-        """,
-        content=location)
-    response = response.lower()
-    if response not in ('offline', 'online', 'hybrid', 'tba', 'unknown'):
-        if PRINT_MODE == 3 : 
-            print(f"""
-                get_mode_from_location(): Error: gemini_request did not return expected result.
-                    Expected: offline, online, hybrid, TBA or unknown
-                    Response: {response}
-            """)
-        response = 'unknown'
-    if PRINT_MODE == 3 : print(f"get_mode_from_location(): Successfully classfied as {response}.")
-    return response
-    
 def format_date(date_str):
     # Standardizes date format across different websites
     # Input: date string from scraping
@@ -262,6 +467,7 @@ def format_date(date_str):
     return None
 
 def insert_to_database(data):
+    # Output: list of the links of the events which were written
     # If it is the first time running, get the root user login details
     if 'user_id' not in globals():
         global user_id
@@ -269,6 +475,8 @@ def insert_to_database(data):
 
     # Insert entry into the database
     # Detects if it was not inserted properly
+    # The event services modify the dict they are given, so they get a copy
+    written = []
     for entry in data:
         try:
             signup_link = entry['signupLink']
@@ -276,66 +484,129 @@ def insert_to_database(data):
             event_id = event_service.check_has_event_by_signup_link_and_name(signup_link, title)
             if event_id:
                 # update event if it is already in the db
-                event_service.edit_event(event_id, entry)
-                continue
-            event_service.create_event(entry, user_id=user_id)
+                event_service.edit_event(event_id, dict(entry))
+            else:
+                event_id = event_service.create_event(dict(entry), user_id=user_id)
+            link_mirrored_image(event_id, entry.get('image'))
+            scrape_fingerprint.commit(entry.get('link'))
+            written.append(entry.get('link'))
         except Exception as e:
             print(f"Encountered error ${e}. Unable to add event ${title} (${signup_link}) into the db")
         # if return_str != signup_link:
         #     if PRINT_MODE >= 2 : print(f"insert_to_database(): Error: Unable to insert data entry with link {signup_link}.")
         #     if DEBUG_MODE : debug_mode_input()
+    return written
+
+def skip_unchanged(scraper, events):
+    # Drops events whose listing card is unchanged and whose detail page was checked recently
+    # Output: (events left to fetch, dict of link -> listing card hash)
+    card_hashes = {event['link']: scrape_fingerprint.listing_hash(event) for event in events}
+    if FULL_REFRESH:
+        return events, card_hashes
+    remaining = [event for event in events if not scrape_fingerprint.is_fresh(event['link'], card_hashes[event['link']])]
+    if PRINT_MODE >= 2 : print(f"{scraper}(): {len(events) - len(remaining)}/{len(events)} events unchanged since the last run.")
+    return remaining, card_hashes
+
+def is_unchanged_detail(scraper, event, card_hash, response):
+    # Checks the fetched detail page against the stored fingerprint, so unchanged events are
+    # not parsed, enriched or written again. Otherwise the new fingerprint is staged and
+    # stored once the event has been inserted (or rejected by enrich_events()).
+    url = event['link']
+    if not FULL_REFRESH and response.unchanged and scrape_fingerprint.is_unchanged(url, card_hash, response.content_hash):
+        if PRINT_MODE == 3 : print(f"{scraper}(): {url} is unchanged. Skipping event.")
+        return True
+    scrape_fingerprint.stage(url, card_hash, response.content_hash)
+    return False
+
+def link_mirrored_image(event_id, image):
+    # Links the mirrored image of a scraped event as an asset of the event so it is reference
+    # counted like uploads, and unlinks a previously mirrored image that has been replaced
+    if not event_id:
+        return
+    asset_id = asset_service.parse_asset_url(image)
+    for linked_id in asset_service.get_assets_by_event_id(event_id):
+        if linked_id != asset_id and image_mirror.is_mirrored(linked_id):
+            asset_service.unlink_asset(event_id, linked_id)
+    if asset_id:
+        try:
+            asset_service.link_asset(event_id, asset_id)
+        except asset_service.MissingAssetError:
+            # deleted after image_mirror.mirror_events() checked it, mirrored again on the next run
+            if PRINT_MODE >= 1 : print(f"link_mirrored_image(): Asset {asset_id} of event {event_id} no longer exists.")
 
 # (2) ---------------------- SCRAPER FUNCTIONS ----------------------
 
-def scrape_cordy():
-    # The following fields cannot be found from the cordy website:
-    #   (1) startTime
-    #   (2) endTime
-    #   (3) mode
-    #   (4) venue
-    if PRINT_MODE >= 2 : print(f"scrape_cordy(): Starting.")
-    URL = "https://www.cordy.sg/"
-    while True:
-        response = requests.get(URL)
-        if response.status_code == 200:
-            if PRINT_MODE == 3 : print(f"scrape_cordy(): Connection successful.")
-            soup = BeautifulSoup(response.content, 'html5lib')
-            break
-        else:
-            if PRINT_MODE >= 2 : print(f"scrape_cordy(): Connection unsuccessful.\nError: {response.status_code} - {response.text}")
-            if DEBUG_MODE : debug_mode_input()
-            if PRINT_MODE >= 2 : print(f"scrape_cordy(): Retrying in 10 seconds")
-            time.sleep(10)
-
+# Every page is parsed once with lxml, and the CSS selectors and XPath expressions below
+# are compiled once and run on that same tree.
+HTML_PARSER = lxml.html.HTMLParser(encoding='utf-8') # Both sites are served as UTF-8
+
+CORDY_EVENTS = CSSSelector('.opp-cms-wrapper.w-dyn-item', translator='html')
+CORDY_TITLE = CSSSelector('.text-block-6', translator='html')
+CORDY_LINK = CSSSelector('.opp-cms-link-item', translator='html')
+CORDY_DATE = CSSSelector('.text-block-10', translator='html')
+CORDY_TAGS = CSSSelector('.text-block-18', translator='html')
+CORDY_ORGANISATION = CSSSelector('.opp-cms-organisation', translator='html')
+CORDY_CAPTION = CSSSelector('.opp-cms-caption', translator='html')
+CORDY_IMAGE = CSSSelector('.opp-cms-thumbnail img', translator='html')
+CORDY_DESCRIPTION = etree.XPath('/html/body/div[3]/div/div[3]/div[3]')
+CORDY_SIGNUP_LINK = etree.XPath('/html/body/div[3]/div/a')
+
+INNOVATE_CARDS = etree.XPath('//div[contains(@class, "col-md-6 col-lg-4 mb-4")]')
+INNOVATE_PROMOTION = etree.XPath('.//img[contains(@src, "Host-an-event")]')
+INNOVATE_TITLE = etree.XPath('.//h4/a/text()')
+INNOVATE_LINK = etree.XPath('.//h4/a/@href')
+INNOVATE_IMAGE = etree.XPath('.//img/@src')
+INNOVATE_DATE = etree.XPath('.//p/text()')
+INNOVATE_REGISTER_LINK = etree.XPath('.//div[contains(@class, "register-hld")]//a/@href')
+INNOVATE_TAGS = etree.XPath('.//a[contains(@href, "search-events")]/text()')
+INNOVATE_ARTICLE = '//*[@id="content"]/section[1]/div/div/div/div/div/div[2]/article'
+INNOVATE_BRIEF_DESCRIPTION = etree.XPath(INNOVATE_ARTICLE + '/div[1]')
+INNOVATE_DESCRIPTION = etree.XPath(INNOVATE_ARTICLE + '/div[3]/section[1]')
+INNOVATE_SCHEDULE = etree.XPath(INNOVATE_ARTICLE + '/div[3]/section[2]')
+INNOVATE_LOCATION = etree.XPath('//*[@id="content"]/section[1]/div/div/div/header/div[3]/div/div[1]/div/div[2]')
+
+def parse_html(content):
+    # Input: html bytes of a page
+    # Output: root element of the parsed page
+    return lxml.html.document_fromstring(content, parser=HTML_PARSER)
+
+def get_text(element):
+    # Text of an element with the whitespace around every piece of text removed
+    return "".join(text.strip() for text in element.itertext())
+
+def select_text(selector, element):
+    # Text of the first match of selector in element (None if there is no match)
+    found = selector(element)
+    return get_text(found[0]) if found else None
+
+def parse_cordy_listing(dom):
+    # Input: parsed cordy listing page
+    # Output: list of events with the information on their cards
     events = []
     # Find all event blocks
-    for event in soup.select('.opp-cms-wrapper.w-dyn-item'):
+    for event in CORDY_EVENTS(dom):
         # Title
-        title = event.select_one('.text-block-6')
-        title = title.get_text(strip=True) if title else None
+        title = select_text(CORDY_TITLE, event)
 
         # Link
-        link = event.select_one('.opp-cms-link-item')
-        link = "https://www.cordy.sg" + str(link['href']) if link else None
+        link = CORDY_LINK(event)
+        link = "https://www.cordy.sg" + str(link[0].get('href')) if link else None
 
         # Date
-        date = event.select_one('.text-block-10')
-        date = date.get_text(strip=True) if date else None
+        date = select_text(CORDY_DATE, event)
 
         # Tags
-        tags = [tag.get_text(strip=True) for tag in event.select('.text-block-18')]
+        tags = [get_text(tag) for tag in CORDY_TAGS(event)]
 
         # Organisation
-        org = event.select_one('.opp-cms-organisation')
-        org = org.get_text(strip=True) if org else None
+        org = select_text(CORDY_ORGANISATION, event)
 
         # Brief Description
-        desc = event.select_one('.opp-cms-caption')
-        desc = desc.get_text(strip=True) if desc else None
+        desc = select_text(CORDY_CAPTION, event)
 
         # Image
-        img = event.select_one('.opp-cms-thumbnail img')
-        img = img['src'] if img else None
+        img = CORDY_IMAGE(event)
+        img = img[0].get('src') if img else None
 
         events.append({
             "title": title,
@@ -345,85 +616,40 @@ def scrape_cordy():
             "organisation": org,
             "briefDescription": desc,
             "image": img,
-            "origin": "web",
-            "mode": "unknown",
         })
         if PRINT_MODE == 3 : print(f"scrape_cordy(): Successfully added {title}")
-        
-
-    if PRINT_MODE == 3 : print(f"scrape_cordy(): All basic information added. Now scraping for more information.")
-    for i in range(len(events)):
-        # Go into each link to find:
-        #   (1) Full Description
-        #   (2) Signup Link
-        event = events[i]
-        url = event['link']
-        if PRINT_MODE == 3 : print(f"scrape_cordy(): Accessing {url}.")
-        while True:
-            response = requests.get(url)
-            if response.status_code == 200:
-                if PRINT_MODE == 3 : print(f"scrape_cordy(): Successful.")
-                soup = BeautifulSoup(response.content, 'html.parser')
-                dom = etree.HTML(text=str(soup), parser=None)
-
-                # Get the full description
-                paragraphs = dom.xpath('/html/body/div[3]/div/div[3]/div[3]')[0]
-                description = parse_paragraphs(paragraphs)
-
-                # Swap brief and full description based on length
-                events[i]['briefDescription'], events[i]['description'] = parse_descriptions(events[i]['briefDescription'], description)
-                
-                # Extract sign up link
-                signup_link = dom.xpath('/html/body/div[3]/div/a')[0].attrib['href']
-                events[i]['signupLink'] = signup_link
-                if PRINT_MODE == 3 : print(f"scrape_cordy(): Successfully added event.")
-                break
-            else:
-                if PRINT_MODE >= 2 : print(f"scrape_cordy(): Connection unsuccessful.\nError: {response.status_code} - {response.text}")
-                if DEBUG_MODE : debug_mode_input()
-                if PRINT_MODE >= 2 : print(f"scrape_cordy(): Retrying in 10 seconds")
-                time.sleep(10)
-    
-    if PRINT_MODE == 3 : print(f"scrape_cordy(): Cordy information added. Now classifying and filtering events.")
-    return list(classify(events))
+    return events
 
-def scrape_innovate():
-    # The following fields cannot be found from the cordy website:
-    #   (1) organisation
-    #   (2) startTime & endTime due to inconsistency -> schedule is put in additional information
-    if PRINT_MODE >= 2 : print(f"scrape_innovate(): Starting.")
-    URL = "https://www.sginnovate.com/events"
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-    while True:
-        response = requests.get(URL, headers=headers)
-        if response.status_code == 200:
-            if PRINT_MODE == 3 : print(f"scrape_innovate(): Connection successful.")
-            # Parse with etree for XPath
-            soup = BeautifulSoup(response.content, 'html.parser')
-            dom = etree.HTML(text=str(soup), parser=None)
-            break
-        else:
-            if PRINT_MODE >= 2 : print(f"scrape_innovate(): Connection unsuccessful.\nError: {response.status_code} - {response.text}")
-            if DEBUG_MODE : debug_mode_input()
-            if PRINT_MODE >= 2 : print(f"scrape_innovate(): Retrying in 10 seconds")
-            time.sleep(10)
-        
-    # Find event cards using XPath
-    event_cards = dom.xpath('//div[contains(@class, "col-md-6 col-lg-4 mb-4")]')
-    
+def parse_cordy_detail(dom, event):
+    # Adds to an event from its parsed cordy page:
+    #   (1) Full Description
+    #   (2) Signup Link
+    # Get the full description
+    description = parse_paragraphs(CORDY_DESCRIPTION(dom)[0])
+
+    # Swap brief and full description based on length
+    event['briefDescription'], event['description'] = parse_descriptions(event['briefDescription'], description)
+
+    # Extract sign up link
+    event['signupLink'] = CORDY_SIGNUP_LINK(dom)[0].attrib['href']
+    return event
+
+def parse_innovate_listing(dom):
+    # Input: parsed sginnovate listing page
+    # Output: list of events with the information on their cards
     events = []
-    for card in event_cards:
+    for card in INNOVATE_CARDS(dom):
         # Skip promotional cards
-        if card.xpath('.//img[contains(@src, "Host-an-event")]'):
+        if INNOVATE_PROMOTION(card):
             continue
         # Extract data using XPath
-        title = card.xpath('.//h4/a/text()')
-        link = card.xpath('.//h4/a/@href')
-        image = card.xpath('.//img/@src')
-        date = card.xpath('.//p/text()')
-        register_link = card.xpath('.//div[contains(@class, "register-hld")]//a/@href')
-        tags = card.xpath('.//a[contains(@href, "search-events")]/text()')
-        
+        title = INNOVATE_TITLE(card)
+        link = INNOVATE_LINK(card)
+        image = INNOVATE_IMAGE(card)
+        date = INNOVATE_DATE(card)
+        register_link = INNOVATE_REGISTER_LINK(card)
+        tags = INNOVATE_TAGS(card)
+
         # Build event dict
         event = {
             'title': title[0].strip() if title else '',
@@ -432,66 +658,200 @@ def scrape_innovate():
             'signupDeadline': format_date(date[0].strip()) if date else None,
             'signupLink': register_link[0] if register_link else '',
             'tags': [tag.strip() for tag in tags if tag.strip() and not tag.startswith('+')],
-            'origin': 'web'
         }
-        
+
         # Only add if has title
         if event['title']:
             events.append(event)
             if PRINT_MODE == 3 : print(f"scrape_innovate(): Successfully added {event['title']}")
-    
-    if PRINT_MODE == 3 : print(f"scrape_innovate(): All basic information added. Now scraping for more information.")
-    for i in range(len(events)):
-        # Go into each link to find:
-        #   (1) Brief and full Description
-        #   (2) Schedule
-        #   (3) Venue + Mode
-        event = events[i]
+    return events
+
+def parse_innovate_detail(dom, event):
+    # Adds to an event from its parsed sginnovate page:
+    #   (1) Brief and full Description
+    #   (2) Schedule
+    #   (3) Venue + Mode
+    # Extract brief description and description
+    brief_description = parse_paragraphs(INNOVATE_BRIEF_DESCRIPTION(dom)[0])
+    description = parse_paragraphs(INNOVATE_DESCRIPTION(dom)[0])
+
+    # Assign to the json based on length
+    event['briefDescription'], event['description'] = parse_descriptions(brief_description, description)
+
+    # Extract schedule
+    event['additionalInformation'] = parse_paragraphs(INNOVATE_SCHEDULE(dom)[0])
+
+    # Extract venue/ mode
+    event['location'] = parse_paragraphs(INNOVATE_LOCATION(dom)[0])
+    return event
+
+def fetch_listing(source, deadline):
+    # Fetches the listing page of a source, retrying every 10 seconds until it is available
+    # or the time of the source is up
+    # Output: root element of the parsed page
+    scraper = f"scrape_{source.name}"
+    while True:
+        response = scrape_http.fetch(source.listing_url, retries=1)
+        if response is not None and response.status_code == 200:
+            if PRINT_MODE == 3 : print(f"{scraper}(): Connection successful.")
+            return parse_html(response.content)
+        if PRINT_MODE >= 2 : print(f"{scraper}(): Connection unsuccessful.\nError: {response.status_code if response is not None else 'no response'}")
+        if DEBUG_MODE : debug_mode_input()
+        scrape_sources.check_deadline(deadline)
+        if PRINT_MODE >= 2 : print(f"{scraper}(): Retrying in 10 seconds")
+        time.sleep(10)
+
+# The sources which are scraped (see scrape_sources)
+scrape_sources.register(scrape_sources.Source(
+    name="cordy",
+    listing_url="https://www.cordy.sg/",
+    parse_listing=parse_cordy_listing,
+    parse_detail=parse_cordy_detail,
+    # The following fields cannot be found from the cordy website:
+    #   (1) startTime
+    #   (2) endTime
+    #   (3) mode
+    #   (4) venue
+    fields={"origin": "web", "mode": "unknown"},
+))
+scrape_sources.register(scrape_sources.Source(
+    name="sginnovate",
+    listing_url="https://www.sginnovate.com/events",
+    parse_listing=parse_innovate_listing,
+    parse_detail=parse_innovate_detail,
+    # The following fields cannot be found from the sginnovate website:
+    #   (1) organisation
+    #   (2) startTime & endTime due to inconsistency -> schedule is put in additional information
+    # The mode is set from the location in enrich_events()
+    fields={"origin": "web", "mode": "unknown"},
+))
+
+# Every source runs as the streaming stages below (see scrape_pipeline), so events reach
+# the database while later pages are still being fetched:
+#   list -> fetch -> parse -> enrich -> upsert
+
+def list_events(source, deadline):
+    # Stage 1: Yields a job for every event on the listing page of the source which has to be processed
+    # Events already done by a resumed run and events unchanged since the last run are left out
+    scraper = f"scrape_{source.name}"
+    if PRINT_MODE >= 2 : print(f"{scraper}(): Starting.")
+    events = [source.apply_fields(event) for event in source.parse_listing(fetch_listing(source, deadline))]
+    scrape_sources.record(source.name, listed=len(events))
+    if PRINT_MODE == 3 : print(f"{scraper}(): All basic information added. Now scraping for more information.")
+    events = [event for event in events if not scrape_checkpoint.is_done(event['link'])]
+    events, card_hashes = skip_unchanged(scraper, events)
+    scrape_sources.record(source.name, queued=len(events))
+    for event in events:
+        yield {"source": source, "event": event, "cardHash": card_hashes[event['link']]}
+
+def fetch_details(jobs, source, deadline):
+    # Stage 2: Fetches the detail page of every job
+    # Pages are fetched concurrently and yielded in order as they arrive
+    # Output: (job, response) for every job
+    pending = deque()
+    def links():
+        for job in jobs:
+            pending.append(job)
+            yield job['event']['link']
+    for response in scrape_http.fetch_all(links(), max_workers=source.concurrency):
+        scrape_sources.check_deadline(deadline)
+        yield pending.popleft(), response
+
+def parse_details(fetched):
+    # Stage 3: Adds the information on its detail page to every event
+    # Events whose page could not be fetched or parsed, or which are unchanged, are left out
+    for job, response in fetched:
+        source, event = job['source'], job['event']
+        scraper = f"scrape_{source.name}"
         url = event['link']
-        if PRINT_MODE == 3 : print(f"scrape_innovate(): Accessing {url}.")
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-        response = requests.get(url, headers=headers)
-        while True:
-            if response.status_code == 200:
-                if PRINT_MODE == 3 : print(f"scrape_innovate(): Successful.")
-                # Parse with etree for XPath
-                soup = BeautifulSoup(response.content, 'html.parser')
-                dom = etree.HTML(text=str(soup), parser=None)
-
-                # Extract brief description
-                paragraphs = dom.xpath('//*[@id="content"]/section[1]/div/div/div/div/div/div[2]/article/div[1]')[0]
-                brief_description = parse_paragraphs(paragraphs)
-
-                # Extract description
-                paragraphs = dom.xpath('//*[@id="content"]/section[1]/div/div/div/div/div/div[2]/article/div[3]/section[1]')[0]
-                description = parse_paragraphs(paragraphs)
-
-                # Assign to the json based on length
-                events[i]['briefDescription'], events[i]['description'] = parse_descriptions(brief_description, description)
-
-                # Extract schedule
-                paragraphs = dom.xpath('//*[@id="content"]/section[1]/div/div/div/div/div/div[2]/article/div[3]/section[2]')[0]
-                schedule = parse_paragraphs(paragraphs)
-                events[i]['additionalInformation'] = schedule
-
-                # Extract venue/ mode
-                paragraphs = dom.xpath('//*[@id="content"]/section[1]/div/div/div/header/div[3]/div/div[1]/div/div[2]')[0]
-                location = parse_paragraphs(paragraphs)
-                events[i]['location'] = location
-                events[i]['mode'] = get_mode_from_location(location)
-                if PRINT_MODE == 3 : print(f"scrape_innovate(): Successfully added event.")
-                break
-            else:
-                if PRINT_MODE >= 2 : print(f"scrape_innovate(): Connection unsuccessful.\nError: {response.status_code} - {response.text}")
-                if DEBUG_MODE : debug_mode_input()
-                if PRINT_MODE >= 2 : print(f"scrape_innovate(): Retrying in 10 seconds")
-                time.sleep(10)
-    if PRINT_MODE == 3 : print(f"scrape_innovate(): Cordy information added. Now classifying and filtering events.") 
-    return list(classify(events))
+        if response is None or response.status_code != 200:
+            if PRINT_MODE >= 2 : print(f"{scraper}(): Unable to access {url}. Skipping event.")
+            if DEBUG_MODE : debug_mode_input()
+            scrape_sources.record(source.name, skipped=1)
+            continue
+        if PRINT_MODE == 3 : print(f"{scraper}(): Accessed {url}.")
+        if is_unchanged_detail(scraper, event, job['cardHash'], response):
+            scrape_sources.record(source.name, skipped=1)
+            continue
+        try:
+            source.parse_detail(parse_html(response.content), event)
+        except (IndexError, KeyError) as e:
+            # The page does not have the expected layout
+            if PRINT_MODE >= 2 : print(f"{scraper}(): Unable to parse {url}: {e!r}. Skipping event.")
+            if DEBUG_MODE : debug_mode_input()
+            scrape_sources.record(source.name, skipped=1)
+            continue
+        if PRINT_MODE == 3 : print(f"{scraper}(): Successfully added event.")
+        yield event
+
+def enrich_details(events, source, deadline):
+    # Stage 4: Classifies and filters the events, ENRICH_BATCH_SIZE at a time (see enrich_events())
+    for batch in scrape_pipeline.batched(events, ENRICH_BATCH_SIZE):
+        scrape_sources.check_deadline(deadline)
+        enriched = enrich_events(batch)
+        scrape_sources.record(source.name, skipped=len(batch) - len(enriched))
+        yield from enriched
+
+def upsert_events(events):
+    # Stage 5: Mirrors the event images and writes the events to the database, INSERT_BATCH_SIZE
+    # at a time (unless RETURN_DATA is set, then the events keep their remote images as nothing
+    # would link the mirrored copies). Every micro-batch is checkpointed once it is written.
+    for batch in scrape_pipeline.batched(events, INSERT_BATCH_SIZE):
+        if not RETURN_DATA:
+            batch = image_mirror.mirror_events(batch)
+            if PRINT_MODE == 3 : print(f"upsert_events(): Inserting {len(batch)} events into database.")
+            scrape_checkpoint.mark_done(insert_to_database(batch))
+        yield from batch
+
+def scrape_source(source, deadline):
+    # Scrapes one source through the pipeline
+    # Called in a thread per source by scrape_sources.run_all()
+    stages = [
+        ("list", lambda: list_events(source, deadline)),
+        ("fetch", lambda jobs: fetch_details(jobs, source, deadline)),
+        ("parse", parse_details),
+        ("enrich", lambda events: enrich_details(events, source, deadline)),
+        ("upsert", upsert_events),
+    ]
+    for event in scrape_pipeline.run(stages, name=source.name):
+        scrape_sources.record(source.name, events=1)
+        write_output(event)
 
 # (3) ---------------------- MAIN FUNCTIONS ----------------------
 
-def scrape(print_mode='Off', debug_mode=False, return_data=False):
+def open_output(path):
+    # Starts a json list of the scraped events in path, which write_output() adds to as
+    # events come out of the pipelines, so the file holds every event of the run without
+    # keeping them in memory
+    with _output_lock:
+        try:
+            _output['file'] = open(path, 'w', encoding="utf-8")
+            _output['file'].write("[")
+        except OSError:
+            _output['file'] = None
+        _output['count'] = 0
+        _output['data'] = []
+
+def write_output(event):
+    # Adds an event to the output file, and to the returned data when RETURN_DATA is set
+    with _output_lock:
+        if _output['file'] is not None:
+            _output['file'].write(("," if _output['count'] else "") + "\n" + textwrap.indent(json.dumps(event, indent=2, ensure_ascii=False), "  "))
+        if RETURN_DATA:
+            _output['data'].append(event)
+        _output['count'] += 1
+
+def close_output():
+    # Output: list of the events written (empty unless RETURN_DATA is set)
+    with _output_lock:
+        if _output['file'] is not None:
+            _output['file'].write("\n]" if _output['count'] else "]")
+            _output['file'].close()
+            _output['file'] = None
+        data, _output['data'] = _output['data'], []
+        return data
+
+def scrape(print_mode='Off', debug_mode=False, return_data=False, full_refresh=False):
     # quite_mode has 3 options:
     #   (1) off
     #   (2) critical
@@ -500,9 +860,16 @@ def scrape(print_mode='Off', debug_mode=False, return_data=False):
     #   Pass in True to enable user inputs for decisions
     # return_data:
     #   Pass in True to enable returning the list of JSON after scraping
-    #   Else, the scraped data will be inserted into the database.
+    #   Else, the scraped data will be inserted into the database, in micro-batches as it is scraped.
+    #   An interrupted run is resumed by the next one (see scrape_checkpoint).
+    # full_refresh:
+    #   Pass in True to process every event again, even if it is unchanged since the last run
+    #   Else, events whose listing card and detail page are unchanged are skipped.
+    # The registered sources are scraped in parallel (see scrape_sources).
     global PRINT_MODE
     global DEBUG_MODE
+    global FULL_REFRESH
+    global RETURN_DATA
     match print_mode:
         case 'critical':
             print("scrape(): Print mode set to: Critical")
@@ -514,24 +881,49 @@ def scrape(print_mode='Off', debug_mode=False, return_data=False):
             PRINT_MODE = 1
     DEBUG_MODE = debug_mode if (debug_mode == True) else False
     if PRINT_MODE >= 2 : print(f"scrape(): Debug mode set to {str(DEBUG_MODE)}.")
-    cordy_data = scrape_cordy()
-    sginnovate_data = scrape_innovate()
+    FULL_REFRESH = full_refresh == True
+    RETURN_DATA = return_data == True
+    scrape_http.reset_stats()
+    http_cache.reset_stats()
+    scrape_fingerprint.reset_stats()
+    gemini_cache.reset_stats()
+    gemini_client.reset_stats()
+    scrape_rules.reset_stats()
+    scrape_pipeline.reset_stats()
+    scrape_checkpoint.reset_stats()
+    scrape_sources.reset_stats()
+    if not RETURN_DATA:
+        run = scrape_checkpoint.start(FULL_REFRESH)
+        if run['resumed']:
+            FULL_REFRESH = run['fullRefresh']
+            if PRINT_MODE >= 2 : print(f"scrape(): Resuming run {run['id']}, {run['done']} events already done.")
+    if PRINT_MODE >= 2 : print(f"scrape(): Full refresh set to {str(FULL_REFRESH)}.")
+
+    open_output('output.json')
+    statuses = scrape_sources.run_all(scrape_source)
+    data = close_output()
     if PRINT_MODE == 3 : print(f"scrape(): Scraping completed.")
-    data = list(cordy_data) + list(sginnovate_data)
-    try:
-        with open('output.json', 'w', encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except:
-        pass
-
-
-    if return_data:
+    if all(status == "ok" for status in statuses.values()):
+        scrape_checkpoint.finish()
+    elif PRINT_MODE >= 2:
+        print(f"scrape(): Not every source completed. The next run resumes this one.")
+
+    if PRINT_MODE >= 2 : scrape_sources.print_report()
+    if PRINT_MODE >= 2 : scrape_pipeline.print_report()
+    if PRINT_MODE >= 2 : scrape_http.print_report()
+    if PRINT_MODE >= 2 : http_cache.print_report()
+    if PRINT_MODE >= 2 : gemini_cache.print_report()
+    if PRINT_MODE >= 2 : gemini_quota.print_report()
+    if PRINT_MODE >= 2 : gemini_client.print_report()
+    if PRINT_MODE >= 2 : scrape_rules.print_report()
+    if PRINT_MODE >= 2 : scrape_fingerprint.print_report()
+    if PRINT_MODE >= 2 : scrape_checkpoint.print_report()
+    http_cache.evict()
+    gemini_cache.evict()
+
+    if RETURN_DATA:
         if PRINT_MODE == 3 : print(f"scrape(): Returning data.")
         return data
-    else:
-        if PRINT_MODE == 3 : print(f"scrape(): Inserting data into database.")
-        insert_to_database(data)
-        if PRINT_MODE == 3 : print(f"scrape(): Insert successful.")
     
 
 # (4) ---------------------- SAMPLE RUN CODE ----------------------